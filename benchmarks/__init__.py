@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for mtgcollector's slowest operations.
+
+Each benchmark is run as a module, e.g. `python3 -m benchmarks.update`, and records its results as JSON so that runs
+can be compared with `--compare previous.json`
+"""
+
+import contextlib
+import datetime
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import flask
+import typing
+
+import lib.db
+import lib.db.maintenance
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+results_directory = os.path.join(os.path.dirname(__file__), "results")
+
+
+def create_app(config_path: str, **config) -> flask.Flask:
+    """
+    Creates an application configured like the server, for the benchmarks to use
+
+    :param config_path: configuration file of the server
+    :param config: values overriding the configuration
+    :return: the configured application
+    """
+    app = flask.Flask("mtgcollector")
+    app.config.from_pyfile(os.path.abspath(config_path))
+    app.config.update(config)
+    lib.db.configure(app)
+    return app
+
+
+@contextlib.contextmanager
+def benchmark_database(app: flask.Flask):
+    """
+    Creates the database named in the application's configuration for the duration of a benchmark, and drops it
+    afterwards. Refuses to touch an existing database, as it could hold real data
+
+    :param app: application configured with the database to create
+    """
+    if lib.db.commands.database_exists(app):
+        raise RuntimeError("Database {} already exists, give another one to run the benchmark on".format(
+            app.config["DATABASE_NAME"]
+        ))
+
+    lib.db.maintenance.MaintenanceDB(app).setup_db()
+    try:
+        yield
+    finally:
+        lib.db.commands.drop_database(app)
+
+
+class Recorder:
+    """
+    Times the stages of a benchmark and, if asked, measures the memory they allocate.
+
+    Memory is traced with tracemalloc, which slows python code down noticeably : timings of a run measuring memory
+    should only be compared with other runs measuring memory
+
+    :param memory: whether to trace memory allocations
+    """
+    def __init__(self, memory: bool=False):
+        self.memory = memory
+        self.stages = OrderedDict()  # type: typing.Dict[str, typing.Dict[str, float]]
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Context manager measuring a stage
+
+        :param name: name of the stage
+        """
+        if self.memory:
+            tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            yield
+            result = self.stages[name] = OrderedDict(seconds=time.perf_counter() - start)
+
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                result["allocated_bytes"] = current
+                result["peak_bytes"] = peak
+        finally:
+            # a failed stage must not leave the tracing on, slowing down everything run after it
+            if self.memory:
+                tracemalloc.stop()
+        # maximum resident size of the process so far, in kilobytes on Linux
+        result["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("{:>30} : {:8.3f}s".format(name, result["seconds"]), file=sys.stderr)
+
+
+def percentile(values: typing.Sequence[float], rank: float) -> float:
+    """
+    Computes a percentile with the nearest rank method
+
+    :param values: values, sorted in increasing order
+    :param rank: the percentile to compute, between 0 and 100
+    :return: the smallest value greater than or equal to rank percent of the values
+    """
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+def summarize(latencies: typing.List[float], queries: typing.List[int]=None) -> typing.Dict[str, float]:
+    """
+    Summarizes the latencies of requests
+
+    :param latencies: time taken by each request, in seconds
+    :param queries: number of database queries done by each request
+    :return: the number of requests, their mean, median, 95th and 99th percentile latencies and mean number of queries
+    """
+    latencies = sorted(latencies)
+    summary = OrderedDict([
+        ("count", len(latencies)),
+        ("mean_seconds", sum(latencies) / len(latencies)),
+        ("p50_seconds", percentile(latencies, 50)),
+        ("p95_seconds", percentile(latencies, 95)),
+        ("p99_seconds", percentile(latencies, 99)),
+    ])
+    if queries:
+        summary["mean_queries"] = sum(queries) / len(queries)
+    return summary
+
+
+def git_revision() -> typing.Union[str, None]:
+    """ The revision of the benchmarked code, if it is in a git repository """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(benchmark: str, results: typing.Dict, output: str=None) -> str:
+    """
+    Writes the results of a benchmark along with a description of the environment it ran in
+
+    :param benchmark: name of the benchmark
+    :param results: results of the benchmark
+    :param output: file in which to write, defaults to a new file in benchmarks/results
+    :return: path of the written file
+    """
+    started = datetime.datetime.now()
+    if output is None:
+        os.makedirs(results_directory, exist_ok=True)
+        output = os.path.join(results_directory, "{}-{}.json".format(benchmark, started.strftime("%Y%m%d-%H%M%S")))
+
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(OrderedDict([
+            ("benchmark", benchmark),
+            ("date", started.isoformat()),
+            ("revision", git_revision()),
+            ("python", platform.python_version()),
+            ("platform", platform.platform()),
+            ("results", results),
+        ]), output_file, indent=2)
+    return output
+
+
+def compare(previous: typing.Dict, current: typing.Dict, path: str="") -> typing.Iterator[str]:
+    """
+    Compares the timings of two runs of the same benchmark
+
+    :param previous: results of the previous run
+    :param current: results of the current run
+    :param path: path of the compared results in the whole results, for display
+    :return: iterator over a line for each timing found in both runs
+    """
+    for key, value in current.items():
+        if key not in previous:
+            continue
+        if isinstance(value, dict):
+            yield from compare(previous[key], value, "{}{} / ".format(path, key))
+        elif key.endswith("seconds") and previous[key]:
+            yield "{:<60} {:8.3f}s -> {:8.3f}s ({:+.1%})".format(
+                path + key, previous[key], value, (value - previous[key]) / previous[key]
+            )
+
+
+def report(benchmark: str, results: typing.Dict, output: str=None, previous: str=None) -> None:
+    """
+    Saves the results of a benchmark and compares them with a previous run
+
+    :param benchmark: name of the benchmark
+    :param results: results of the benchmark
+    :param output: file in which to write, defaults to a new file in benchmarks/results
+    :param previous: results file of a previous run to compare with
+    """
+    print("Results written to {}".format(save(benchmark, results, output)))
+    if previous is not None:
+        with open(previous, encoding="utf-8") as previous_file:
+            for line in compare(json.load(previous_file)["results"], results):
+                print(line)
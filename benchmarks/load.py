@@ -0,0 +1,504 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the whole application : starts the server as the integration tests do, against a temporary database
+holding a synthetic catalog and a local stand-in for mtgjson and gatherer, then drives concurrent sessions through it.
+
+Each session logs in, searches, scrolls through the results fetching their images, opens card details and edits the
+collection and a deck, while other clients stay subscribed to the server sent events. Throughput, latency percentiles
+and error rates are reported for each endpoint :
+
+    $ python3 -m benchmarks.load --config config.cfg --sessions 20 --subscribers 50 --duration 60
+"""
+
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from argparse import ArgumentParser
+from collections import OrderedDict
+from io import BytesIO
+
+import requests
+import requests.exceptions
+import typing
+
+import benchmarks
+import lib.db
+import mtgcollector
+from tests import LiveServerTestCase, DBConnectionMixin
+from tests.catalog import generate_dump, populate
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+# smallest valid png, served as every image and icon
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d49444154789c6300010000000500010d0a2db4"
+    "0000000049454e44ae426082"
+)
+
+csrf_token = re.compile(r'<meta name="csrf-token" content="([^"]+)"')
+card_ids = re.compile(r'<div id="(\d+)" data-normal=')
+
+
+class StandIn(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Local server standing in for mtgjson and gatherer, so that load tests do not depend on, nor hammer, them
+
+    :param dump: catalog to serve as mtgjson's AllSets-x.json
+    :param version: version of the catalog
+    :param latency: time to wait before answering each request for an image, in seconds
+    """
+    daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        Answers the requests for mtgjson's files and gatherer's images
+        """
+        def do_GET(self):
+            """ Serves the version file, the zipped catalog and images """
+            path = self.path.split("?")[0]
+            if path == "/json/version-full.json":
+                self.send(json.dumps(dict(version=self.server.version)).encode(), "application/json")
+            elif path == "/json/AllSets-x.json.zip":
+                self.send(self.server.archive, "application/zip")
+            elif path == "/Handlers/Image.ashx":
+                time.sleep(self.server.latency)
+                self.send(PNG, "image/png")
+            else:
+                self.send_error(404)
+
+        def send(self, body: bytes, content_type: str) -> None:
+            """
+            Sends a successful answer
+
+            :param body: content of the answer
+            :param content_type: type of the content
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # noinspection PyShadowingBuiltins
+        def log_message(self, format, *args):
+            """ Requests are not logged, there are too many of them """
+
+    def __init__(self, dump: typing.Dict, version: str="1.0.0", latency: float=0):
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        self.version = version
+        self.latency = latency
+        with BytesIO() as archive:
+            with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zipped:
+                zipped.writestr("AllSets-x.json", json.dumps(dump))
+            self.archive = archive.getvalue()
+
+    @property
+    def url(self) -> str:
+        """ url of the server """
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self) -> None:
+        """ Serves requests in a background thread """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class LoadServer(LiveServerTestCase.LiveServer):
+    """
+    Server under test, run as for the integration tests but without the debugger
+    """
+    def run(self):
+        """ Creates flask app and setups it before launching it """
+        os.environ["MTG_COLLECTOR_CONFIG"] = os.path.join(self.directory, "config.cfg")
+        mtgcollector.app.static_folder = self.directory
+        mtgcollector.setup_app(mtgcollector.app)
+        mtgcollector.app.run(port=int(DBConnectionMixin.SERVER_PORT), use_reloader=False, threaded=True)
+
+
+class Statistics:
+    """
+    Latencies and errors of the requests, by endpoint
+    """
+    def __init__(self):
+        self.latencies = OrderedDict()  # type: typing.Dict[str, typing.List[float]]
+        self.errors = OrderedDict()  # type: typing.Dict[str, int]
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, duration: float, error: bool) -> None:
+        """
+        Records a request
+
+        :param endpoint: endpoint requested
+        :param duration: time taken by the request, in seconds
+        :param error: whether the request failed
+        """
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(duration)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + error
+
+    def summary(self, duration: float) -> typing.Dict[str, typing.Dict]:
+        """
+        Summarizes the requests of each endpoint
+
+        :param duration: duration of the load test, in seconds
+        :return: the throughput, latency percentiles, errors and error rate of each endpoint and of all of them
+        """
+        with self.lock:
+            endpoints = OrderedDict(all=[latency for latencies in self.latencies.values() for latency in latencies])
+            endpoints.update(self.latencies)
+            errors = dict(self.errors, all=sum(self.errors.values()))
+
+        results = OrderedDict()
+        for endpoint, latencies in endpoints.items():
+            if not latencies:
+                continue
+            summary = results[endpoint] = benchmarks.summarize(latencies)
+            summary["throughput"] = len(latencies) / duration
+            summary["errors"] = errors[endpoint]
+            summary["error_rate"] = errors[endpoint] / len(latencies)
+        return results
+
+
+class Session:
+    """
+    A user browsing the application
+
+    :param url: url of the server
+    :param username: name of the user
+    :param password: password of the user
+    :param statistics: where to record the requests
+    :param options: parameters of the load test
+    :param seed: seed of the user's choices
+    """
+    def __init__(self, url: str, username: str, password: str, statistics: Statistics, options, seed: int):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.statistics = statistics
+        self.options = options
+        self.generator = random.Random(seed)
+        self.http = requests.Session()
+        self.csrf_token = None  # type: str
+        self.deck = "load-{}".format(seed)
+
+    def request(self, endpoint: str, method: str, path: str, **kwargs) -> typing.Union[requests.Response, None]:
+        """
+        Sends a request and records its latency and whether it failed
+
+        :param endpoint: name under which to record the request
+        :param method: http method to use
+        :param path: path to request
+        :param kwargs: arguments given to requests
+        :return: the response, or None if the request did not get one
+        """
+        if method != "GET":
+            kwargs.setdefault("headers", {})["X-CSRFToken"] = self.csrf_token
+            kwargs.setdefault("data", {})["csrf_token"] = self.csrf_token
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.url + path, timeout=self.options.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.statistics.record(endpoint, time.perf_counter() - start, True)
+            return None
+        self.statistics.record(endpoint, time.perf_counter() - start, response.status_code >= 400)
+
+        token = csrf_token.search(response.text) if "text/html" in response.headers.get("Content-Type", "") else None
+        if token is not None:
+            self.csrf_token = token.group(1)
+        return response
+
+    def login(self) -> bool:
+        """
+        Logs the user in
+
+        :return: whether the login succeeded
+        """
+        self.request("GET /login", "GET", "/login")
+        response = self.request(
+            "POST /login", "POST", "/login", data=dict(username=self.username, password=self.password),
+            allow_redirects=False
+        )
+        return response is not None and response.status_code == 302
+
+    def search(self) -> typing.List[str]:
+        """
+        Searches for cards
+
+        :return: the ids of the cards found
+        """
+        query = self.generator.choice([
+            dict(name="Card {}".format(self.generator.randrange(100))),
+            dict(types=self.generator.choice(["Creature", "Instant", "Land"])),
+            dict(colors=self.generator.sample(["Red", "Green", "White", "Blue", "Black"], 2)),
+            dict(text="draw a card", cmc="1,3"),
+        ])
+        response = self.request("GET /search", "GET", "/search", params=query)
+        return card_ids.findall(response.text) if response is not None else []
+
+    def scroll(self, cards: typing.List[str]) -> None:
+        """
+        Scrolls through search results, fetching the images of the cards displayed
+
+        :param cards: ids of the cards found
+        """
+        for card_id in cards[:self.options.images]:
+            self.request("GET /api/images/<card_id>", "GET", "/api/images/{}".format(card_id))
+
+    def details(self, card_id: str) -> None:
+        """
+        Opens the details and versions of a card
+
+        :param card_id: id of the card
+        """
+        response = self.request("GET /api/cards/<card_id>", "GET", "/api/cards/{}".format(card_id))
+        if response is not None and response.status_code == 200:
+            self.request("GET /card/<name>", "GET", "/card/{}".format(response.json()["name"]))
+
+    def edit_collection(self, card_id: str) -> None:
+        """
+        Changes the number of copies of a card in the collection
+
+        :param card_id: id of the card
+        """
+        self.request(
+            "POST /api/collection/<card_id>", "POST", "/api/collection/{}".format(card_id),
+            data=dict(n_normal=self.generator.randint(0, 4), n_foil=self.generator.randint(0, 1))
+        )
+
+    def edit_deck(self, card_id: str) -> None:
+        """
+        Adds a card to the session's deck, looks at the deck and removes the card
+
+        :param card_id: id of the card
+        """
+        self.request(
+            "POST /api/decks/<name>/<card_id>", "POST", "/api/decks/{}/{}".format(self.deck, card_id),
+            data=dict(n_cards=self.generator.randint(1, 4))
+        )
+        self.request("GET /decks/<name>", "GET", "/decks/{}".format(self.deck))
+        self.request("GET /api/decks/<name>/analytics", "GET", "/api/decks/{}/analytics".format(self.deck))
+        if self.generator.random() < 0.5:
+            self.request("DELETE /api/decks/<name>/<card_id>", "DELETE", "/api/decks/{}/{}".format(self.deck, card_id))
+
+    def run(self, stop: threading.Event) -> None:
+        """
+        Browses the application until asked to stop
+
+        :param stop: event set when the load test ends
+        """
+        if not self.login():
+            return
+        self.request("POST /api/decks/<name>", "POST", "/api/decks/{}".format(self.deck))
+
+        while not stop.is_set():
+            cards = self.search()
+            self.scroll(cards)
+            if cards:
+                card_id = self.generator.choice(cards)
+                self.details(card_id)
+                if self.generator.random() < self.options.edits:
+                    self.edit_collection(card_id)
+                if self.generator.random() < self.options.edits:
+                    self.edit_deck(card_id)
+            stop.wait(self.options.think_time)
+
+
+def subscribe(url: str, statistics: Statistics, stop: threading.Event, timeout: float) -> None:
+    """
+    Stays subscribed to the server sent events until asked to stop, reconnecting when the connection is lost
+
+    :param url: url of the server
+    :param statistics: where to record the connections
+    :param stop: event set when the load test ends
+    :param timeout: time to wait for the server, in seconds
+    """
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            # the server pings every 10 seconds, longer silences mean the connection is lost
+            response = requests.get(url + "/updates", stream=True, timeout=(timeout, 15))
+            statistics.record("SSE /updates", time.perf_counter() - start, response.status_code >= 400)
+            for _ in response.iter_lines():
+                if stop.is_set():
+                    break
+            response.close()
+        except requests.exceptions.RequestException:
+            statistics.record("SSE /updates", time.perf_counter() - start, True)
+
+
+def wait_for(url: str, timeout: float) -> None:
+    """
+    Waits for the server to answer
+
+    :param url: url of the server
+    :param timeout: time after which to give up, in seconds
+    """
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url + "/login", timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            if time.monotonic() > end:
+                raise
+            time.sleep(0.5)
+
+
+def write_config(path: str, **config) -> None:
+    """
+    Writes a configuration file for the server
+
+    :param path: path of the file
+    :param config: values to write
+    """
+    with open(path, "w", encoding="utf-8") as config_file:
+        for key, value in sorted(config.items()):
+            config_file.write("{} = {!r}\n".format(key, value))
+
+
+def load(url: str, options, password: str) -> typing.Dict:
+    """
+    Runs the sessions and subscribers against the server
+
+    :param url: url of the server
+    :param options: parameters of the load test
+    :param password: password of the users
+    :return: the summary of the requests of each endpoint
+    """
+    statistics = Statistics()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=Session(
+            url, "user{}".format(index % options.users), password, statistics, options, options.seed + index
+        ).run, args=(stop,), daemon=True)
+        for index in range(options.sessions)
+    ] + [
+        threading.Thread(target=subscribe, args=(url, statistics, stop, options.timeout), daemon=True)
+        for _ in range(options.subscribers)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(options.duration)
+    stop.set()
+    duration = time.perf_counter() - start
+    for thread in threads:
+        thread.join(options.timeout)
+    return statistics.summary(duration)
+
+
+def print_results(results: typing.Dict) -> None:
+    """
+    Prints the summary of each endpoint
+
+    :param results: summaries of the endpoints
+    """
+    for endpoint, summary in results.items():
+        print("{:>40} : {:8.1f} req/s, p50 {:8.2f}ms, p95 {:8.2f}ms, p99 {:8.2f}ms, {:6.2%} errors".format(
+            endpoint, summary["throughput"], summary["p50_seconds"] * 1000, summary["p95_seconds"] * 1000,
+            summary["p99_seconds"] * 1000, summary["error_rate"]
+        ), file=sys.stderr)
+
+
+def benchmark(options) -> typing.Dict:
+    """
+    Runs the load test
+
+    :param options: parameters of the load test
+    :return: the description of the test and the summary of each endpoint
+    """
+    password = "load-test"
+    stand_in = StandIn(generate_dump(options.scale, options.seed), latency=options.image_latency)
+    stand_in.start()
+    directory = tempfile.mkdtemp(prefix="mtgcollector-load-")
+
+    try:
+        # the server serves its assets and stores downloads in the temporary directory, as in the integration tests
+        for asset in os.listdir(mtgcollector.app.static_folder):
+            shutil.copytree(os.path.join(mtgcollector.app.static_folder, asset), os.path.join(directory, asset))
+
+        app = benchmarks.create_app(
+            options.config, DATABASE_NAME=options.database, RUN_DIRECTORY=os.path.join(directory, "run"),
+            MTGJSON_URL=stand_in.url + "/json", GATHERER_URL=stand_in.url + "/Handlers/Image.ashx",
+            CATALOG_CHECK_INTERVAL=0, PASSWORD_ITERATIONS=options.password_iterations
+        )
+        app.static_folder = directory
+        write_config(os.path.join(directory, "config.cfg"), **{
+            key: value for key, value in app.config.items()
+            if key.startswith(("DATABASE_", "MTGJSON_", "GATHERER_", "CATALOG_", "PASSWORD_"))
+            or key in ("SECRET_KEY", "RUN_DIRECTORY", "USER_CACHE_TTL")
+        })
+
+        with benchmarks.benchmark_database(app):
+            connection = lib.db.get_connection(app)
+            try:
+                populate(
+                    app, connection, options.scale, options.users, options.collection_size, options.seed,
+                    password, options.password_iterations
+                )
+            finally:
+                connection.close()
+
+            # the server has to be stopped before its database is dropped
+            server = LoadServer(directory)
+            server.start()
+            try:
+                url = "http://127.0.0.1:{}".format(DBConnectionMixin.SERVER_PORT)
+                wait_for(url, options.timeout)
+                results = OrderedDict(test=OrderedDict(
+                    sessions=options.sessions, subscribers=options.subscribers, duration=options.duration,
+                    scale=options.scale, users=options.users, image_latency=options.image_latency
+                ))
+                results["endpoints"] = load(url, options, password)
+            finally:
+                server.terminate()
+                server.join()
+        print_results(results["endpoints"])
+        return results
+    finally:
+        stand_in.shutdown()
+        shutil.rmtree(directory)
+
+
+def main() -> None:
+    """ Runs the load test with the given arguments """
+    parser = ArgumentParser("Load test the whole application")
+    parser.add_argument("-c", "--config", type=str, required=True, help="configuration of the server")
+    parser.add_argument("-d", "--database", type=str, default="mtg_benchmark", help="temporary database to use")
+    parser.add_argument("-s", "--scale", type=float, default=1, help="size of the catalog")
+    parser.add_argument("-u", "--users", type=int, default=10, help="number of users the sessions log in as")
+    parser.add_argument("--collection-size", type=int, default=2000, help="number of cards in each collection")
+    parser.add_argument("--sessions", type=int, default=10, help="number of concurrent browsing sessions")
+    parser.add_argument("--subscribers", type=int, default=10, help="number of clients subscribed to events")
+    parser.add_argument("--duration", type=float, default=60, help="duration of the test, in seconds")
+    parser.add_argument("--think-time", type=float, default=0, help="pause between two searches, in seconds")
+    parser.add_argument("--images", type=int, default=12, help="images fetched when scrolling through results")
+    parser.add_argument("--edits", type=float, default=0.3, help="probability to edit the collection and a deck")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="latency of the stand-in's images")
+    parser.add_argument(
+        "--password-iterations", type=int, default=1000000, help="PBKDF2 iterations of the users' passwords"
+    )
+    parser.add_argument("--timeout", type=float, default=30, help="time to wait for each answer, in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices")
+    parser.add_argument("-o", "--output", type=str, help="file in which to write the results")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare with")
+    arguments = parser.parse_args()
+
+    benchmarks.report("load", benchmark(arguments), arguments.output, arguments.compare)
+
+
+if __name__ == "__main__":
+    main()
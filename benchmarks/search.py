@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the card search : replays a weighted mix of searches, as given by the search form, against a synthetic
+catalog and collections, and reports the latency percentiles and the number of database queries of each search.
+
+Searches go either directly through Metacard.get_ids_where or through the whole /search view. A temporary database is
+created and dropped on the configured MySQL or MariaDB server, or in a temporary directory with the sqlite backend :
+
+    $ python3 -m benchmarks.search --config config.cfg --scale 1 --users 20 --collection-size 2000 --through model view
+"""
+
+import bisect
+import copy
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import flask
+import typing
+
+import benchmarks
+import lib.db
+from lib.db.instrumentation import QueryStats
+from lib.models import Metacard
+from tests.catalog import populate
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+default_mix = os.path.join(os.path.dirname(__file__), "search_queries.json")
+server_timing_queries = re.compile(r"(\d+) queries")
+
+Search = typing.Dict[str, typing.Any]
+
+
+def load_mix(path: str) -> typing.List[Search]:
+    """
+    Loads a mix of searches. Each search has a name, a weight giving how often it is done, the values of the search
+    form and whether the user has to be logged in
+
+    :param path: path to the json file describing the mix
+    :return: the searches of the mix
+    """
+    with open(path, encoding="utf-8") as mix_file:
+        return json.load(mix_file)
+
+
+def search_model(app: flask.Flask, connection, search: Search, user_id: int) -> typing.Tuple[float, int]:
+    """
+    Runs a search through Metacard.get_ids_where
+
+    :param app: application configured with the database
+    :param connection: connection to the database
+    :param search: search to run
+    :param user_id: user doing the search, used if the search needs one
+    :return: time taken by the search and number of queries it did
+    """
+    with app.app_context():
+        flask.g.db = connection
+        stats = flask.g.query_stats = QueryStats()
+        start = time.perf_counter()
+        # get_ids_where modifies the lists it is given
+        Metacard.get_ids_where(
+            user_id=user_id if search.get("authenticated") else None, **copy.deepcopy(search["query"])
+        )
+        return time.perf_counter() - start, stats.count
+
+
+class ViewClient:
+    """
+    Runs searches through the /search view, as a browser would
+
+    :param app: application configured with the database
+    """
+    def __init__(self, app: flask.Flask):
+        import mtgcollector  # the view needs the whole application
+
+        mtgcollector.app.config.update(app.config)
+        mtgcollector.csrf.init_app(mtgcollector.app)
+        mtgcollector.login_manager.init_app(mtgcollector.app)
+        self.app = mtgcollector.app
+        self.clients = {}  # type: typing.Dict[typing.Union[int, None], typing.Any]
+
+    def client(self, user_id: typing.Union[int, None]):
+        """
+        Gets a client logged in as the given user
+
+        :param user_id: id of the user, None for an anonymous client
+        :return: the test client
+        """
+        if user_id not in self.clients:
+            client = self.clients[user_id] = self.app.test_client()
+            if user_id is not None:
+                with client.session_transaction() as session:
+                    session["user_id"] = str(user_id)
+                    session["_fresh"] = True
+        return self.clients[user_id]
+
+    def search(self, search: Search, user_id: int) -> typing.Tuple[float, int]:
+        """
+        Runs a search through the /search view
+
+        :param search: search to run
+        :param user_id: user doing the search, used if the search needs one
+        :return: time taken by the search and number of queries it did
+        """
+        arguments = {key: "y" if value is True else value for key, value in search["query"].items()}
+        client = self.client(user_id if search.get("authenticated") else None)
+        start = time.perf_counter()
+        response = client.get("/search", query_string=arguments)
+        duration = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError("Search {} failed with status {}".format(search["name"], response.status_code))
+        queries = server_timing_queries.search(response.headers.get("Server-Timing", ""))
+        return duration, int(queries.group(1)) if queries else 0
+
+
+def replay(run: typing.Callable[[Search, int], typing.Tuple[float, int]], mix: typing.List[Search],
+           user_ids: typing.List[int], count: int, warmup: int, seed: int=0) -> typing.Dict:
+    """
+    Replays searches drawn from the mix according to their weights
+
+    :param run: function running a search for a user, and returning its duration and number of queries
+    :param mix: searches to draw from
+    :param user_ids: users doing the searches
+    :param count: number of searches to measure
+    :param warmup: number of searches to run before measuring, to fill the database's caches
+    :param seed: seed of the random choices
+    :return: the summary of all searches and of each search of the mix
+    """
+    generator = random.Random(seed)
+    weights = list(itertools.accumulate(search["weight"] for search in mix))
+    searches = [mix[bisect.bisect(weights, generator.random() * weights[-1])] for _ in range(warmup + count)]
+    latencies = OrderedDict((search["name"], []) for search in mix)
+    queries = OrderedDict((search["name"], []) for search in mix)
+
+    for index, search in enumerate(searches):
+        duration, query_count = run(search, generator.choice(user_ids))
+        if index >= warmup:
+            latencies[search["name"]].append(duration)
+            queries[search["name"]].append(query_count)
+
+    results = OrderedDict(all=benchmarks.summarize(
+        [value for values in latencies.values() for value in values],
+        [value for values in queries.values() for value in values]
+    ))
+    for name in latencies:
+        if latencies[name]:
+            results[name] = benchmarks.summarize(latencies[name], queries[name])
+    return results
+
+
+def print_results(through: str, results: typing.Dict) -> None:
+    """
+    Prints the summary of each search
+
+    :param through: how the searches were run
+    :param results: summaries of the searches
+    """
+    print("Through {}".format(through), file=sys.stderr)
+    for name, summary in results.items():
+        print("{:>30} : {:5} searches, p50 {:8.2f}ms, p95 {:8.2f}ms, p99 {:8.2f}ms, {:.1f} queries".format(
+            name, summary["count"], summary["p50_seconds"] * 1000, summary["p95_seconds"] * 1000,
+            summary["p99_seconds"] * 1000, summary.get("mean_queries", 0)
+        ), file=sys.stderr)
+
+
+def benchmark(config: str, database_name: str="mtg_benchmark", scale: float=1, users: int=10,
+              collection_size: int=2000, mix_path: str=default_mix, through: typing.Iterable[str]=("model",),
+              count: int=1000, warmup: int=50, seed: int=0) -> typing.Dict:
+    """
+    Runs the benchmark
+
+    :param config: configuration file of the server giving access to the database
+    :param database_name: name of the temporary database to create
+    :param scale: size of the catalog, as a multiple of the real one
+    :param users: number of users to create
+    :param collection_size: number of different cards in each user's collection
+    :param mix_path: path to the json file describing the searches to run
+    :param through: how to run the searches, "model" to call Metacard.get_ids_where or "view" to use /search
+    :param count: number of searches to measure
+    :param warmup: number of searches to run before measuring
+    :param seed: seed of the random choices
+    :return: the description of the data and the summaries of the searches, for each way of running them
+    """
+    directory = tempfile.mkdtemp(prefix="mtgcollector-benchmark-")
+    app = benchmarks.create_app(config, DATABASE_NAME=database_name, RUN_DIRECTORY=os.path.join(directory, "run"))
+    app.static_folder = os.path.join(directory, "static")
+    mix = load_mix(mix_path)
+    results = OrderedDict(data=OrderedDict(
+        scale=scale, users=users, collection_size=collection_size, mix=os.path.basename(mix_path)
+    ))
+
+    try:
+        with benchmarks.benchmark_database(app):
+            connection = lib.db.get_connection(app)
+            try:
+                user_ids = populate(app, connection, scale, users, collection_size, seed)
+                for way in through:
+                    if way == "model":
+                        def run(search, user_id):
+                            return search_model(app, connection, search, user_id)
+                    else:
+                        run = ViewClient(app).search
+                    results[way] = replay(run, mix, user_ids, count, warmup, seed)
+                    print_results(way, results[way])
+            finally:
+                connection.close()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main() -> None:
+    """ Runs the benchmark with the given arguments """
+    parser = ArgumentParser("Benchmark the card search")
+    parser.add_argument("-c", "--config", type=str, required=True, help="configuration of the server")
+    parser.add_argument("-d", "--database", type=str, default="mtg_benchmark", help="temporary database to use")
+    parser.add_argument("-s", "--scale", type=float, default=1, help="size of the catalog")
+    parser.add_argument("-u", "--users", type=int, default=10, help="number of users")
+    parser.add_argument("--collection-size", type=int, default=2000, help="number of cards in each collection")
+    parser.add_argument("--mix", type=str, default=default_mix, help="json file describing the searches to run")
+    parser.add_argument(
+        "-t", "--through", type=str, nargs="+", choices=["model", "view"], default=["model"],
+        help="run the searches through Metacard.get_ids_where, the /search view or both"
+    )
+    parser.add_argument("-n", "--count", type=int, default=1000, help="number of searches to measure")
+    parser.add_argument("-w", "--warmup", type=int, default=50, help="number of searches to run before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices")
+    parser.add_argument("-o", "--output", type=str, help="file in which to write the results")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare with")
+    arguments = parser.parse_args()
+
+    results = benchmark(
+        arguments.config, arguments.database, arguments.scale, arguments.users, arguments.collection_size,
+        arguments.mix, arguments.through, arguments.count, arguments.warmup, arguments.seed
+    )
+    benchmarks.report("search", results, arguments.output, arguments.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the catalog update : times, and optionally measures the memory used by, each stage of
+MaintenanceDB.update on synthetic dumps shaped like mtgjson's AllSets-x.json, scaled to multiples of its real size.
+
+Without a configuration, only the stages not touching the database are run. With one, the dump is also inserted in a
+temporary database, created and dropped by the benchmark :
+
+    $ python3 -m benchmarks.update --scales 1 5 20 --config config.cfg --memory
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import flask
+import typing
+
+import benchmarks
+import lib.db
+import lib.models
+from lib.db.maintenance import MaintenanceDB
+from lib.parser import JSonCardParser
+from tests.catalog import generate_dump, write_dump
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+def run(dump_path: str, app: flask.Flask, recorder: benchmarks.Recorder, database: bool) -> None:
+    """
+    Runs each stage of an update of the given dump
+
+    :param dump_path: path of the zipped dump
+    :param app: application to use, with its static folder and run directory in a temporary directory
+    :param recorder: recorder measuring the stages
+    :param database: whether to run the stages inserting in the database
+    """
+    parser = JSonCardParser(app)
+
+    with recorder.stage("unzip"):
+        with zipfile.ZipFile(dump_path) as archive:
+            with open(os.path.join(parser.download_directory, "cards-1.0.0.json"), "wb") as dump_file:
+                dump_file.write(archive.read(archive.namelist()[0]))
+    with recorder.stage("json load"):
+        parser.load_file()
+    with recorder.stage("parse"):
+        parser.parse()
+
+    if not database:
+        return
+
+    with benchmarks.benchmark_database(app):
+        connection = lib.db.get_connection(app)
+        try:
+            for model, entities in MaintenanceDB.insertions(parser):
+                with recorder.stage("insert {}".format(model.__name__)):
+                    model.bulk_insert(entities, connection=connection)
+            with recorder.stage("legality matrix"):
+                lib.models.FormatLegality.build(app, connection)
+        finally:
+            connection.close()
+
+
+def benchmark(scales: typing.Iterable[float], config: str=None, database_name: str="mtg_benchmark",
+              memory: bool=False, seed: int=0) -> typing.Dict:
+    """
+    Runs the benchmark at each scale
+
+    :param scales: sizes of the dumps to use, as multiples of the real one
+    :param config: configuration file of the server giving access to the database, None to skip the database
+    :param database_name: name of the temporary database to create
+    :param memory: whether to measure the memory used by each stage
+    :param seed: seed of the synthetic dumps
+    :return: the results at each scale
+    """
+    results = OrderedDict()
+    for scale in scales:
+        directory = tempfile.mkdtemp(prefix="mtgcollector-benchmark-")
+        try:
+            app = benchmarks.create_app(config, DATABASE_NAME=database_name) if config else flask.Flask("benchmark")
+            app.static_folder = os.path.join(directory, "static")
+            app.config["RUN_DIRECTORY"] = os.path.join(directory, "run")
+
+            dump = generate_dump(scale, seed)
+            dump_path = os.path.join(directory, "AllSets-x.json.zip")
+            write_dump(dump, dump_path)
+            recorder = benchmarks.Recorder(memory)
+            print("Scale {:g}x".format(scale), file=sys.stderr)
+            run(dump_path, app, recorder, config is not None)
+
+            results["{:g}x".format(scale)] = OrderedDict([
+                ("editions", len(dump)),
+                ("cards", sum(len(edition["cards"]) for edition in dump.values())),
+                ("dump_bytes", os.path.getsize(dump_path)),
+                ("stages", recorder.stages),
+            ])
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def main() -> None:
+    """ Runs the benchmark with the given arguments """
+    parser = ArgumentParser("Benchmark the stages of the catalog update")
+    parser.add_argument("-s", "--scales", type=float, nargs="+", default=[1, 5, 20], help="sizes of the dumps")
+    parser.add_argument("-c", "--config", type=str, help="configuration of the server, to benchmark insertions")
+    parser.add_argument("-d", "--database", type=str, default="mtg_benchmark", help="temporary database to use")
+    parser.add_argument("-m", "--memory", action="store_true", help="measure the memory used by each stage")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic dumps")
+    parser.add_argument("-o", "--output", type=str, help="file in which to write the results")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare with")
+    arguments = parser.parse_args()
+
+    results = benchmark(arguments.scales, arguments.config, arguments.database, arguments.memory, arguments.seed)
+    benchmarks.report("update", results, arguments.output, arguments.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,23 @@
 Utilities for mtgcollector's application
 """
 
+import importlib
 import inspect
+import os
+import sys
+import tempfile
+import time
+
+import typing
 
 
 __author__ = "Benjamin Schubert, <ben.c.schubert@gmail.com>"
 
 
+# reports of import_logged, kept until the application logs them once its logging is configured
+import_reports = []  # type: typing.List[str]
+
+
 def get_subclasses(base_class: callable) -> list:
     """
     Gets all non abstract subclasses for a given base class
@@ -26,3 +37,47 @@ def get_subclasses(base_class: callable) -> list:
         all_subclasses.extend(get_subclasses(subclass))
 
     return all_subclasses
+
+
+def get_run_directory(app) -> str:
+    """
+    Gets the directory in which runtime files shared between processes are stored, creating it if needed
+
+    :param app: flask application from which to take the configuration
+    :return: path to the runtime directory
+    """
+    directory = app.config.get("RUN_DIRECTORY", app.instance_path)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def write_atomically(path: str, content: str) -> None:
+    """
+    Writes the given content to the file, replacing it at once so that readers never see a partial file
+
+    :param path: path of the file to write
+    :param content: text to write in the file
+    """
+    temp_fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path), dir=os.path.dirname(path))
+    with os.fdopen(temp_fd, "w", encoding="utf-8") as temp_file:
+        temp_file.write(content)
+    os.replace(temp_path, path)
+
+
+def import_logged(name: str):
+    """
+    Imports a module, reporting how long it took and how many modules it loaded. Entry points import the application
+    with it, `python3 -X importtime` giving the details.
+
+    The import happens before logging is configured, the report is therefore only kept in `import_reports`, for the
+    application to log it once configured
+
+    :param name: name of the module to import
+    :return: the module
+    """
+    started, modules_before = time.perf_counter(), len(sys.modules)
+    module = importlib.import_module(name)
+    import_reports.append("{} imported in {:.0f}ms, loading {} modules".format(
+        name, (time.perf_counter() - started) * 1000, len(sys.modules) - modules_before
+    ))
+    return module
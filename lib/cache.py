@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+In-memory caches
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import typing
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+class TTLCache:
+    """
+    Thread safe cache, keeping at most max_size values, each for at most ttl seconds. When full, the least recently
+    used value is dropped.
+
+    :param max_size: maximum number of values to keep
+    :param ttl: number of seconds a value stays valid
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__values = OrderedDict()  # type: typing.Dict[typing.Hashable, typing.Tuple[float, typing.Any]]
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable, default: typing.Any=None) -> typing.Any:
+        """
+        Gets the value stored for the key
+
+        :param key: key of the value
+        :param default: value to return if the key is not in the cache or has expired
+        :return: the cached value
+        """
+        with self.__lock:
+            try:
+                expiration, value = self.__values[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expiration < time.monotonic():
+                del self.__values[key]
+                self.misses += 1
+                return default
+
+            self.__values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        """
+        Stores the value for the given key
+
+        :param key: key of the value
+        :param value: value to store
+        """
+        with self.__lock:
+            self.__values[key] = (time.monotonic() + self.ttl, value)
+            self.__values.move_to_end(key)
+            while len(self.__values) > self.max_size:
+                self.__values.popitem(last=False)
+
+    def invalidate(self, key: typing.Hashable) -> None:
+        """
+        Removes the value stored for the key, if any
+
+        :param key: key of the value to remove
+        """
+        with self.__lock:
+            self.__values.pop(key, None)
+
+    def clear(self) -> None:
+        """ Removes all values """
+        with self.__lock:
+            self.__values.clear()
+
+    def __len__(self) -> int:
+        return len(self.__values)
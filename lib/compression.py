@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Compression of the responses.
+
+Responses of a compressible content type are compressed with the best encoding the client accepts : brotli when the
+brotli module is installed, and gzip. Streamed responses are compressed as they are sent.
+
+Pages are compressed although they carry the CSRF token : the token is masked differently in each of them, see
+lib.csrf, so that it cannot be guessed from the size of the compressed pages (BREACH).
+
+Static files are not compressed on the fly. Their compressed versions are written next to them beforehand, and sent
+instead of the original files to the clients accepting them :
+
+    $ python3 -m lib.compression static
+"""
+
+import mimetypes
+import os
+import shutil
+import tempfile
+import zlib
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import flask
+import typing
+import werkzeug.wrappers
+import werkzeug.wsgi
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are then only compressed with gzip
+    brotli = None
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+compressible_types = [
+    "text/html", "text/css", "text/plain", "text/csv", "text/xml", "text/javascript", "application/javascript",
+    "application/json", "application/xml", "image/svg+xml", "application/vnd.ms-fontobject", "application/x-font-ttf"
+]
+compressible_extensions = (".html", ".css", ".js", ".json", ".map", ".txt", ".xml", ".svg", ".eot", ".ttf", ".otf")
+
+# suffix of the precompressed static files, by encoding, in order of preference
+suffixes = OrderedDict([("br", ".br"), ("gzip", ".gz")])
+encodings = [encoding for encoding in suffixes if encoding != "br" or brotli is not None]
+
+# levels used on the fly favor speed, static files are compressed once so they use the best compression
+default_levels = {"br": 4, "gzip": 6}
+best_levels = {"br": 11, "gzip": 9}
+default_min_size = 1024
+
+
+def compressor(encoding: str, level: int) -> typing.Tuple[typing.Callable[[bytes], bytes], typing.Callable[[], bytes]]:
+    """
+    Creates an incremental compressor
+
+    :param encoding: encoding to use, one of `encodings`
+    :param level: compression level
+    :return: a function compressing a chunk of data, and a function giving back the data still buffered at the end
+    """
+    if encoding == "br":
+        compressor_ = brotli.Compressor(quality=level)
+        return compressor_.process, compressor_.finish
+    compressor_ = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor_.compress, compressor_.flush
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compresses the given data
+
+    :param data: data to compress
+    :param encoding: encoding to use, one of `encodings`
+    :param level: compression level
+    :return: the compressed data
+    """
+    compress_, flush = compressor(encoding, level)
+    return compress_(data) + flush()
+
+
+def compress_stream(chunks: typing.Iterable[bytes], encoding: str, level: int) -> typing.Iterator[bytes]:
+    """
+    Compresses the given chunks as they come
+
+    :param chunks: data to compress
+    :param encoding: encoding to use, one of `encodings`
+    :param level: compression level
+    :return: iterator over the compressed data
+    """
+    compress_, flush = compressor(encoding, level)
+    for chunk in chunks:
+        data = compress_(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def is_up_to_date(path: str, source: str) -> bool:
+    """
+    Checks whether a file exists and is more recent than the file it was created from
+
+    :param path: path of the file to check
+    :param source: path of the file it was created from
+    :return: whether the file is up to date
+    """
+    try:
+        return os.stat(path).st_mtime >= os.stat(source).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def precompress(directory: str, min_size: int=default_min_size) -> typing.List[str]:
+    """
+    Writes compressed versions of the compressible files of the directory next to them, with every encoding available.
+    Compressed versions already up to date are kept, and the ones that would not be smaller are not written
+
+    :param directory: directory containing the static files
+    :param min_size: size under which files are not compressed
+    :return: paths of the files written
+    """
+    written = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith(compressible_extensions) or os.path.getsize(path) < min_size:
+                continue
+
+            with open(path, "rb") as source:
+                data = source.read()
+            for encoding in encodings:
+                target = path + suffixes[encoding]
+                if is_up_to_date(target, path):
+                    continue
+
+                compressed = compress(data, encoding, best_levels[encoding])
+                if len(compressed) >= len(data):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+
+                temp_fd, temp_path = tempfile.mkstemp(prefix=name, dir=root)
+                with os.fdopen(temp_fd, "wb") as temp_file:
+                    temp_file.write(compressed)
+                shutil.copymode(path, temp_path)  # readable by the same users as the original
+                os.replace(temp_path, target)
+                written.append(target)
+    return written
+
+
+class ResponseCompressor:
+    """
+    Compresses responses and sends the precompressed versions of static files
+
+    The configuration can disable compression with COMPRESSION_ENABLED, and change COMPRESSION_MIN_SIZE, the size under
+    which responses are sent as they are, COMPRESSION_TYPES, the content types to compress, and COMPRESSION_LEVELS, the
+    level to use for each encoding.
+
+    :param app: flask application on which to register the compression hooks
+    """
+    def __init__(self, app: flask.Flask):
+        app.compressor = self
+        self.app = app
+        self.enabled = app.config.get("COMPRESSION_ENABLED", True)
+        self.min_size = app.config.get("COMPRESSION_MIN_SIZE", default_min_size)
+        self.types = set(app.config.get("COMPRESSION_TYPES", compressible_types))
+        self.levels = dict(default_levels, **app.config.get("COMPRESSION_LEVELS", {}))
+
+        if self.enabled:
+            app.after_request(self.compress)
+            app.view_functions["static"] = self.send_static_file
+
+    def compress(self, response: werkzeug.wrappers.Response) -> werkzeug.wrappers.Response:
+        """
+        Compresses the response if it is worth it and the client accepts it
+
+        :param response: response to send
+        :return: the response, compressed if possible
+        """
+        if response.mimetype not in self.types or response.direct_passthrough \
+                or "Content-Encoding" in response.headers or response.status_code not in (200, 201, 202, 203):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = flask.request.accept_encodings.best_match(encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            # the original stream still has to be closed, to release what it holds once the response is sent
+            original = response.response
+            response.response = werkzeug.wsgi.ClosingIterator(
+                compress_stream(response.iter_encoded(), encoding, self.levels[encoding]),
+                [original.close] if hasattr(original, "close") else []
+            )
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(compress(data, encoding, self.levels[encoding]))
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag("{}-{}".format(etag, encoding), weak)
+        return response
+
+    def send_static_file(self, filename: str) -> werkzeug.wrappers.Response:
+        """
+        Sends a static file, or its precompressed version if there is an up to date one that the client accepts
+
+        :param filename: path of the file, relative to the static folder
+        :return: the response with the file
+        """
+        if not filename.endswith(compressible_extensions):
+            return self.app.send_static_file(filename)
+
+        path = flask.safe_join(self.app.static_folder, filename)
+        encoding = flask.request.accept_encodings.best_match([
+            encoding for encoding, suffix in suffixes.items() if is_up_to_date(path + suffix, path)
+        ])
+        if encoding is None:
+            response = self.app.send_static_file(filename)
+        else:
+            response = flask.send_from_directory(
+                self.app.static_folder, filename + suffixes[encoding],
+                mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            )
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+def main() -> None:
+    """ Writes the compressed versions of the static files """
+    parser = ArgumentParser("Precompress static files")
+    parser.add_argument(
+        "directories", type=str, nargs="*", help="directories containing the static files, static/ by default",
+        default=[os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")]
+    )
+    parser.add_argument("--min-size", type=int, default=default_min_size, help="size under which files are skipped")
+    arguments = parser.parse_args()
+
+    for directory in arguments.directories:
+        written = precompress(directory, arguments.min_size)
+        print("{} : {} compressed files written".format(directory, len(written)))
+
+
+if __name__ == "__main__":
+    main()
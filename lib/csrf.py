@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Protection against cross-site request forgery, with tokens masked differently in each response.
+
+Pages are compressed, and a secret compressed alongside text the client controls, such as a search echoed in the page,
+can be guessed one character at a time from the responses' sizes (BREACH). The CSRF token is therefore XORed with a
+new random mask each time it is written in a page, the mask being sent with it. The token itself never appears in the
+pages, and is recovered from the masked value before flask_wtf validates it.
+"""
+
+import base64
+import binascii
+import os
+
+import flask
+import flask_wtf
+import flask_wtf.csrf
+from werkzeug.datastructures import ImmutableMultiDict
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+def mask(token: str) -> str:
+    """
+    Masks the token with a new random value
+
+    :param token: token to mask
+    :return: the mask followed by the masked token, encoded in base64
+    """
+    data = token.encode()
+    pad = os.urandom(len(data))
+    return base64.urlsafe_b64encode(pad + bytes(a ^ b for a, b in zip(pad, data))).decode()
+
+
+def unmask(masked: str) -> str:
+    """
+    Recovers a token masked by `mask`
+
+    :param masked: the masked token
+    :return: the token, or the given value if it was not masked, for the validation to refuse it
+    """
+    try:
+        data = base64.urlsafe_b64decode(masked.encode())
+        pad, data = data[:len(data) // 2], data[len(data) // 2:]
+        if len(pad) != len(data):
+            return masked
+        return bytes(a ^ b for a, b in zip(pad, data)).decode()
+    except (binascii.Error, UnicodeError, ValueError):
+        return masked
+
+
+def generate_masked_csrf() -> str:
+    """ The token of the session, masked for the page being rendered """
+    return mask(flask_wtf.csrf.generate_csrf())
+
+
+# noinspection PyUnresolvedReferences
+class MaskedCsrfProtect(flask_wtf.CsrfProtect):
+    """
+    CSRF protection writing masked tokens in the pages, through the `csrf_token` function of the templates, and
+    unmasking the tokens sent in the forms and the headers before they are validated
+    """
+    def init_app(self, app: flask.Flask) -> None:
+        """
+        Registers the protection on the application
+
+        :param app: application to protect
+        """
+        super().init_app(app)
+        app.jinja_env.globals["csrf_token"] = generate_masked_csrf
+        app.context_processor(lambda: {"csrf_token": generate_masked_csrf})
+        # the tokens have to be unmasked before flask_wtf's hook validates them
+        app.before_request_funcs.setdefault(None, []).insert(0, self.unmask_request)
+
+    @staticmethod
+    def unmask_request() -> None:
+        """ Replaces the masked tokens of the request by the tokens themselves """
+        request = flask.request
+        app = flask.current_app
+        if request.method not in app.config["WTF_CSRF_METHODS"]:
+            return
+
+        field_name = app.config["WTF_CSRF_FIELD_NAME"]
+        if request.form.get(field_name):
+            form = request.form.to_dict(flat=False)
+            form[field_name] = [unmask(token) for token in form[field_name]]
+            request.form = ImmutableMultiDict(form)
+
+        for header_name in app.config["WTF_CSRF_HEADERS"]:
+            key = "HTTP_{}".format(header_name.upper().replace("-", "_"))
+            if request.environ.get(key):
+                request.environ[key] = unmask(request.environ[key])
@@ -4,11 +4,67 @@
 """
 Base setup for the sql backend
 
-For now only supports MySQL but others can be easily implemented
+The backend is chosen with the DATABASE_BACKEND configuration value : "mysql", the default, uses a MySQL or MariaDB
+server, while "sqlite" keeps the whole database in the DATABASE_NAME file, relative to the run directory
 """
 
-from lib.db import sql as sql_commands
+import importlib
+
 
 __author__ = "Benjamin Schubert, <ben.c.schubert@gmail.com>"
 
-get_connection = sql_commands.get_connection
+
+backends = {"mysql": "lib.db.sql", "sqlite": "lib.db.sqlite"}
+
+
+class CommandSet:
+    """
+    Commands of the backend in use. Attributes are looked up in the backend's module each time, so that modules
+    importing the commands follow the configuration. The module, and the database driver with it, is only imported
+    once a command is needed
+
+    :param backend: name of the backend, one of `backends`
+    """
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.module = None
+
+    def __getattr__(self, name: str):
+        if self.module is None:
+            self.module = importlib.import_module(backends[self.backend])
+        return getattr(self.module, name)
+
+
+commands = CommandSet("mysql")
+
+
+def use(backend: str) -> None:
+    """
+    Selects the backend to use
+
+    :param backend: name of the backend, one of `backends`
+    """
+    if backend not in backends:
+        raise ValueError("Unknown database backend {}, use one of {}".format(backend, ", ".join(sorted(backends))))
+    if backend != commands.backend:
+        commands.backend = backend
+        commands.module = None
+
+
+def configure(app) -> None:
+    """
+    Selects the backend given in the application's configuration
+
+    :param app: Flask app containing the configuration
+    """
+    use(app.config.get("DATABASE_BACKEND", "mysql"))
+
+
+def get_connection(app):
+    """
+    returns a connection to the database of the backend in use
+
+    :param app: Flask app containing the configuration
+    :return: connection to the database
+    """
+    return commands.get_connection(app)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Index advisor : explains every query of lib.db.sql with representative parameters and flags full table scans.
+
+Run it against a configured database with `python3 -m lib.db.advisor`. It exits with an error code when a query
+scans a whole table, so that it can be used to catch regressions
+"""
+
+import inspect
+import os
+import re
+import sys
+from argparse import ArgumentParser
+
+import flask
+import mysql.connector.errorcode
+import mysql.connector.errors
+import typing
+
+from lib.db import sql
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+parameter = re.compile(r"%\((\w+)\)s")
+
+# values given to the templates of queries built by the models, chosen to exercise the search indexes
+templates = {
+    "selection": (
+        "WHERE card.edition IN (SELECT code FROM edition WHERE block = %(block)s) "
+        "AND metacard.cmc >= %(cmc_min)s AND metacard.cmc <= %(cmc_max)s"
+    ),
+    "having": "",
+    "order": "metacard.name",
+    "maximum": "metacard.cmc",
+}
+
+# values given to the queries' parameters. Parameters not listed get 1
+parameters = {
+    "name": "Forest",
+    "deck_name": "deck",
+    "username": "user",
+    "email": "user@example.com",
+    "edition": "LEA",
+    "block": "Ice Age",
+    "format": "Legacy",
+}
+
+
+def get_statements() -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    Finds all queries of lib.db.sql that can be explained
+
+    :return: iterator over the name of each query's method and the query
+    """
+    for class_name, command_class in inspect.getmembers(sql, inspect.isclass):
+        if command_class.__module__ != sql.__name__:
+            continue
+        methods = inspect.getmembers(command_class, inspect.ismethod)
+        if any(getattr(method, "__isabstractmethod__", False) for _, method in methods):
+            continue
+
+        for method_name, method in methods:
+            try:
+                statement = method()
+            except TypeError:  # needs arguments
+                continue
+            if isinstance(statement, str) and statement.lstrip().upper().startswith("SELECT"):
+                yield "{}.{}".format(class_name, method_name), statement
+
+
+def prepare(statement: str) -> typing.Tuple[str, typing.Dict[str, typing.Any]]:
+    """
+    Fills the templates of a query and gives representative values to its parameters
+
+    :param statement: query to prepare
+    :return: the query and its parameters
+    """
+    if "{" in statement:
+        statement = statement.format(**templates)
+    return statement, {name: parameters.get(name, 1) for name in parameter.findall(statement)}
+
+
+def explain(connection, statement: str) -> typing.List[typing.Dict]:
+    """
+    Finds the full table scans done by a query
+
+    :param connection: connection to the database
+    :param statement: query to explain
+    :return: the rows of EXPLAIN scanning a whole table
+    """
+    statement, kwargs = prepare(statement)
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("EXPLAIN " + statement, kwargs)
+    return [
+        row for row in cursor.fetchall()
+        if row["type"] == "ALL" and row["table"] is not None and not row["table"].startswith("<")
+    ]
+
+
+def advise(app: flask.Flask, output: typing.TextIO=sys.stdout) -> int:
+    """
+    Explains all queries and reports the full table scans
+
+    :param app: flask application configured with the database to use
+    :param output: where to write the report
+    :return: the number of queries doing full table scans
+    """
+    connection = sql.get_connection(app)
+    flagged = 0
+    try:
+        for name, statement in get_statements():
+            try:
+                scans = explain(connection, statement)
+            except mysql.connector.errors.ProgrammingError as exc:
+                if exc.errno != mysql.connector.errorcode.ER_NO_SUCH_TABLE:
+                    raise
+                print("{} : skipped, {}".format(name, exc.msg), file=output)
+                continue
+
+            if scans:
+                flagged += 1
+            for row in scans:
+                print("{} : full scan of {} ({} rows)".format(name, row["table"], row["rows"]), file=output)
+    finally:
+        connection.close()
+    return flagged
+
+
+def main() -> None:
+    """ Runs the advisor against the database of the given configuration """
+    parser = ArgumentParser("Flag the queries of mtgcollector that scan whole tables")
+    parser.add_argument(
+        "-c", "--config", type=str, help="configuration file of the server",
+        default=os.environ.get(
+            "MTG_COLLECTOR_CONFIG", os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "config.cfg")
+        )
+    )
+    arguments = parser.parse_args()
+
+    app = flask.Flask(__name__)
+    app.config.from_pyfile(os.path.abspath(arguments.config))
+    sys.exit(1 if advise(app) else 0)
+
+
+if __name__ == "__main__":
+    main()
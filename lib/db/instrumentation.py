@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the queries sent to the database : number of queries, time spent and rows returned for each request,
+and a log of the slow queries and requests
+"""
+
+import functools
+import logging
+import re
+import time
+from collections import OrderedDict
+
+import flask
+import typing
+
+from lib.metrics import registry
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+string_literal = re.compile(r"'(?:[^'\\]|\\.)*'")
+parameter = re.compile(r"%\(\w+\)s")
+number = re.compile(r"\b\d+(?:\.\d+)?\b")
+value_list = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+whitespace = re.compile(r"\s+")
+
+query_duration = registry.histogram("mtgcollector_db_query_duration_seconds", "Time taken by database queries")
+query_rows = registry.counter("mtgcollector_db_rows_total", "Rows returned or affected by database queries")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """
+    Normalizes a statement, so that all executions of the same query share the same fingerprint whatever their
+    parameters are
+
+    :param statement: statement sent to the database
+    :return: the statement, with its values replaced by ? and lists of values by (?+)
+    """
+    statement = string_literal.sub("?", statement)
+    statement = parameter.sub("?", statement)
+    statement = number.sub("?", statement)
+    statement = value_list.sub("(?+)", statement)
+    return whitespace.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """
+    Statistics of the queries executed while serving a request
+    """
+    slow_query_threshold = 0.5  # seconds after which a single query is logged
+    slow_request_threshold = 1.0  # seconds spent in the database after which a request is logged
+    logger = logging.getLogger("mtgcollector.slow_queries")
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+        self.statements = OrderedDict()  # type: typing.Dict[str, typing.List]
+
+    @classmethod
+    def configure(cls, slow_query_threshold: float, slow_request_threshold: float) -> None:
+        """
+        Configures when queries and requests are logged as slow
+
+        :param slow_query_threshold: time after which a single query is logged, in seconds
+        :param slow_request_threshold: time spent in the database after which a request is logged, in seconds
+        """
+        cls.slow_query_threshold = slow_query_threshold
+        cls.slow_request_threshold = slow_request_threshold
+
+    @classmethod
+    def current(cls) -> typing.Union["QueryStats", None]:
+        """ The statistics of the request being served, if any """
+        if flask.has_app_context():
+            return getattr(flask.g, "query_stats", None)
+        return None
+
+    @classmethod
+    def record(cls, statement: str, duration: float, rows: int) -> None:
+        """
+        Records the execution of a statement in the current request's statistics and logs it if it was slow
+
+        :param statement: statement sent to the database
+        :param duration: time taken by the statement, in seconds
+        :param rows: number of rows returned or affected
+        """
+        key = fingerprint(statement)
+        query_duration.observe(duration)
+        query_rows.inc(max(rows, 0))
+        if duration >= cls.slow_query_threshold:
+            cls.logger.warning("Slow query ({:.3f}s, {} rows) : {}".format(duration, rows, key))
+
+        stats = cls.current()
+        if stats is None:
+            return
+        stats.count += 1
+        stats.time += duration
+        stats.rows += max(rows, 0)
+        totals = stats.statements.setdefault(key, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += max(rows, 0)
+
+    def server_timing(self) -> str:
+        """ The statistics as a Server-Timing header value """
+        return 'db;dur={:.1f};desc="{} queries, {} rows"'.format(self.time * 1000, self.count, self.rows)
+
+    def log_if_slow(self, request: str) -> None:
+        """
+        Logs the statistics if the request spent too much time in the database
+
+        :param request: description of the request
+        """
+        if self.time < self.slow_request_threshold:
+            return
+        slowest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:5]
+        self.logger.warning("Slow request {} : {} queries, {:.3f}s, {} rows{}".format(
+            request, self.count, self.time, self.rows, "".join(
+                "\n\t{} x {:.3f}s, {} rows : {}".format(count, time, rows, key)
+                for key, (count, time, rows) in slowest
+            )
+        ))
+
+
+class TimedCursor:
+    """
+    Cursor timing the statements it runs, from their execution to the last row fetched. The time the caller spends
+    between two fetches does not count. Each statement is recorded in the query statistics once all its rows are read,
+    or right after its execution when it returns no rows
+
+    :param cursor: database cursor to wrap
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statement = None  # type: str
+        self.duration = 0.0
+        self.rows = 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.cursor, name)
+
+    def __timed(self, method: typing.Callable, *args) -> typing.Any:
+        """
+        calls a method of the cursor, adding the time it took to the statement's
+
+        :param method: method to call
+        :param args: arguments of the method
+        :return: the method's result
+        """
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.duration += time.perf_counter() - start
+
+    def __start(self, statement: str) -> None:
+        """
+        starts timing a new statement
+
+        :param statement: statement about to be run
+        """
+        self.statement = statement
+        self.duration = 0.0
+        self.rows = 0
+
+    def __record(self, rows: int) -> None:
+        """
+        records the statement in the statistics
+
+        :param rows: number of rows returned or affected
+        """
+        QueryStats.record(self.statement, self.duration, rows)
+
+    def execute(self, statement: str, parameters: typing.Dict=None) -> None:
+        """
+        executes a statement
+
+        :param statement: statement to execute
+        :param parameters: parameters of the statement
+        """
+        self.__start(statement)
+        self.__timed(self.cursor.execute, statement, parameters or {})
+        if self.cursor.description is None:
+            self.__record(self.cursor.rowcount)
+
+    def executemany(self, statement: str, parameters: typing.List[typing.Dict]) -> None:
+        """
+        executes a statement once for each set of parameters
+
+        :param statement: statement to execute
+        :param parameters: parameters of each execution
+        """
+        self.__start(statement)
+        self.__timed(self.cursor.executemany, statement, parameters)
+        self.__record(len(parameters))
+
+    def fetchall(self) -> typing.List:
+        """ fetches all the remaining rows """
+        rows = self.__timed(self.cursor.fetchall)
+        self.rows += len(rows)
+        self.__record(self.rows)
+        return rows
+
+    def fetchmany(self, size: int) -> typing.List:
+        """
+        fetches the next rows, the statement being recorded once there are none left
+
+        :param size: maximum number of rows to fetch
+        """
+        rows = self.__timed(self.cursor.fetchmany, size)
+        self.rows += len(rows)
+        if not rows:
+            self.__record(self.rows)
+        return rows
@@ -5,22 +5,234 @@
 Database Maintenance utilities
 """
 
+import contextlib
 import datetime
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
 
 import flask
-import mysql.connector
-import mysql.connector.errorcode
-import mysql.connector.errors
+import typing
 
 import lib
 import lib.db
+import lib.metrics
 import lib.models
+from lib.db import commands as sql
+from lib.exceptions import UpdateCancelledException
 from lib.parser import JSonCardParser
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
 
 
+class UpdateJob:
+    """
+    A database update, keeping track of its progress and of the time spent in each of its phases.
+
+    The status is written to the run directory for every process to read, and the job can be cancelled from any of
+    them between two batches of insertion.
+
+    :param app: flask application running the update
+    :param stopped: event set when the process running the update stops, which cancels the job too
+    """
+    def __init__(self, app: flask.Flask, stopped: threading.Event=None):
+        self.app = app
+        self.stopped = stopped
+        self.state = "running"
+        self.phase_name = None  # type: str
+        self.progress = 0.0
+        self.timings = OrderedDict()  # type: typing.Dict[str, float]
+        self.rows = OrderedDict()  # type: typing.Dict[str, int]
+        self.started = datetime.datetime.now()
+        self.finished = None  # type: datetime.datetime
+        self.__done = 0.0
+        self.__weight = 0.0
+        self.__last_published = time.monotonic()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.cancel_path(app))
+
+    @staticmethod
+    def status_path(app: flask.Flask) -> str:
+        """ path to the file containing the status of the last update """
+        return os.path.join(lib.get_run_directory(app), "update-status.json")
+
+    @staticmethod
+    def cancel_path(app: flask.Flask) -> str:
+        """ path to the file asking the running update to stop """
+        return os.path.join(lib.get_run_directory(app), "update-cancel")
+
+    @classmethod
+    def status(cls, app: flask.Flask) -> typing.Union[typing.Dict, None]:
+        """
+        Gets the status of the running or last update. An update whose process died while running it is failed
+
+        :param app: flask application
+        :return: the status as written by the job, or None if no update ever ran
+        """
+        try:
+            with open(cls.status_path(app), encoding="utf-8") as status_file:
+                status = json.load(status_file)
+        except FileNotFoundError:
+            return None
+
+        if status["state"] == "running" and status.get("pid") is not None:
+            try:
+                os.kill(status["pid"], 0)
+            except ProcessLookupError:
+                status["state"] = "failed"
+            except PermissionError:  # the process exists but belongs to another user
+                pass
+        return status
+
+    @classmethod
+    def cancel(cls, app: flask.Flask) -> None:
+        """
+        Asks the running update to stop
+
+        :param app: flask application
+        """
+        open(cls.cancel_path(app), "a").close()
+
+    def notify(self, message: str) -> None:
+        """
+        Sends the given message to all clients
+
+        :param message: message to send
+        """
+        self.app.notifier.set_value(message)
+        self.app.notifier.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, weight: float):
+        """
+        Context manager timing a phase of the update
+
+        :param name: name of the phase
+        :param weight: share of the total update this phase represents, in percent
+        """
+        self.check_cancelled()
+        self.phase_name = name
+        self.__weight = weight
+        self.publish()
+        self.notify("Database update : {} ({}%)".format(name, int(self.progress)))
+
+        start = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start
+        self.app.logger.info("Database update : {} took {:.2f}s".format(name, self.timings[name]))
+        self.skip_phase(weight)
+
+    def skip_phase(self, weight: float) -> None:
+        """
+        Marks a phase as done
+
+        :param weight: share of the total update this phase represents, in percent
+        """
+        self.__done += weight
+        self.__weight = 0
+        self.progress = self.__done
+        self.publish()
+
+    def rewind(self, progress: float) -> None:
+        """
+        Goes back to an earlier point of the update, for the phases after it to run again without being counted twice
+
+        :param progress: progress of the update at that point, in percent
+        """
+        self.__done = progress
+        self.__weight = 0
+        self.progress = progress
+        self.publish()
+
+    def advance(self, done: int, total: int) -> None:
+        """
+        Updates the progress inside the current phase and stops the update if it was cancelled
+
+        :param done: number of items already treated in this phase
+        :param total: total number of items in this phase
+        """
+        self.rows[self.phase_name] = total
+        self.progress = self.__done + self.__weight * done / max(total, 1)
+        self.check_cancelled()
+        if time.monotonic() - self.__last_published > 1:
+            self.publish()
+
+    def check_cancelled(self) -> None:
+        """ Raises UpdateCancelledException if an administrator asked to cancel the update or its process stops """
+        if os.path.exists(self.cancel_path(self.app)) or (self.stopped is not None and self.stopped.is_set()):
+            raise UpdateCancelledException()
+
+    def end(self, state: str) -> None:
+        """
+        Ends the job
+
+        :param state: final state of the update (finished, cancelled or failed)
+        """
+        self.state = state
+        self.finished = datetime.datetime.now()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.cancel_path(self.app))
+        self.publish()
+
+    def as_dict(self) -> typing.Dict:
+        """ A dictionary view of the job """
+        return {
+            "state": self.state,
+            "pid": os.getpid(),
+            "phase": self.phase_name,
+            "progress": round(self.progress, 1),
+            "timings": self.timings,
+            "rows": self.rows,
+            "started": self.started.isoformat(),
+            "finished": self.finished.isoformat() if self.finished is not None else None,
+            "duration": (self.finished - self.started).total_seconds() if self.finished is not None else None
+        }
+
+    @classmethod
+    def metrics(cls, app: flask.Flask) -> typing.List[lib.metrics.Metric]:
+        """
+        Metrics describing the running or last update, as written by the process running it
+
+        :param app: flask application
+        :return: the metrics to expose
+        """
+        status = cls.status(app)
+        if status is None:
+            return []
+
+        state = lib.metrics.Gauge("mtgcollector_update_state", "State of the last database update", ["state"])
+        state.set(1, state=status["state"])
+        progress = lib.metrics.Gauge("mtgcollector_update_progress", "Progress of the last database update, in percent")
+        progress.set(status["progress"])
+        phases = lib.metrics.Gauge(
+            "mtgcollector_update_phase_duration_seconds", "Time taken by each phase of the last database update",
+            ["phase"]
+        )
+        for phase, duration in status["timings"].items():
+            phases.set(duration, phase=phase)
+        rows = lib.metrics.Gauge("mtgcollector_update_rows", "Rows inserted by the last database update", ["phase"])
+        for phase, count in status["rows"].items():
+            rows.set(count, phase=phase)
+        metrics = [state, progress, phases, rows]
+
+        if status.get("duration") is not None:
+            duration = lib.metrics.Gauge(
+                "mtgcollector_update_duration_seconds", "Time taken by the last database update"
+            )
+            duration.set(status["duration"])
+            metrics.append(duration)
+        return metrics
+
+    def publish(self) -> None:
+        """ Writes the status of the job for all processes to read """
+        self.__last_published = time.monotonic()
+        lib.write_atomically(self.status_path(self.app), json.dumps(self.as_dict()))
+
+
 class MaintenanceDB:
     """
     Database Maintenance utilities
@@ -44,56 +256,196 @@ class MaintenanceDB:
     def __init__(self, app: flask.Flask):
         self.app = app
 
-    def __update(self, card_parser: JSonCardParser) -> None:
+    def update_lock(self):
+        """
+        Lock held by the process updating the database, shared by every process using the same database.
+
+        The lock is released when its holder dies, so a crashed process cannot block further updates.
+
+        :return: context manager giving whether the lock was acquired or not
+        """
+        return sql.named_lock(self.app, "update")
+
+    @staticmethod
+    def insertions(card_parser: JSonCardParser) -> typing.List[typing.Tuple[typing.Type, typing.Set]]:
+        """
+        The models to insert during an update, in the order in which they have to be inserted
+
+        :param card_parser: jsonCardParser entity containing the values to enter in the database
+        :return: list of the models and of the entities to insert for each of them
+        """
+        return [
+            (lib.models.Edition, card_parser.editions),
+            (lib.models.Format, card_parser.formats),
+            (lib.models.Metacard, card_parser.metacards),
+            (lib.models.Card, card_parser.cards),
+            (lib.models.LegalInFormat, card_parser.legal_in_format)
+        ]
+
+    def __update(self, card_parser: JSonCardParser, job: UpdateJob) -> None:
         """
         Uses the given JSonCardParser to insert all its information into the database
 
         :param card_parser: jsonCardParser entity containing the values to enter in the database
+        :param job: the update job to keep informed of the progress
         """
         with self.DBManager(self.app) as connection:
-            lib.models.Edition.bulk_insert(card_parser.editions, connection=connection)
-            lib.models.Format.bulk_insert(card_parser.formats, connection=connection)
-            lib.models.Metacard.bulk_insert(card_parser.metacards, connection=connection)
-            lib.models.Card.bulk_insert(card_parser.cards, connection=connection)
-            lib.models.LegalInFormat.bulk_insert(card_parser.legal_in_format, connection=connection)
+            for model, entities in self.insertions(card_parser):
+                with job.phase("insert {}".format(model.__name__), 11):
+                    model.bulk_insert(entities, connection=connection, progress=job.advance)
+
+            with job.phase("legality matrix", 5):
+                lib.models.FormatLegality.build(self.app, connection)
 
     def setup_db(self) -> None:
-        """ Configures the database with the models subclassing lib.models.Model """
-        conn = mysql.connector.connect(
-            user=self.app.config["DATABASE_USER"], password=self.app.config["DATABASE_PASSWORD"],
-            host=self.app.config["DATABASE_HOST"], port=self.app.config["DATABASE_PORT"], raise_on_warnings=True
-        )
+        """
+        Configures the database with the models subclassing lib.models.Model.
+
+        Missing tables are created at the latest version of their schema and existing ones are brought to it by
+        applying the models' pending migrations. The legality matrix is built if the catalog was inserted without it
+        """
+        sql.create_database(self.app)
+        with self.DBManager(self.app) as connection:
+            self.__setup_tables(connection)
+            if not lib.models.FormatLegality.is_built(connection):
+                self.app.logger.info("Building the legality matrix")
+                lib.models.FormatLegality.build(self.app, connection)
+
+    def migrate(self) -> None:
+        """
+        Brings a database created by an older version to the current schema.
+
+        The migration runs under the update lock, so that no update runs while tables are altered
+        """
+        with self.update_lock() as acquired:
+            if not acquired:
+                self.app.logger.info("Another process is updating the database, not migrating it")
+                return
+            self.setup_db()
+
+    def __setup_tables(self, connection) -> None:
+        """
+        Creates the missing tables and applies pending migrations to the existing ones
+
+        :param connection: connection to the database
+        """
+        cursor = connection.cursor()
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                    "CREATE DATABASE IF NOT EXISTS {} CHARACTER SET utf8".format(self.app.config["DATABASE_NAME"])
-            )
-            conn.commit()
+            cursor.execute(sql.Migration.create_table())
+        except sql.Error as exc:
+            if not sql.Errors.table_exists(exc):
+                raise
+        cursor.execute(sql.Migration.list_versions())
+        versions = dict(cursor.fetchall())
+
+        for model in sorted(lib.get_subclasses(lib.models.Model), key=lambda x: x.index):
+            migrations = model.migrations()
+            try:
+                model.setup_table(connection=connection)
+            except sql.Error as exc:
+                if not sql.Errors.table_exists(exc):
+                    raise
+                version = versions.get(model.__name__, 0)
+                for number, commands in enumerate(migrations[version:], start=version + 1):
+                    self.app.logger.info("Migrating {} to version {}".format(model.__name__, number))
+                    for command in commands:
+                        self.__execute_migration(cursor, command)
+                    cursor.execute(sql.Migration.set_version(), dict(model=model.__name__, version=number))
+                    connection.commit()
+            else:
+                if migrations:
+                    cursor.execute(sql.Migration.set_version(), dict(model=model.__name__, version=len(migrations)))
+                connection.commit()
+
+    def __execute_migration(self, cursor, command: typing.Union[str, typing.Tuple[str, str]]) -> None:
+        """
+        Executes a command of a migration, running online alterations as regular ones when the server refuses them.
+        Steps given as a query and a command run the command for each row of the query, see sql.Migration.for_each
+
+        :param cursor: cursor on the database
+        :param command: command to execute, or query and command to run for each of its rows
+        """
+        if isinstance(command, tuple):
+            query, command = command
+            cursor.execute(query)
+            for row in cursor.fetchall():
+                self.__execute_migration(cursor, command.format(*row))
+            return
+
+        try:
+            cursor.execute(command)
+        except sql.Error as exc:
+            if not sql.Migration.refused_online(command, exc):
+                raise
+            self.app.logger.warning("Cannot alter the table online, got : {}".format(exc))
+            cursor.execute(sql.Migration.offline(command))
+
+    def update(self, stopped: threading.Event=None) -> None:
+        """
+        Updates the database by checking on the internet for new files before committing them
+
+        Only one process at a time can update the database, others skip the update. As the notifier is shared between
+        processes, all of them still get the updating process' notifications.
+
+        :param stopped: event cancelling the update when set, as the process is stopping
+        """
+        with self.update_lock() as acquired:
+            if not acquired:
+                self.app.logger.info("Another process is already updating the database, skipping")
+                return
+            self.__locked_update(stopped)
+
+    def __locked_update(self, stopped: threading.Event=None) -> None:
+        """
+        Updates the database. The update lock has to be held when calling this
+
+        :param stopped: event cancelling the update when set
+        """
+        job = UpdateJob(self.app, stopped)
+        job.notify("Database update started on {}".format(datetime.datetime.now().strftime("%c")))
+        self.app.logger.info("Starting database update")
+        try:
+            self.__run(job)
+        except UpdateCancelledException:
+            job.end("cancelled")
+            self.app.logger.info("Database update cancelled")
+            job.notify("Database update cancelled on {}".format(datetime.datetime.now().strftime("%c")))
         except:
+            job.end("failed")
             raise
         else:
-            with self.DBManager(self.app) as connection:
-                for model in sorted(lib.get_subclasses(lib.models.Model), key=lambda x: x.index):
-                    model.setup_table(connection=connection)
-        finally:
-            conn.close()
-
-    def update(self) -> None:
-        """ Updates the database by checking on the internet for new files before committing them """
-        self.app.notifier.set_value("Database update started on {}".format(datetime.datetime.now().strftime("%c")))
-        self.app.notifier.clear()
-        self.app.logger.info("Starting database update")
+            job.end("finished")
+            self.app.logger.info("Finished database update")
+            job.notify("Database update finished on {}".format(datetime.datetime.now().strftime("%c")))
+
+    def __run(self, job: UpdateJob) -> None:
+        """
+        Runs all phases of the update
+
+        :param job: the job keeping track of the update
+        """
         card_parser = JSonCardParser(self.app)
-        card_parser.check_update()
+        with job.phase("version check", 5):
+            version = card_parser.get_update_version()
+
+        if version is not None:
+            with job.phase("download", 20):
+                card_parser.download_version(version)
+        else:
+            job.skip_phase(20)
+
+        with job.phase("json load", 5):
+            card_parser.load_file()
+        with job.phase("parse", 10):
+            card_parser.parse()
+
+        progress = job.progress
         try:
-            self.__update(card_parser)
-        except mysql.connector.errors.ProgrammingError as exc:
-            if exc.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
+            self.__update(card_parser, job)
+        except sql.Error as exc:
+            if sql.Errors.unknown_database(exc):
                 self.setup_db()
-                self.__update(card_parser)
+                job.rewind(progress)
+                self.__update(card_parser, job)
             else:
                 raise
-        else:
-            self.app.logger.info("Finished database update")
-            self.app.notifier.set_value("Database update finished on {}".format(datetime.datetime.now().strftime("%c")))
-            self.app.notifier.clear()
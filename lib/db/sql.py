@@ -2,21 +2,43 @@
 # -*- coding: utf-8 -*-
 
 """
-MySQL implementation of the commands needed to run MTGCollector application
+MySQL implementation of the commands needed to run MTGCollector application. The driver is imported on first use,
+the SQLite backend inheriting these commands
 """
 
 import abc
+import contextlib
+import functools
 
-import mysql.connector
-import mysql.connector.conversion
+import typing
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
 
 
-# Patches to make MySQL behave correctly
-mysql.connector.conversion.MySQLConverter._list_to_mysql = lambda self, value: ",".join(value).encode()
-mysql.connector.conversion.MySQLConverter._set_to_mysql = lambda self, value: ",".join(value).encode()
-mysql.connector.conversion.MySQLConverter._bytearray_to_mysql = lambda self, value: bytes(value)
+@functools.lru_cache()
+def driver():
+    """
+    Imports the MySQL driver on first use, as the SQLite backend reuses the commands of this module without needing it
+
+    :return: the mysql.connector module
+    """
+    import mysql.connector
+    import mysql.connector.conversion
+    import mysql.connector.errorcode
+    import mysql.connector.errors
+
+    # Patches to make MySQL behave correctly
+    mysql.connector.conversion.MySQLConverter._list_to_mysql = lambda self, value: ",".join(value).encode()
+    mysql.connector.conversion.MySQLConverter._set_to_mysql = lambda self, value: ",".join(value).encode()
+    mysql.connector.conversion.MySQLConverter._bytearray_to_mysql = lambda self, value: bytes(value)
+    return mysql.connector
+
+
+def __getattr__(name: str):
+    """ Gives `Error`, the base class of the driver's errors, importing the driver only then """
+    if name == "Error":
+        return driver().errors.Error
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
 
 
 def get_connection(app):
@@ -26,13 +48,135 @@ def get_connection(app):
     :param app: Flask app containing the configuration
     :return: MySQL connection to the database
     """
-    return mysql.connector.connect(
+    return driver().connect(
         user=app.config["DATABASE_USER"], password=app.config["DATABASE_PASSWORD"],
         host=app.config["DATABASE_HOST"], database=app.config["DATABASE_NAME"], port=app.config["DATABASE_PORT"],
         raise_on_warnings=True
     )
 
 
+def get_server_connection(app):
+    """
+    returns a connection to the database server, without selecting any database
+
+    :param app: Flask app containing the configuration
+    :return: MySQL connection to the server
+    """
+    return driver().connect(
+        user=app.config["DATABASE_USER"], password=app.config["DATABASE_PASSWORD"],
+        host=app.config["DATABASE_HOST"], port=app.config["DATABASE_PORT"], raise_on_warnings=True
+    )
+
+
+def database_exists(app) -> bool:
+    """
+    checks whether the database already exists on the server
+
+    :param app: Flask app containing the configuration
+    """
+    connection = get_server_connection(app)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SHOW DATABASES LIKE %(name)s", dict(name=app.config["DATABASE_NAME"]))
+        return len(cursor.fetchall()) > 0
+    finally:
+        connection.close()
+
+
+def create_database(app) -> None:
+    """
+    creates the database if it does not exist yet
+
+    :param app: Flask app containing the configuration
+    """
+    connection = get_server_connection(app)
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("CREATE DATABASE IF NOT EXISTS {} CHARACTER SET utf8".format(app.config["DATABASE_NAME"]))
+        except driver().errors.Error as exc:
+            if exc.errno != driver().errorcode.ER_DB_CREATE_EXISTS:
+                raise
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def drop_database(app) -> None:
+    """
+    drops the database and all its tables
+
+    :param app: Flask app containing the configuration
+    """
+    connection = get_server_connection(app)
+    try:
+        connection.cursor().execute("DROP DATABASE IF EXISTS {}".format(app.config["DATABASE_NAME"]))
+    finally:
+        connection.close()
+
+
+@contextlib.contextmanager
+def named_lock(app, name: str):
+    """
+    Lock shared by every process using the same database server. It is released when its connection closes, so a
+    crashed process cannot keep it
+
+    :param app: Flask app containing the configuration
+    :param name: name of the lock, unique for each database
+    :return: whether the lock was acquired or not
+    """
+    name = "mtgcollector.{}.{}".format(app.config["DATABASE_NAME"], name)
+    connection = get_server_connection(app)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(Lock.acquire(), dict(name=name, timeout=0))
+        acquired = cursor.fetchall()[0][0] == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute(Lock.release(), dict(name=name))
+                cursor.fetchall()
+    finally:
+        connection.close()
+
+
+class Errors:
+    """
+    Classification of the MySQL errors from which the application recovers
+    """
+    @classmethod
+    def duplicate_entry(cls, exc: Exception) -> bool:
+        """ whether the error comes from a value already present in a unique column """
+        return isinstance(exc, driver().errors.IntegrityError) \
+            and exc.errno == driver().errorcode.ER_DUP_ENTRY
+
+    @classmethod
+    def table_exists(cls, exc: Exception) -> bool:
+        """ whether the error comes from creating a table that already exists """
+        return isinstance(exc, driver().errors.Error) and exc.errno == driver().errorcode.ER_TABLE_EXISTS_ERROR
+
+    @classmethod
+    def unknown_database(cls, exc: Exception) -> bool:
+        """ whether the error comes from using a database that was not created """
+        return isinstance(exc, driver().errors.Error) and exc.errno == driver().errorcode.ER_BAD_DB_ERROR
+
+
+class Lock:
+    """
+    MySQL commands to handle named locks shared between all connections to the server
+    """
+    @classmethod
+    def acquire(cls) -> str:
+        """ command to acquire the lock %(name)s, waiting at most %(timeout)s seconds. Returns 1 on success """
+        return """ SELECT GET_LOCK(%(name)s, %(timeout)s) """
+
+    @classmethod
+    def release(cls) -> str:
+        """ command to release the lock %(name)s """
+        return """ SELECT RELEASE_LOCK(%(name)s) """
+
+
 class User:
     """
     MySQL commands related to the User model
@@ -47,16 +191,22 @@ class User:
                 email VARCHAR(255) NOT NULL UNIQUE,
                 password BINARY(64) NOT NULL,
                 salt BINARY(255) NOT NULL,
+                iterations INT UNSIGNED NOT NULL DEFAULT 1000000,
                 is_admin BOOLEAN NOT NULL DEFAULT FALSE
             )
         """
 
+    @classmethod
+    def add_iterations(cls) -> str:
+        """ command to add the number of hashing iterations to users, all previous ones having used 1000000 """
+        return """ ALTER TABLE user ADD iterations INT UNSIGNED NOT NULL DEFAULT 1000000 """
+
     @classmethod
     def insert(cls):
         """ command to insert a user in the table"""
         return """
-            INSERT INTO user (username, email, password, salt)
-            VALUES (%(username)s, %(email)s, %(password)s, %(salt)s)
+            INSERT INTO user (username, email, password, salt, iterations)
+            VALUES (%(username)s, %(email)s, %(password)s, %(salt)s, %(iterations)s)
         """
 
     @classmethod
@@ -89,7 +239,8 @@ class User:
         """ updates the user's information """
         return """
             UPDATE user
-            SET username = %(username)s, email = %(email)s, password = %(password)s, salt = %(salt)s
+            SET username = %(username)s, email = %(email)s, password = %(password)s, salt = %(salt)s,
+                iterations = %(iterations)s
             WHERE user_id = %(user_id)s
         """
 
@@ -103,7 +254,8 @@ class Metacard:
         """ table creation command to the Metacard model """
         return """
             CREATE TABLE metacard (
-                name VARCHAR(150) PRIMARY KEY,
+                metacard_id INT PRIMARY KEY AUTO_INCREMENT,
+                name VARCHAR(150) NOT NULL UNIQUE,
                 types SET (
                     'Land', 'Creature', 'Sorcery', 'Instant', 'Artifact', 'Planeswalker', 'Enchantment', 'Tribal',
                     'Scheme', 'Eaturecray', 'Enchant', 'Vanguard', 'Plane', 'Scariest', 'You\\'ll', 'Ever', 'See',
@@ -116,10 +268,19 @@ class Metacard:
                 toughness DECIMAL(3,1),
                 colors SET('Red', 'Green', 'White', 'Blue', 'Black'),
                 cmc DECIMAL(8,1) NOT NULL,
-                orig_text TEXT
+                orig_text TEXT,
+
+                INDEX (cmc),
+                INDEX (power),
+                INDEX (toughness)
             )
         """
 
+    @classmethod
+    def add_range_indexes(cls) -> str:
+        """ command to index the columns searched by range """
+        return """ ALTER TABLE metacard ADD INDEX (cmc), ADD INDEX (power), ADD INDEX (toughness) """
+
     @classmethod
     def insert(cls):
         """ command to insert a metacard """
@@ -141,9 +302,9 @@ class Metacard:
         return """
             SELECT card.card_id
             FROM metacard
-            INNER JOIN card ON card.name = metacard.name
+            INNER JOIN card ON card.metacard_id = metacard.metacard_id
             {selection}
-            GROUP BY metacard.name
+            GROUP BY metacard.metacard_id
             ORDER BY {order}
         """
 
@@ -156,15 +317,25 @@ class Metacard:
                 IFNULL(SUM(collection.foil), 0) AS foil
             FROM metacard
             INNER JOIN card
-                ON card.name = metacard.name
+                ON card.metacard_id = metacard.metacard_id
             LEFT OUTER JOIN (SELECT * FROM card_in_collection WHERE user_id = %(user_id)s) AS collection
                 ON collection.card_id = card.card_id
             {selection}
-            GROUP BY metacard.name
+            GROUP BY metacard.metacard_id
             {having}
             ORDER BY {order}
         """
 
+    @classmethod
+    def has_type(cls) -> str:
+        """ condition on the metacard's types starting with %(types)s """
+        return "metacard.types LIKE %(types)s"
+
+    @classmethod
+    def has_supertype(cls) -> str:
+        """ condition on the metacard's supertypes being %(supertypes)s """
+        return "%(supertypes)s IN (metacard.supertypes)"
+
     @classmethod
     def maximum(cls):
         """ command to get the minimum value for a column """
@@ -182,6 +353,7 @@ class Card:
             CREATE TABLE card (
                 card_id INT PRIMARY KEY AUTO_INCREMENT,
                 multiverseid INT,
+                metacard_id INT NOT NULL,
                 name VARCHAR(150) NOT NULL,
                 edition VARCHAR(8) NOT NULL,
                 rarity SET ('Basic Land', 'Common', 'Uncommon', 'Rare', 'Mythic Rare', 'Special') NOT NULL,
@@ -190,19 +362,28 @@ class Card:
                 flavor TEXT,
                 price DECIMAL(7,2),
 
-                FOREIGN KEY (name) REFERENCES metacard(name) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                FOREIGN KEY (metacard_id) REFERENCES metacard(metacard_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
                 FOREIGN KEY (edition) REFERENCES edition(code) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                INDEX (name),
+                INDEX (edition, rarity, number),
                 UNIQUE (multiverseid, edition, number)
             )
         """
 
+    @classmethod
+    def add_search_index(cls) -> str:
+        """ command to index cards by edition, rarity and number, which the edition's foreign key can use too """
+        return """ ALTER TABLE card ADD INDEX (edition, rarity, number) """
+
     @classmethod
     def insert(cls):
         """ command to insert a card """
         return """
-            INSERT INTO card (multiverseid, name, number, rarity, edition, artist, flavor)
-            VALUES
-                (%(multiverseid)s, %(name)s, %(number)s, %(rarity)s, %(edition)s, %(artist)s, %(flavor)s)
+            INSERT INTO card (multiverseid, metacard_id, name, number, rarity, edition, artist, flavor)
+            VALUES (
+                %(multiverseid)s, (SELECT metacard_id FROM metacard WHERE name = %(name)s), %(name)s, %(number)s,
+                %(rarity)s, %(edition)s, %(artist)s, %(flavor)s
+            )
             ON DUPLICATE KEY UPDATE
                 rarity=VALUES(rarity), edition=VALUES(edition), artist=VALUES(artist),
                 flavor=VALUES(flavor)
@@ -232,11 +413,11 @@ class Card:
                 (
                     SELECT COUNT(*)
                         FROM card
-                        WHERE card.name = metacard.name
+                        WHERE card.metacard_id = metacard.metacard_id
                 ) AS versions
             FROM metacard
                 INNER JOIN card
-                    ON metacard.name = card.name
+                    ON metacard.metacard_id = card.metacard_id
                 INNER JOIN edition
                     ON card.edition = edition.code
             WHERE card_id = %(card_id)s;
@@ -309,10 +490,17 @@ class Edition:
                     'core', 'expansion', 'duel deck', 'commander', 'promo', 'box', 'un', 'reprint', 'from the vault',
                     'planechase', 'masters', 'starter', 'premium deck', 'conspiracy', 'vanguard', 'archenemy'
                 ) NOT NULL,
-                block VARCHAR(50)
+                block VARCHAR(50),
+
+                INDEX (block)
             )
         """
 
+    @classmethod
+    def add_block_index(cls) -> str:
+        """ command to index editions by block """
+        return """ ALTER TABLE edition ADD INDEX (block) """
+
     @classmethod
     def insert(cls) -> str:
         """ command to insert an edition """
@@ -343,7 +531,8 @@ class Format:
         """ command to create the format table """
         return """
             CREATE TABLE format (
-                name VARCHAR(150) PRIMARY KEY
+                format_id INT PRIMARY KEY AUTO_INCREMENT,
+                name VARCHAR(150) NOT NULL UNIQUE
             )
         """
 
@@ -412,13 +601,60 @@ class CardInCollection:
         """
 
     @classmethod
-    def insert(cls):
-        """ insert a card in the collection """
+    def create_import_table(cls):
+        """ command to create the temporary table in which uploaded cards are staged before being resolved """
+        return """
+            CREATE TEMPORARY TABLE IF NOT EXISTS collection_import (
+                name VARCHAR(150) NOT NULL,
+                edition VARCHAR(8) NOT NULL,
+                number VARCHAR(4) NOT NULL,
+                normal INT UNSIGNED NOT NULL DEFAULT 0,
+                foil INT UNSIGNED NOT NULL DEFAULT 0,
+
+                INDEX (name, edition, number)
+            )
+        """
+
+    @classmethod
+    def drop_import_table(cls):
+        """ command to remove the temporary import table """
+        return """ DROP TEMPORARY TABLE IF EXISTS collection_import """
+
+    @classmethod
+    def stage(cls):
+        """ stage an uploaded card in the import table """
+        return """
+            INSERT INTO collection_import (name, edition, number, normal, foil)
+            VALUES (%(name)s, %(edition)s, %(number)s, %(normal)s, %(foil)s)
+        """
+
+    @classmethod
+    def merge_import(cls):
+        """ resolve all staged cards to their ids and set their quantities in the user's collection """
         return """
             INSERT INTO card_in_collection (user_id, card_id, normal, foil)
-            SELECT %(user_id)s, card_id, %(normal)s, %(foil)s
-            FROM card
-            WHERE name = %(name)s AND edition = %(edition)s AND number = %(number)s
+            SELECT %(user_id)s, card.card_id, SUM(collection_import.normal), SUM(collection_import.foil)
+            FROM collection_import
+            INNER JOIN card
+                ON card.name = collection_import.name
+                    AND card.edition = collection_import.edition
+                    AND card.number = collection_import.number
+            GROUP BY card.card_id
+            ON DUPLICATE KEY UPDATE normal=VALUES(normal), foil=VALUES(foil)
+        """
+
+    @classmethod
+    def unresolved_import(cls):
+        """ list all staged cards that do not correspond to any known card """
+        return """
+            SELECT collection_import.name, collection_import.edition, collection_import.number,
+                collection_import.normal, collection_import.foil
+            FROM collection_import
+            LEFT JOIN card
+                ON card.name = collection_import.name
+                    AND card.edition = collection_import.edition
+                    AND card.number = collection_import.number
+            WHERE card.card_id IS NULL
         """
 
 
@@ -476,33 +712,37 @@ class Deck:
     def list(cls):
         """ command to get a list of decks for the given user_id """
         return """
-            SELECT name,
-                user_index,
-                IFNULL(deck.card_sum, 0) AS n_deck,
-                IFNULL(side.card_sum, 0) AS n_side,
-                colors.colors
-            FROM deck AS decks
-            LEFT JOIN (SELECT deck_id, SUM(number) AS card_sum FROM card_in_deck GROUP BY deck_id) AS deck
-                ON deck.deck_id = decks.deck_id
-            LEFT JOIN (SELECT deck_id, SUM(number) AS card_sum FROM card_in_side GROUP BY deck_id) AS side
-                ON side.deck_id = decks.deck_id
-            LEFT JOIN (
-                SELECT GROUP_CONCAT(DISTINCT colors) AS colors, deck_id
-                FROM metacard
-                    INNER JOIN card
-                        ON metacard.name = card.name
-                    INNER JOIN (
-                        SELECT card_id, deck_id
-                              FROM card_in_deck
-                        UNION SELECT card_id, deck_id
-                              FROM card_in_side
-                    ) AS cards
-                      ON cards.card_id = card.card_id
-                  GROUP BY deck_id) AS colors
-              ON decks.deck_id = colors.deck_id
-            WHERE user_id=%(user_id)s
-                GROUP BY decks.deck_id
-            ORDER BY user_index ASC
+            SELECT deck.name, deck.user_index, deck_summary.n_deck, deck_summary.n_side, deck_summary.colors
+            FROM deck_summary
+            INNER JOIN deck ON deck.deck_id = deck_summary.deck_id
+            WHERE deck_summary.user_id = %(user_id)s
+            ORDER BY deck.user_index ASC
+        """
+
+    @classmethod
+    def export_all(cls):
+        """
+        command to get all cards of all decks of the given user, ordered by deck. Each deck starts with a row having
+        a NULL side, so that empty decks are exported too
+        """
+        return """
+            SELECT deck.deck_id, deck.name AS deck_name, NULL AS side, NULL AS name, NULL AS edition,
+                NULL AS ed_number, NULL AS number
+            FROM deck
+            WHERE deck.user_id = %(user_id)s
+            UNION ALL
+            SELECT deck.deck_id, deck.name, 0, card.name, card.edition, card.number, card_in_deck.number
+            FROM deck
+            INNER JOIN card_in_deck ON card_in_deck.deck_id = deck.deck_id
+            INNER JOIN card ON card.card_id = card_in_deck.card_id
+            WHERE deck.user_id = %(user_id)s
+            UNION ALL
+            SELECT deck.deck_id, deck.name, 1, card.name, card.edition, card.number, card_in_side.number
+            FROM deck
+            INNER JOIN card_in_side ON card_in_side.deck_id = deck.deck_id
+            INNER JOIN card ON card.card_id = card_in_side.card_id
+            WHERE deck.user_id = %(user_id)s
+            ORDER BY deck_id, side
         """
 
     @classmethod
@@ -519,20 +759,263 @@ class Deck:
     def get_missing(cls):
         """ get all missing card from given deck """
         return """
-            SELECT deck_entity.card_id, SUM(deck_entity.number) - IFNULL(owned.number, 0) AS number
+            SELECT deck_card_need.card_id, deck_card_need.needed - deck_card_need.owned AS number
+            FROM deck
+            INNER JOIN deck_card_need ON deck_card_need.deck_id = deck.deck_id
+            WHERE deck.name = %(deck_name)s AND deck.user_id = %(user_id)s
+                AND deck_card_need.needed > deck_card_need.owned
+        """
+
+    @classmethod
+    def get_all_missing(cls):
+        """ get all missing cards from all decks of the given user """
+        return """
+            SELECT deck.name, deck_card_need.card_id, deck_card_need.needed - deck_card_need.owned AS number
+            FROM deck_card_need
+            INNER JOIN deck ON deck.deck_id = deck_card_need.deck_id
+            WHERE deck_card_need.user_id = %(user_id)s AND deck_card_need.needed > deck_card_need.owned
+            ORDER BY deck.user_index ASC
+        """
+
+    @classmethod
+    def get_revision(cls) -> str:
+        """ command to get the id and revision of the given deck, which changes each time its content changes """
+        return """
+            SELECT deck.deck_id, deck_summary.revision
+            FROM deck
+            INNER JOIN deck_summary ON deck_summary.deck_id = deck.deck_id
+            WHERE deck.name = %(deck_name)s AND deck.user_id = %(user_id)s
+        """
+
+    @classmethod
+    def get_analytics_cards(cls) -> str:
+        """ command to get the catalog information needed for the analytics of the given deck, by card name """
+        return """
+            SELECT entity.side, metacard.name, metacard.types, metacard.manaCost, metacard.cmc,
+                SUM(entity.number) AS number
+            FROM (
+                SELECT card_id, number, 0 AS side FROM card_in_deck WHERE deck_id = %(deck_id)s
+                UNION ALL SELECT card_id, number, 1 AS side FROM card_in_side WHERE deck_id = %(deck_id)s
+            ) AS entity
+            INNER JOIN card ON card.card_id = entity.card_id
+            INNER JOIN metacard ON metacard.metacard_id = card.metacard_id
+            GROUP BY entity.side, metacard.metacard_id
+        """
+
+    @classmethod
+    def count_by_name(cls) -> str:
+        """ command to get the number of copies of each card of the given deck, main and side deck together """
+        return """
+            SELECT card.name, SUM(entity.number) AS number
+            FROM (
+                SELECT card_id, number FROM card_in_deck WHERE deck_id = %(deck_id)s
+                UNION ALL SELECT card_id, number FROM card_in_side WHERE deck_id = %(deck_id)s
+            ) AS entity
+            INNER JOIN card ON card.card_id = entity.card_id
+            GROUP BY card.name
+        """
+
+
+class DeckSummary:
+    """
+    MySQL commands to handle the summary of each deck, kept up to date by triggers
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the deck summary table. colors is a bitmask with the same values as metacard.colors """
+        return """
+            CREATE TABLE deck_summary (
+                deck_id INT PRIMARY KEY,
+                user_id INT NOT NULL,
+                n_deck INT UNSIGNED NOT NULL DEFAULT 0,
+                n_side INT UNSIGNED NOT NULL DEFAULT 0,
+                colors TINYINT UNSIGNED NOT NULL DEFAULT 0,
+                revision INT UNSIGNED NOT NULL DEFAULT 0,
+
+                FOREIGN KEY (deck_id) REFERENCES deck(deck_id) ON DELETE CASCADE ON UPDATE CASCADE,
+                INDEX (user_id)
+            )
+        """
+
+    colors_mask = "metacard.colors + 0"
+
+    @classmethod
+    def deck_colors(cls, deck_id: str) -> str:
+        """
+        expression of the colors of all cards of a deck, as a bitmask
+
+        :param deck_id: expression giving the id of the deck
+        """
+        return """(
+            SELECT IFNULL(BIT_OR({colors_mask}), 0)
+            FROM metacard
+            INNER JOIN card ON card.metacard_id = metacard.metacard_id
+            WHERE card.card_id IN (
+                SELECT card_id FROM card_in_deck WHERE card_in_deck.deck_id = {deck_id}
+                UNION SELECT card_id FROM card_in_side WHERE card_in_side.deck_id = {deck_id}
+            )
+        )""".format(colors_mask=cls.colors_mask, deck_id=deck_id)
+
+    @classmethod
+    def card_colors(cls, card_id: str) -> str:
+        """
+        expression of the colors of a card, as a bitmask
+
+        :param card_id: expression giving the id of the card
+        """
+        return """(
+            SELECT IFNULL({colors_mask}, 0)
+            FROM metacard
+            INNER JOIN card ON card.metacard_id = metacard.metacard_id
+            WHERE card.card_id = {card_id}
+        )""".format(colors_mask=cls.colors_mask, card_id=card_id)
+
+    @classmethod
+    def refresh(cls, selection: str="") -> str:
+        """
+        command to recompute the summary of the decks matching the given selection
+
+        :param selection: WHERE clause on the deck table, all decks are refreshed if empty
+        """
+        return """
+            INSERT INTO deck_summary (deck_id, user_id, n_deck, n_side, colors)
+            SELECT deck.deck_id, deck.user_id,
+                (SELECT IFNULL(SUM(number), 0) FROM card_in_deck WHERE card_in_deck.deck_id = deck.deck_id),
+                (SELECT IFNULL(SUM(number), 0) FROM card_in_side WHERE card_in_side.deck_id = deck.deck_id),
+                {colors}
             FROM deck
-            INNER JOIN (SELECT * FROM card_in_deck UNION ALL SELECT * FROM card_in_side) AS deck_entity
-                ON deck_entity.deck_id = deck.deck_id
-            LEFT JOIN (
-                SELECT DISTINCT card_id,
-                normal + foil AS number
-                FROM card_in_collection WHERE user_id = %(user_id)s
-            ) AS owned
-                ON owned.card_id = deck_entity.card_id
-            WHERE name = %(deck_name)s AND user_id = %(user_id)s
-            GROUP BY deck_entity.card_id, owned.number
-            HAVING owned.number IS NULL OR SUM(deck_entity.number) > owned.number
+            {selection}
+            ON DUPLICATE KEY UPDATE
+                n_deck=VALUES(n_deck), n_side=VALUES(n_side), colors=VALUES(colors), revision=revision + 1
+        """.format(colors=cls.deck_colors("deck.deck_id"), selection=selection)
+
+    @classmethod
+    def content_changes(cls) -> typing.Iterator[typing.Tuple[str, str, str]]:
         """
+        statements applying each change of the decks' content to their summary. Counts move by the number of copies
+        added or removed, colors gain those of an added card and are only recomputed from the deck when a card is
+        removed. Rows of the decks' content only ever change their number of copies
+
+        :return: iterator over the table, event and statement of each trigger
+        """
+        for table, count in ("card_in_deck", "n_deck"), ("card_in_side", "n_side"):
+            for event, row, changes in (
+                    ("INSERT", "NEW", "{count} = {count} + NEW.number, colors = colors | {card_colors}"),
+                    ("UPDATE", "NEW", "{count} = {count} + NEW.number - OLD.number"),
+                    ("DELETE", "OLD", "{count} = {count} - OLD.number, colors = {deck_colors}")
+            ):
+                yield table, event, """
+                    UPDATE deck_summary
+                    SET {changes}, revision = revision + 1
+                    WHERE deck_id = {row}.deck_id
+                """.format(row=row, changes=changes.format(
+                    count=count, card_colors=cls.card_colors("NEW.card_id"), deck_colors=cls.deck_colors("OLD.deck_id")
+                ))
+
+    @classmethod
+    def content_triggers(cls) -> typing.List[str]:
+        """ triggers keeping the summary up to date with the decks' content """
+        return [
+            """
+                CREATE TRIGGER deck_summary_on_{table}_{name} AFTER {event} ON {table}
+                FOR EACH ROW {statement}
+            """.format(table=table, name=event.lower(), event=event, statement=statement)
+            for table, event, statement in cls.content_changes()
+        ]
+
+    @classmethod
+    def triggers(cls) -> typing.List[str]:
+        """ triggers creating the summary of new decks and keeping it up to date """
+        return [
+            """
+                CREATE TRIGGER deck_summary_on_deck_insert AFTER INSERT ON deck
+                FOR EACH ROW INSERT INTO deck_summary (deck_id, user_id) VALUES (NEW.deck_id, NEW.user_id)
+            """
+        ] + cls.content_triggers()
+
+
+class DeckCardNeed:
+    """
+    MySQL commands to handle the number of copies of each card needed by each deck and owned by the deck's owner,
+    kept up to date by triggers
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table of needed cards """
+        return """
+            CREATE TABLE deck_card_need (
+                deck_id INT NOT NULL,
+                card_id INT NOT NULL,
+                user_id INT NOT NULL,
+                needed INT UNSIGNED NOT NULL DEFAULT 0,
+                owned INT UNSIGNED NOT NULL DEFAULT 0,
+
+                FOREIGN KEY (deck_id) REFERENCES deck(deck_id) ON DELETE CASCADE ON UPDATE CASCADE,
+                PRIMARY KEY (deck_id, card_id),
+                INDEX (user_id, card_id)
+            )
+        """
+
+    @classmethod
+    def populate(cls) -> str:
+        """ command to compute the needed cards of all existing decks """
+        return """
+            INSERT INTO deck_card_need (deck_id, card_id, user_id, needed, owned)
+            SELECT deck.deck_id, entity.card_id, deck.user_id, SUM(entity.number),
+                IFNULL(MAX(card_in_collection.normal + card_in_collection.foil), 0)
+            FROM (
+                SELECT deck_id, card_id, number FROM card_in_deck
+                UNION ALL SELECT deck_id, card_id, number FROM card_in_side
+            ) AS entity
+            INNER JOIN deck ON deck.deck_id = entity.deck_id
+            LEFT JOIN card_in_collection
+                ON card_in_collection.user_id = deck.user_id AND card_in_collection.card_id = entity.card_id
+            GROUP BY deck.deck_id, entity.card_id, deck.user_id
+            ON DUPLICATE KEY UPDATE needed=VALUES(needed), owned=VALUES(owned)
+        """
+
+    @classmethod
+    def triggers(cls) -> typing.List[str]:
+        """ procedure and triggers keeping the needed and owned numbers up to date """
+        commands = [
+            """
+                CREATE PROCEDURE refresh_deck_card_need(IN need_deck_id INT, IN need_card_id INT)
+                BEGIN
+                    INSERT INTO deck_card_need (deck_id, card_id, user_id, needed, owned)
+                    SELECT deck.deck_id, need_card_id, deck.user_id,
+                        (
+                            SELECT IFNULL(SUM(number), 0) FROM card_in_deck
+                            WHERE deck_id = need_deck_id AND card_id = need_card_id
+                        ) + (
+                            SELECT IFNULL(SUM(number), 0) FROM card_in_side
+                            WHERE deck_id = need_deck_id AND card_id = need_card_id
+                        ),
+                        IFNULL((
+                            SELECT normal + foil FROM card_in_collection
+                            WHERE user_id = deck.user_id AND card_id = need_card_id
+                        ), 0)
+                    FROM deck
+                    WHERE deck.deck_id = need_deck_id
+                    ON DUPLICATE KEY UPDATE needed=VALUES(needed), owned=VALUES(owned);
+
+                    DELETE FROM deck_card_need WHERE deck_id = need_deck_id AND card_id = need_card_id AND needed = 0;
+                END
+            """
+        ]
+        for table in "card_in_deck", "card_in_side":
+            for event, row in ("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"):
+                commands.append("""
+                    CREATE TRIGGER deck_card_need_on_{table}_{event} AFTER {event} ON {table}
+                    FOR EACH ROW CALL refresh_deck_card_need({row}.deck_id, {row}.card_id)
+                """.format(table=table, event=event.lower(), row=row))
+        owned_after = "NEW.normal + NEW.foil"
+        for event, row, owned in ("INSERT", "NEW", owned_after), ("UPDATE", "NEW", owned_after), ("DELETE", "OLD", "0"):
+            commands.append("""
+                CREATE TRIGGER deck_card_need_on_card_in_collection_{event} AFTER {event} ON card_in_collection
+                FOR EACH ROW UPDATE deck_card_need SET owned = {owned}
+                    WHERE user_id = {row}.user_id AND card_id = {row}.card_id
+            """.format(event=event.lower(), owned=owned, row=row))
+        return commands
 
 
 # noinspection SqlResolve
@@ -651,13 +1134,13 @@ class LegalInFormat:
         """ command to create the table """
         return """
             CREATE TABLE card_legal_in_format (
-                card_name VARCHAR(150) NOT NULL,
-                format VARCHAR(150) NOT NULL,
+                metacard_id INT NOT NULL,
+                format_id INT NOT NULL,
                 type SET('Restricted', 'Legal', 'Banned') NOT NULL,
 
-                FOREIGN KEY (card_name) REFERENCES metacard(name) ON DELETE RESTRICT ON UPDATE RESTRICT,
-                FOREIGN KEY (format) REFERENCES format(name) ON DELETE RESTRICT ON UPDATE RESTRICT ,
-                UNIQUE (card_name, format)
+                FOREIGN KEY (metacard_id) REFERENCES metacard(metacard_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                FOREIGN KEY (format_id) REFERENCES format(format_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                PRIMARY KEY (metacard_id, format_id)
             )
         """
 
@@ -665,7 +1148,315 @@ class LegalInFormat:
     def insert(cls) -> str:
         """ command to make a card valid in a format """
         return """
-            INSERT INTO card_legal_in_format (card_name, format, type)
-            VALUES (%(card_name)s, %(format)s, %(type)s)
+            INSERT INTO card_legal_in_format (metacard_id, format_id, type)
+            VALUES (
+                (SELECT metacard_id FROM metacard WHERE name = %(card_name)s),
+                (SELECT format_id FROM format WHERE name = %(format)s),
+                %(type)s
+            )
             ON DUPLICATE KEY UPDATE type=VALUES(type)
         """
+
+
+class FormatLegality:
+    """
+    MySQL commands to store the legality matrix : for each format, bitsets of the cards legal and restricted in it,
+    indexed by the cards' ordinal
+    """
+    @classmethod
+    def create_card_table(cls) -> str:
+        """ command to create the table giving each card its position in the bitsets """
+        return """
+            CREATE TABLE legality_card (
+                ordinal INT PRIMARY KEY,
+                name VARCHAR(150) NOT NULL UNIQUE,
+
+                FOREIGN KEY (name) REFERENCES metacard(name) ON DELETE CASCADE ON UPDATE CASCADE
+            )
+        """
+
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table of bitsets """
+        return """
+            CREATE TABLE legality_format (
+                format_id INT PRIMARY KEY,
+                name VARCHAR(150) NOT NULL UNIQUE,
+                legal MEDIUMBLOB NOT NULL,
+                restricted MEDIUMBLOB NOT NULL,
+
+                FOREIGN KEY (name) REFERENCES format(name) ON DELETE CASCADE ON UPDATE CASCADE
+            )
+        """
+
+    @classmethod
+    def clear(cls) -> typing.List[str]:
+        """ commands to remove the current matrix """
+        return ["DELETE FROM legality_format", "DELETE FROM legality_card"]
+
+    @classmethod
+    def insert_card(cls) -> str:
+        """ command to give a card its position """
+        return """ INSERT INTO legality_card (ordinal, name) VALUES (%(ordinal)s, %(name)s) """
+
+    @classmethod
+    def insert(cls) -> str:
+        """ command to insert the bitsets of a format """
+        return """
+            INSERT INTO legality_format (format_id, name, legal, restricted)
+            VALUES (%(format_id)s, %(name)s, %(legal)s, %(restricted)s)
+        """
+
+    @classmethod
+    def list_cards(cls) -> str:
+        """ command to get all cards, by position """
+        return """ SELECT ordinal, name FROM legality_card ORDER BY ordinal """
+
+    @classmethod
+    def list(cls) -> str:
+        """ command to get the bitsets of all formats """
+        return """ SELECT format_id, name, legal, restricted FROM legality_format ORDER BY format_id """
+
+    @classmethod
+    def list_metacards(cls) -> str:
+        """ command to get the names of all cards """
+        return """ SELECT name FROM metacard ORDER BY name """
+
+    @classmethod
+    def count_formats(cls) -> str:
+        """ command to get the number of formats of the catalog and of the matrix, which differ until it is built """
+        return """
+            SELECT (SELECT COUNT(*) FROM format) AS formats, (SELECT COUNT(*) FROM legality_format) AS built
+        """
+
+    @classmethod
+    def list_legalities(cls) -> str:
+        """ command to get the legality of all cards in all formats """
+        return """
+            SELECT metacard.name AS card_name, format.name AS format, card_legal_in_format.type
+            FROM card_legal_in_format
+            INNER JOIN metacard ON metacard.metacard_id = card_legal_in_format.metacard_id
+            INNER JOIN format ON format.format_id = card_legal_in_format.format_id
+        """
+
+
+class Migration:
+    """
+    MySQL commands to keep track of the schema's version and to bring databases created by older versions to the
+    current schema
+    """
+    online_clause = ", ALGORITHM=INPLACE, LOCK=NONE"
+
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table holding the schema version of each model """
+        return """
+            CREATE TABLE schema_migration (
+                model VARCHAR(64) PRIMARY KEY,
+                version INT UNSIGNED NOT NULL,
+                applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """
+
+    @classmethod
+    def list_versions(cls) -> str:
+        """ command to get the schema version of each model """
+        return """ SELECT model, version FROM schema_migration """
+
+    @classmethod
+    def set_version(cls) -> str:
+        """ command to set the schema version of a model """
+        return """
+            INSERT INTO schema_migration (model, version)
+            VALUES (%(model)s, %(version)s)
+            ON DUPLICATE KEY UPDATE version=VALUES(version)
+        """
+
+    @classmethod
+    def online(cls, command: str) -> str:
+        """
+        Asks MySQL to alter the table without blocking reads and writes. The migration falls back to a regular ALTER
+        when the server cannot do it for this command
+
+        :param command: ALTER TABLE command
+        :return: the command, altering the table online
+        """
+        return command.rstrip() + cls.online_clause
+
+    @classmethod
+    def refused_online(cls, command: str, exc: Exception) -> bool:
+        """
+        Checks whether the server failed a command because it cannot alter the table online
+
+        :param command: the failed command
+        :param exc: the error raised by the command
+        :return: whether the command has to be run again as a regular ALTER
+        """
+        return cls.online_clause in command and getattr(exc, "errno", None) in (
+            driver().errorcode.ER_ALTER_OPERATION_NOT_SUPPORTED,
+            driver().errorcode.ER_ALTER_OPERATION_NOT_SUPPORTED_REASON,
+            driver().errorcode.ER_PARSE_ERROR
+        )
+
+    @classmethod
+    def offline(cls, command: str) -> str:
+        """
+        Removes the online clause of a command
+
+        :param command: ALTER TABLE command, altering the table online
+        :return: the command, as a regular ALTER
+        """
+        return command.replace(cls.online_clause, "")
+
+    @classmethod
+    def for_each(cls, query: str, command: str) -> typing.Tuple[str, str]:
+        """
+        Step of a migration running a command once for each row returned by a query, formatted with the row's values.
+        MySQL commits each alteration of a table : steps checking the schema this way let a migration that was
+        interrupted resume where it stopped when run again
+
+        :param query: query selecting the rows for which to run the command
+        :param command: command to run, formatted with the values of each row
+        :return: the step of the migration
+        """
+        return query, command
+
+    @classmethod
+    def if_column(cls, table: str, column: str, command: str, exists: bool=True) -> typing.Tuple[str, str]:
+        """
+        Step of a migration running a command depending on whether a table has a column
+
+        :param table: name of the table
+        :param column: name of the column
+        :param command: command to run
+        :param exists: whether the column has to exist for the command to run, or to be missing
+        :return: the step of the migration
+        """
+        return cls.for_each("""
+            SELECT 1 FROM DUAL WHERE {negation} EXISTS (
+                SELECT * FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{table}' AND COLUMN_NAME = '{column}'
+            )
+        """.format(negation="" if exists else "NOT", table=table, column=column), command)
+
+    @classmethod
+    def foreign_keys(cls, table: str, referenced_table: str, referenced_column: str) -> str:
+        """
+        query selecting the names of the foreign keys of a table referencing the given column
+
+        :param table: name of the table holding the foreign keys
+        :param referenced_table: name of the table they reference
+        :param referenced_column: name of the column they reference
+        """
+        return """
+            SELECT DISTINCT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{table}'
+                AND REFERENCED_TABLE_NAME = '{referenced_table}' AND REFERENCED_COLUMN_NAME = '{referenced_column}'
+        """.format(table=table, referenced_table=referenced_table, referenced_column=referenced_column)
+
+    @classmethod
+    def drop_foreign_keys(cls, table: str, referenced_table: str, referenced_column: str) -> typing.Tuple[str, str]:
+        """
+        Step of a migration dropping the foreign keys of a table referencing the given column, whatever their names
+
+        :param table: name of the table holding the foreign keys
+        :param referenced_table: name of the table they reference
+        :param referenced_column: name of the column they reference
+        :return: the step of the migration
+        """
+        return cls.for_each(
+            cls.foreign_keys(table, referenced_table, referenced_column),
+            "ALTER TABLE {} DROP FOREIGN KEY `{{}}`".format(table)
+        )
+
+    @classmethod
+    def add_foreign_key(cls, table: str, column: str, referenced_table: str, referenced_column: str, actions: str) \
+            -> typing.Tuple[str, str]:
+        """
+        Step of a migration adding a foreign key to a table if it exists and has none referencing the column yet
+
+        :param table: name of the table holding the foreign key
+        :param column: column of the foreign key
+        :param referenced_table: name of the table it references
+        :param referenced_column: name of the column it references
+        :param actions: ON DELETE and ON UPDATE clauses of the foreign key
+        :return: the step of the migration
+        """
+        return cls.for_each(
+            """
+                SELECT 1 FROM information_schema.TABLES
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{table}' AND NOT EXISTS ({foreign_keys})
+            """.format(table=table, foreign_keys=cls.foreign_keys(table, referenced_table, referenced_column)),
+            "ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {}({}) {}".format(
+                table, column, referenced_table, referenced_column, actions
+            )
+        )
+
+    @classmethod
+    def drop_single_column_index(cls, table: str, column: str) -> typing.Tuple[str, str]:
+        """
+        Step of a migration dropping the indexes of a table on the given column alone, once another index starts with
+        it. Those created by MySQL for foreign keys are named after the key or the column, so they are looked up
+
+        :param table: name of the table
+        :param column: name of the column
+        :return: the step of the migration
+        """
+        return cls.for_each(
+            """
+                SELECT INDEX_NAME FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{table}'
+                GROUP BY INDEX_NAME
+                HAVING COUNT(*) = 1 AND MAX(COLUMN_NAME) = '{column}'
+            """.format(table=table, column=column),
+            cls.online("ALTER TABLE {} DROP INDEX `{{}}`".format(table))
+        )
+
+    @classmethod
+    def surrogate_keys(cls) -> typing.List[typing.Union[str, typing.Tuple[str, str]]]:
+        """
+        commands replacing the names of metacards and formats by integer ids in the tables referencing them. Foreign
+        keys on the names are dropped while the primary keys change
+        """
+        restrict = "ON DELETE RESTRICT ON UPDATE RESTRICT"
+        return [
+            cls.drop_foreign_keys("card", "metacard", "name"),
+            cls.drop_foreign_keys("card_legal_in_format", "metacard", "name"),
+            cls.drop_foreign_keys("card_legal_in_format", "format", "name"),
+            cls.if_column("metacard", "metacard_id", """
+                ALTER TABLE metacard
+                DROP PRIMARY KEY, ADD metacard_id INT PRIMARY KEY AUTO_INCREMENT FIRST, ADD UNIQUE (name)
+            """, exists=False),
+            cls.if_column("format", "format_id", """
+                ALTER TABLE format
+                DROP PRIMARY KEY, ADD format_id INT PRIMARY KEY AUTO_INCREMENT FIRST, ADD UNIQUE (name)
+            """, exists=False),
+            cls.if_column(
+                "card", "metacard_id", "ALTER TABLE card ADD metacard_id INT NOT NULL AFTER multiverseid", exists=False
+            ),
+            """
+                UPDATE card
+                INNER JOIN metacard ON metacard.name = card.name
+                SET card.metacard_id = metacard.metacard_id
+            """,
+            cls.add_foreign_key("card", "metacard_id", "metacard", "metacard_id", restrict),
+            cls.if_column("card_legal_in_format", "metacard_id", """
+                ALTER TABLE card_legal_in_format
+                ADD metacard_id INT NOT NULL FIRST, ADD format_id INT NOT NULL AFTER metacard_id
+            """, exists=False),
+            cls.if_column("card_legal_in_format", "card_name", """
+                UPDATE card_legal_in_format
+                INNER JOIN metacard ON metacard.name = card_legal_in_format.card_name
+                INNER JOIN format ON format.name = card_legal_in_format.format
+                SET card_legal_in_format.metacard_id = metacard.metacard_id,
+                    card_legal_in_format.format_id = format.format_id
+            """),
+            cls.if_column("card_legal_in_format", "card_name", """
+                ALTER TABLE card_legal_in_format
+                DROP COLUMN card_name,
+                DROP COLUMN format,
+                ADD PRIMARY KEY (metacard_id, format_id),
+                ADD FOREIGN KEY (metacard_id) REFERENCES metacard(metacard_id) {restrict},
+                ADD FOREIGN KEY (format_id) REFERENCES format(format_id) {restrict}
+            """.format(restrict=restrict))
+        ]
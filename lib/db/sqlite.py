@@ -0,0 +1,879 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite implementation of the commands needed to run MTGCollector application.
+
+The whole database is kept in a single file, without any server, which suits small installs and lets the tests and
+benchmarks run in-process. Commands are written as for MySQL, with %(name)s parameters, and only those SQLite does not
+understand are redefined here.
+
+SQLite has no SET type : the multi-valued columns of metacards are stored as integer bitmasks, with the bit values MySQL
+gives to their members, so that the color searches work unchanged. The single-valued rarity and legality are stored as
+text. All of them are read back as python sets, as the MySQL connector gives them
+"""
+
+import contextlib
+import datetime
+import decimal
+import fcntl
+import functools
+import os
+import re
+import sqlite3
+
+import typing
+
+import lib
+from lib.db import sql
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+sets = {
+    "types": (
+        "Land", "Creature", "Sorcery", "Instant", "Artifact", "Planeswalker", "Enchantment", "Tribal", "Scheme",
+        "Eaturecray", "Enchant", "Vanguard", "Plane", "Scariest", "You'll", "Ever", "See", "Conspiracy", "Phenomenon",
+        "Player", "Token"
+    ),
+    "supertypes": ("Legendary", "Snow", "World", "Basic", "Ongoing"),
+    "colors": ("Red", "Green", "White", "Blue", "Black"),
+}
+
+rarities = ("Basic Land", "Common", "Uncommon", "Rare", "Mythic Rare", "Special")
+legalities = ("Restricted", "Legal", "Banned")
+edition_types = (
+    "core", "expansion", "duel deck", "commander", "promo", "box", "un", "reprint", "from the vault", "planechase",
+    "masters", "starter", "premium deck", "conspiracy", "vanguard", "archenemy"
+)
+
+parameter = re.compile(r"%\((\w+)\)s")
+
+
+def to_mask(name: str, members: typing.Union[str, None]) -> typing.Union[int, None]:
+    """
+    Computes the bitmask of a set
+
+    :param name: name of the set, as in `sets`
+    :param members: comma separated members of the set
+    :return: the bitmask, with the bit of each member as MySQL would give it
+    """
+    if members is None:
+        return None
+    mask = 0
+    for member in members.split(","):
+        if member:
+            mask |= 1 << sets[name].index(member)
+    return mask
+
+
+def to_members(name: str, mask: typing.Union[int, None]) -> typing.Union[str, None]:
+    """
+    Lists the members of a bitmask, in the order MySQL would give them
+
+    :param name: name of the set, as in `sets`
+    :param mask: the bitmask
+    :return: comma separated members of the set
+    """
+    if mask is None:
+        return None
+    return ",".join(member for bit, member in enumerate(sets[name]) if mask & 1 << bit)
+
+
+def to_set(name: str, mask: bytes) -> typing.Set[str]:
+    """
+    Reads a bitmask as a python set
+
+    :param name: name of the set, as in `sets`
+    :param mask: the bitmask, as read from the database
+    :return: the members of the set
+    """
+    return set(to_members(name, int(mask)).split(",")) - {""}
+
+
+def check_in(column: str, values: typing.Iterable[str]) -> str:
+    """
+    Constraint replacing MySQL's ENUM
+
+    :param column: name of the column
+    :param values: values allowed in the column
+    :return: the CHECK constraint
+    """
+    return "CHECK ({} IN ({}))".format(column, ", ".join("'{}'".format(value.replace("'", "''")) for value in values))
+
+
+# Patches to make SQLite behave like MySQL
+sqlite3.register_adapter(list, ",".join)
+sqlite3.register_adapter(set, ",".join)
+sqlite3.register_converter("DECIMAL", lambda value: decimal.Decimal(value.decode()))
+sqlite3.register_converter("DATE", lambda value: datetime.datetime.strptime(value.decode(), "%Y-%m-%d").date())
+sqlite3.register_converter("SET_VALUE", lambda value: {value.decode()})
+for _name in sets:
+    sqlite3.register_converter("SET_" + _name.upper(), functools.partial(to_set, _name))
+
+
+class BitOr:
+    """
+    Aggregate computing the bitwise or of integers, as MySQL's BIT_OR
+    """
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value: typing.Union[int, None]) -> None:
+        """ adds a value to the aggregate """
+        if value is not None:
+            self.value |= value
+
+    def finalize(self) -> int:
+        """ the bitwise or of all values """
+        return self.value
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(statement: str) -> typing.Tuple[str, ...]:
+    """
+    Translates a statement written for the MySQL connector to SQLite : parameters are named :name and the statement is
+    split in its commands, SQLite running one at a time
+
+    :param statement: statement to translate
+    :return: the commands of the statement
+    """
+    commands = []
+    current = ""
+    for part in parameter.sub(r":\1", statement).replace("%%", "%").split(";"):
+        current += part + ";"
+        if sqlite3.complete_statement(current):
+            if current.strip(" \n;"):
+                commands.append(current)
+            current = ""
+    if current.strip(" \n;"):
+        commands.append(current)
+    return tuple(commands)
+
+
+class Cursor(sqlite3.Cursor):
+    """
+    Cursor running statements written for the MySQL connector
+    """
+    def execute(self, statement: str, parameters=()):
+        """
+        Executes all commands of a statement
+
+        :param statement: statement to execute
+        :param parameters: parameters of the statement, by name
+        :return: the cursor, on the results of the last command
+        """
+        commands = translate(statement)
+        for command in commands[:-1]:
+            super().execute(command, parameters)
+        return super().execute(commands[-1], parameters)
+
+    def executemany(self, statement: str, parameters):
+        """
+        Executes a single command for each set of parameters
+
+        :param statement: statement to execute
+        :param parameters: iterable over the parameters of each execution
+        :return: the cursor
+        """
+        command, = translate(statement)
+        return super().executemany(command, parameters)
+
+
+class DictionaryCursor(Cursor):
+    """
+    Cursor returning each row as a dictionary, as the MySQL connector's dictionary cursors
+    """
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.row_factory = lambda cursor, row: {
+            column[0]: value for column, value in zip(cursor.description, row)
+        }
+
+
+class Connection(sqlite3.Connection):
+    """
+    Connection giving the same cursors as the MySQL connector
+    """
+    def cursor(self, factory=None, dictionary: bool=False):
+        """
+        Creates a cursor
+
+        :param factory: class of the cursor, as for sqlite3
+        :param dictionary: whether the cursor returns rows as dictionaries
+        :return: the cursor
+        """
+        return super().cursor(factory or (DictionaryCursor if dictionary else Cursor))
+
+
+def database_path(app) -> str:
+    """
+    Gets the path to the database file, relative paths being relative to the run directory
+
+    :param app: Flask app containing the configuration
+    :return: path to the database
+    """
+    return os.path.join(lib.get_run_directory(app), app.config["DATABASE_NAME"])
+
+
+def connect(path: str) -> Connection:
+    """
+    Opens the database at the given path, creating it if needed
+
+    :param path: path to the database file
+    :return: the connection
+    """
+    connection = sqlite3.connect(path, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES, factory=Connection)
+    connection.create_function("to_mask", 2, to_mask)
+    connection.create_function("to_members", 2, to_members)
+    connection.create_aggregate("bit_or", 1, BitOr)
+    cursor = connection.cursor()
+    # readers do not block the writer nor each other
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    return connection
+
+
+def get_connection(app) -> Connection:
+    """
+    returns a connection to the database
+
+    :param app: Flask app containing the configuration
+    :return: SQLite connection to the database
+    """
+    return connect(database_path(app))
+
+
+def database_exists(app) -> bool:
+    """
+    checks whether the database file already exists
+
+    :param app: Flask app containing the configuration
+    """
+    return os.path.exists(database_path(app))
+
+
+def create_database(app) -> None:
+    """
+    creates the directory of the database, the file itself being created on the first connection
+
+    :param app: Flask app containing the configuration
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(database_path(app))), exist_ok=True)
+
+
+def drop_database(app) -> None:
+    """
+    removes the database file, along with its journal
+
+    :param app: Flask app containing the configuration
+    """
+    path = database_path(app)
+    for suffix in "", "-wal", "-shm":
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + suffix)
+
+
+@contextlib.contextmanager
+def named_lock(app, name: str):
+    """
+    Lock shared by every process using the same database file. It is released when its file is closed, so a crashed
+    process cannot keep it
+
+    :param app: Flask app containing the configuration
+    :param name: name of the lock, unique for each database
+    :return: whether the lock was acquired or not
+    """
+    with open("{}.{}.lock".format(database_path(app), name), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+Error = sqlite3.Error
+
+
+class Errors:
+    """
+    Classification of the SQLite errors from which the application recovers
+    """
+    @classmethod
+    def duplicate_entry(cls, exc: Exception) -> bool:
+        """ whether the error comes from a value already present in a unique column """
+        return isinstance(exc, sqlite3.IntegrityError) and str(exc).startswith("UNIQUE constraint failed")
+
+    @classmethod
+    def table_exists(cls, exc: Exception) -> bool:
+        """ whether the error comes from creating a table that already exists """
+        return isinstance(exc, sqlite3.OperationalError) and str(exc).endswith("already exists")
+
+    @classmethod
+    def unknown_database(cls, exc: Exception) -> bool:
+        """ never the case, the database file being created on the first connection """
+        return False
+
+
+class User(sql.User):
+    """
+    SQLite commands related to the User model
+    """
+    @classmethod
+    def create_table(cls):
+        """ command to create the user table"""
+        return """
+            CREATE TABLE user (
+                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username VARCHAR(255) NOT NULL UNIQUE,
+                email VARCHAR(255) NOT NULL UNIQUE,
+                password BLOB NOT NULL,
+                salt BLOB NOT NULL,
+                iterations INT UNSIGNED NOT NULL DEFAULT 1000000,
+                is_admin BOOLEAN NOT NULL DEFAULT FALSE
+            )
+        """
+
+
+class Metacard(sql.Metacard):
+    """
+    SQLite commands related to the Metacard model
+    """
+    @classmethod
+    def create_table(cls):
+        """ table creation command to the Metacard model """
+        return """
+            CREATE TABLE metacard (
+                metacard_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(150) NOT NULL UNIQUE,
+                types SET_TYPES NOT NULL,
+                subtypes VARCHAR(80),
+                supertypes SET_SUPERTYPES,
+                manaCost VARCHAR(50),
+                power DECIMAL(3,1),
+                toughness DECIMAL(3,1),
+                colors SET_COLORS,
+                cmc DECIMAL(8,1) NOT NULL,
+                orig_text TEXT
+            );
+            CREATE INDEX metacard_cmc ON metacard (cmc);
+            CREATE INDEX metacard_power ON metacard (power);
+            CREATE INDEX metacard_toughness ON metacard (toughness);
+        """
+
+    @classmethod
+    def add_range_indexes(cls) -> str:
+        """ command to index the columns searched by range """
+        return """
+            CREATE INDEX metacard_cmc ON metacard (cmc);
+            CREATE INDEX metacard_power ON metacard (power);
+            CREATE INDEX metacard_toughness ON metacard (toughness);
+        """
+
+    @classmethod
+    def insert(cls):
+        """ command to insert a metacard """
+        return """
+            INSERT INTO metacard (name, types, subtypes, supertypes, manaCost, power, toughness, colors, cmc, orig_text)
+            VALUES (
+                %(name)s, to_mask('types', %(types)s), %(subtypes)s, to_mask('supertypes', %(supertypes)s),
+                %(manaCost)s, %(power)s, %(toughness)s, to_mask('colors', %(colors)s), %(cmc)s, %(text)s
+            )
+            ON CONFLICT (name) DO UPDATE SET
+                types=excluded.types, subtypes=excluded.subtypes, supertypes=excluded.supertypes,
+                manaCost=excluded.manaCost, power=excluded.power, toughness=excluded.toughness,
+                colors=excluded.colors, cmc=excluded.cmc, orig_text=excluded.orig_text
+        """
+
+    @classmethod
+    def has_type(cls) -> str:
+        """ condition on the metacard's types starting with %(types)s """
+        return "to_members('types', metacard.types) LIKE %(types)s"
+
+    @classmethod
+    def has_supertype(cls) -> str:
+        """ condition on the metacard's supertypes being %(supertypes)s """
+        return "%(supertypes)s = to_members('supertypes', metacard.supertypes)"
+
+
+class Card(sql.Card):
+    """
+    SQLite commands related to the Card model
+    """
+    @classmethod
+    def create_table(cls):
+        """ command to create the Card table """
+        return """
+            CREATE TABLE card (
+                card_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                multiverseid INT,
+                metacard_id INT NOT NULL,
+                name VARCHAR(150) NOT NULL,
+                edition VARCHAR(8) NOT NULL,
+                rarity SET_VALUE NOT NULL {rarities},
+                number VARCHAR(4) NOT NULL,
+                artist VARCHAR(150) NOT NULL,
+                flavor TEXT,
+                price DECIMAL(7,2),
+
+                FOREIGN KEY (metacard_id) REFERENCES metacard(metacard_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                FOREIGN KEY (edition) REFERENCES edition(code) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                UNIQUE (multiverseid, edition, number)
+            );
+            CREATE INDEX card_name ON card (name);
+            CREATE INDEX card_metacard_id ON card (metacard_id);
+            CREATE INDEX card_edition ON card (edition, rarity, number);
+        """.format(rarities=check_in("rarity", rarities))
+
+    @classmethod
+    def add_search_index(cls) -> str:
+        """ command to index cards by edition, rarity and number """
+        return """ CREATE INDEX card_edition ON card (edition, rarity, number) """
+
+    @classmethod
+    def insert(cls):
+        """ command to insert a card """
+        return """
+            INSERT INTO card (multiverseid, metacard_id, name, number, rarity, edition, artist, flavor)
+            VALUES (
+                %(multiverseid)s, (SELECT metacard_id FROM metacard WHERE name = %(name)s), %(name)s, %(number)s,
+                %(rarity)s, %(edition)s, %(artist)s, %(flavor)s
+            )
+            ON CONFLICT (multiverseid, edition, number) DO UPDATE SET
+                rarity=excluded.rarity, edition=excluded.edition, artist=excluded.artist, flavor=excluded.flavor
+        """
+
+
+class Edition(sql.Edition):
+    """
+    SQLite commands related to the Edition model
+    """
+    @classmethod
+    def create_table(cls):
+        """ command to create the table for Edition """
+        return """
+            CREATE TABLE edition (
+                code VARCHAR(8) PRIMARY KEY NOT NULL,
+                releaseDate DATE NOT NULL,
+                name VARCHAR(255) UNIQUE NOT NULL,
+                type VARCHAR(20) NOT NULL {types},
+                block VARCHAR(50)
+            );
+            CREATE INDEX edition_block ON edition (block);
+        """.format(types=check_in("type", edition_types))
+
+    @classmethod
+    def add_block_index(cls) -> str:
+        """ command to index editions by block """
+        return """ CREATE INDEX edition_block ON edition (block) """
+
+    @classmethod
+    def insert(cls) -> str:
+        """ command to insert an edition """
+        return """
+            INSERT INTO edition (code, releaseDate, name, type, block)
+            VALUES (%(code)s, %(releaseDate)s, %(name)s, %(type)s, %(block)s)
+            ON CONFLICT (code) DO UPDATE SET
+                releaseDate=excluded.releaseDate, type=excluded.type
+        """
+
+
+class Format(sql.Format):
+    """
+    SQLite commands related to the Format model
+    """
+    @classmethod
+    def create_table(cls):
+        """ command to create the format table """
+        return """
+            CREATE TABLE format (
+                format_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(150) NOT NULL UNIQUE
+            )
+        """
+
+    @classmethod
+    def insert(cls):
+        """ command to insert a format """
+        return """
+            INSERT INTO format (name)
+            VALUES (%(name)s)
+            ON CONFLICT (name) DO NOTHING
+        """
+
+
+class CardInCollection(sql.CardInCollection):
+    """
+    SQLite commands related to the collection table
+    """
+    @classmethod
+    def insert_by_id(cls):
+        """ command to insert a new card in collection """
+        return """
+            INSERT INTO card_in_collection (user_id, card_id, normal, foil)
+            VALUES (%(user_id)s, %(card_id)s, %(normal)s, %(foil)s)
+            ON CONFLICT (user_id, card_id) DO UPDATE SET normal=excluded.normal, foil=excluded.foil
+        """
+
+    @classmethod
+    def create_import_table(cls):
+        """ command to create the temporary table in which uploaded cards are staged before being resolved """
+        return """
+            CREATE TEMPORARY TABLE IF NOT EXISTS collection_import (
+                name VARCHAR(150) NOT NULL,
+                edition VARCHAR(8) NOT NULL,
+                number VARCHAR(4) NOT NULL,
+                normal INT UNSIGNED NOT NULL DEFAULT 0,
+                foil INT UNSIGNED NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS temp.collection_import_card ON collection_import (name, edition, number);
+        """
+
+    @classmethod
+    def drop_import_table(cls):
+        """ command to remove the temporary import table """
+        return """ DROP TABLE IF EXISTS temp.collection_import """
+
+    @classmethod
+    def merge_import(cls):
+        """ resolve all staged cards to their ids and set their quantities in the user's collection """
+        return """
+            INSERT INTO card_in_collection (user_id, card_id, normal, foil)
+            SELECT %(user_id)s, card.card_id, SUM(collection_import.normal), SUM(collection_import.foil)
+            FROM collection_import
+            INNER JOIN card
+                ON card.name = collection_import.name
+                    AND card.edition = collection_import.edition
+                    AND card.number = collection_import.number
+            WHERE true
+            GROUP BY card.card_id
+            ON CONFLICT (user_id, card_id) DO UPDATE SET normal=excluded.normal, foil=excluded.foil
+        """
+
+
+class Deck(sql.Deck):
+    """
+    SQLite commands related to the DeckList model
+    """
+    @classmethod
+    def create_table(cls):
+        """ command to create the deck """
+        return """
+            CREATE TABLE deck (
+                deck_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INT NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                user_index INT DEFAULT 0 NOT NULL,
+
+                FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+                UNIQUE(user_id, name)
+            )
+        """
+
+
+class DeckSummary(sql.DeckSummary):
+    """
+    SQLite commands to handle the summary of each deck, kept up to date by triggers
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the deck summary table. colors is a bitmask with the same values as metacard.colors """
+        return """
+            CREATE TABLE deck_summary (
+                deck_id INT PRIMARY KEY,
+                user_id INT NOT NULL,
+                n_deck INT UNSIGNED NOT NULL DEFAULT 0,
+                n_side INT UNSIGNED NOT NULL DEFAULT 0,
+                colors TINYINT UNSIGNED NOT NULL DEFAULT 0,
+                revision INT UNSIGNED NOT NULL DEFAULT 0,
+
+                FOREIGN KEY (deck_id) REFERENCES deck(deck_id) ON DELETE CASCADE ON UPDATE CASCADE
+            );
+            CREATE INDEX deck_summary_user_id ON deck_summary (user_id);
+        """
+
+    colors_mask = "metacard.colors"
+
+    @classmethod
+    def refresh(cls, selection: str="WHERE true") -> str:
+        """
+        command to recompute the summary of the decks matching the given selection
+
+        :param selection: WHERE clause on the deck table
+        """
+        return """
+            INSERT INTO deck_summary (deck_id, user_id, n_deck, n_side, colors)
+            SELECT deck.deck_id, deck.user_id,
+                (SELECT IFNULL(SUM(number), 0) FROM card_in_deck WHERE card_in_deck.deck_id = deck.deck_id),
+                (SELECT IFNULL(SUM(number), 0) FROM card_in_side WHERE card_in_side.deck_id = deck.deck_id),
+                {colors}
+            FROM deck
+            {selection}
+            ON CONFLICT (deck_id) DO UPDATE SET
+                n_deck=excluded.n_deck, n_side=excluded.n_side, colors=excluded.colors, revision=revision + 1
+        """.format(colors=cls.deck_colors("deck.deck_id"), selection=selection)
+
+    @classmethod
+    def content_triggers(cls) -> typing.List[str]:
+        """ triggers keeping the summary up to date with the decks' content """
+        return [
+            """
+                CREATE TRIGGER deck_summary_on_{table}_{name} AFTER {event} ON {table}
+                FOR EACH ROW BEGIN
+                    {statement};
+                END
+            """.format(table=table, name=event.lower(), event=event, statement=statement)
+            for table, event, statement in cls.content_changes()
+        ]
+
+    @classmethod
+    def triggers(cls) -> typing.List[str]:
+        """ triggers creating the summary of new decks and keeping it up to date """
+        return [
+            """
+                CREATE TRIGGER deck_summary_on_deck_insert AFTER INSERT ON deck
+                FOR EACH ROW BEGIN
+                    INSERT INTO deck_summary (deck_id, user_id) VALUES (NEW.deck_id, NEW.user_id);
+                END
+            """
+        ] + cls.content_triggers()
+
+
+class DeckCardNeed(sql.DeckCardNeed):
+    """
+    SQLite commands to handle the number of copies of each card needed by each deck and owned by the deck's owner,
+    kept up to date by triggers
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table of needed cards """
+        return """
+            CREATE TABLE deck_card_need (
+                deck_id INT NOT NULL,
+                card_id INT NOT NULL,
+                user_id INT NOT NULL,
+                needed INT UNSIGNED NOT NULL DEFAULT 0,
+                owned INT UNSIGNED NOT NULL DEFAULT 0,
+
+                FOREIGN KEY (deck_id) REFERENCES deck(deck_id) ON DELETE CASCADE ON UPDATE CASCADE,
+                PRIMARY KEY (deck_id, card_id)
+            );
+            CREATE INDEX deck_card_need_user_card ON deck_card_need (user_id, card_id);
+        """
+
+    @classmethod
+    def populate(cls) -> str:
+        """ command to compute the needed cards of all existing decks """
+        return """
+            INSERT INTO deck_card_need (deck_id, card_id, user_id, needed, owned)
+            SELECT deck.deck_id, entity.card_id, deck.user_id, SUM(entity.number),
+                IFNULL(MAX(card_in_collection.normal + card_in_collection.foil), 0)
+            FROM (
+                SELECT deck_id, card_id, number FROM card_in_deck
+                UNION ALL SELECT deck_id, card_id, number FROM card_in_side
+            ) AS entity
+            INNER JOIN deck ON deck.deck_id = entity.deck_id
+            LEFT JOIN card_in_collection
+                ON card_in_collection.user_id = deck.user_id AND card_in_collection.card_id = entity.card_id
+            WHERE true
+            GROUP BY deck.deck_id, entity.card_id, deck.user_id
+            ON CONFLICT (deck_id, card_id) DO UPDATE SET needed=excluded.needed, owned=excluded.owned
+        """
+
+    @classmethod
+    def refresh(cls, deck_id: str, card_id: str) -> str:
+        """
+        commands to recompute the needed and owned numbers of a card in a deck
+
+        :param deck_id: expression giving the id of the deck
+        :param card_id: expression giving the id of the card
+        """
+        return """
+            INSERT INTO deck_card_need (deck_id, card_id, user_id, needed, owned)
+            SELECT deck.deck_id, {card_id}, deck.user_id,
+                (
+                    SELECT IFNULL(SUM(number), 0) FROM card_in_deck
+                    WHERE deck_id = {deck_id} AND card_id = {card_id}
+                ) + (
+                    SELECT IFNULL(SUM(number), 0) FROM card_in_side
+                    WHERE deck_id = {deck_id} AND card_id = {card_id}
+                ),
+                IFNULL((
+                    SELECT normal + foil FROM card_in_collection
+                    WHERE user_id = deck.user_id AND card_id = {card_id}
+                ), 0)
+            FROM deck
+            WHERE deck.deck_id = {deck_id}
+            ON CONFLICT (deck_id, card_id) DO UPDATE SET needed=excluded.needed, owned=excluded.owned;
+
+            DELETE FROM deck_card_need WHERE deck_id = {deck_id} AND card_id = {card_id} AND needed = 0;
+        """.format(deck_id=deck_id, card_id=card_id)
+
+    @classmethod
+    def triggers(cls) -> typing.List[str]:
+        """ triggers keeping the needed and owned numbers up to date """
+        commands = []
+        for table in "card_in_deck", "card_in_side":
+            for event, row in ("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"):
+                commands.append("""
+                    CREATE TRIGGER deck_card_need_on_{table}_{event} AFTER {event} ON {table}
+                    FOR EACH ROW BEGIN
+                        {refresh}
+                    END
+                """.format(
+                    table=table, event=event.lower(),
+                    refresh=cls.refresh("{}.deck_id".format(row), "{}.card_id".format(row))
+                ))
+        owned_after = "NEW.normal + NEW.foil"
+        for event, row, owned in ("INSERT", "NEW", owned_after), ("UPDATE", "NEW", owned_after), ("DELETE", "OLD", "0"):
+            commands.append("""
+                CREATE TRIGGER deck_card_need_on_card_in_collection_{event} AFTER {event} ON card_in_collection
+                FOR EACH ROW BEGIN
+                    UPDATE deck_card_need SET owned = {owned}
+                    WHERE user_id = {row}.user_id AND card_id = {row}.card_id;
+                END
+            """.format(event=event.lower(), owned=owned, row=row))
+        return commands
+
+
+# noinspection SqlResolve
+class CardInDeckEntity(sql.CardInDeckEntity):
+    """
+    Abstract helper for cardsInDeck and cardsInSide
+    """
+    # noinspection SqlInsertValues
+    @classmethod
+    def add(mcs) -> str:
+        """ add a card to a deck """
+        return """
+            INSERT INTO {table_name} (deck_id, card_id, number)
+            SELECT deck_id, %(card_id)s, %(number)s
+            FROM deck
+            WHERE user_id = %(user_id)s AND deck.name = %(deck_name)s
+            ON CONFLICT (deck_id, card_id) DO UPDATE SET number=excluded.number
+        """.format(table_name=mcs.table_name())
+
+
+class CardInDeck(CardInDeckEntity):
+    """
+    SQLite commands to handle adding and removing cards in a deck
+    """
+    @classmethod
+    def table_name(mcs) -> str:
+        """ the table name """
+        return "card_in_deck"
+
+
+class CardInSide(CardInDeckEntity):
+    """
+    SQLite commands to handle adding and removing cards in a side deck
+    """
+    @classmethod
+    def table_name(mcs) -> str:
+        """ the table name """
+        return "card_in_side"
+
+
+class LegalInFormat(sql.LegalInFormat):
+    """
+    SQLite commands to handle which formats which card is available in
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table """
+        return """
+            CREATE TABLE card_legal_in_format (
+                metacard_id INT NOT NULL,
+                format_id INT NOT NULL,
+                type SET_VALUE NOT NULL {legalities},
+
+                FOREIGN KEY (metacard_id) REFERENCES metacard(metacard_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                FOREIGN KEY (format_id) REFERENCES format(format_id) ON DELETE RESTRICT ON UPDATE RESTRICT,
+                PRIMARY KEY (metacard_id, format_id)
+            )
+        """.format(legalities=check_in("type", legalities))
+
+    @classmethod
+    def insert(cls) -> str:
+        """ command to make a card valid in a format """
+        return """
+            INSERT INTO card_legal_in_format (metacard_id, format_id, type)
+            VALUES (
+                (SELECT metacard_id FROM metacard WHERE name = %(card_name)s),
+                (SELECT format_id FROM format WHERE name = %(format)s),
+                %(type)s
+            )
+            ON CONFLICT (metacard_id, format_id) DO UPDATE SET type=excluded.type
+        """
+
+
+class FormatLegality(sql.FormatLegality):
+    """
+    SQLite commands to store the legality matrix : for each format, bitsets of the cards legal and restricted in it,
+    indexed by the cards' ordinal
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table of bitsets """
+        return """
+            CREATE TABLE legality_format (
+                format_id INT PRIMARY KEY,
+                name VARCHAR(150) NOT NULL UNIQUE,
+                legal BLOB NOT NULL,
+                restricted BLOB NOT NULL,
+
+                FOREIGN KEY (name) REFERENCES format(name) ON DELETE CASCADE ON UPDATE CASCADE
+            )
+        """
+
+
+class Migration(sql.Migration):
+    """
+    SQLite commands to keep track of the schema's version. Databases are created at the current schema, SQLite
+    databases being younger than every migration
+    """
+    @classmethod
+    def create_table(cls) -> str:
+        """ command to create the table holding the schema version of each model """
+        return """
+            CREATE TABLE schema_migration (
+                model VARCHAR(64) PRIMARY KEY,
+                version INT UNSIGNED NOT NULL,
+                applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """
+
+    @classmethod
+    def set_version(cls) -> str:
+        """ command to set the schema version of a model """
+        return """
+            INSERT INTO schema_migration (model, version)
+            VALUES (%(model)s, %(version)s)
+            ON CONFLICT (model) DO UPDATE SET version=excluded.version, applied=CURRENT_TIMESTAMP
+        """
+
+    @classmethod
+    def online(cls, command: str) -> str:
+        """
+        SQLite has no online alteration, tables being locked by any write
+
+        :param command: ALTER TABLE command
+        :return: the command, unchanged
+        """
+        return command
+
+    @classmethod
+    def refused_online(cls, command: str, exc: Exception) -> bool:
+        """
+        Commands are never run online
+
+        :param command: the failed command
+        :param exc: the error raised by the command
+        :return: False
+        """
+        return False
@@ -19,3 +19,15 @@ class DataManipulationException(Exception):
     def __init__(self, error):
         super().__init__()
         self.error = error
+
+
+class UpdateCancelledException(Exception):
+    """
+    Exception raised inside a database update when an administrator asked for it to be cancelled
+    """
+
+
+class ServerBusyException(Exception):
+    """
+    Exception raised when the server refuses to run an expensive operation because too many are already waiting
+    """
@@ -11,6 +11,7 @@ from wtforms import StringField, IntegerField, PasswordField, TextAreaField, Boo
 from wtforms.fields.html5 import EmailField
 from wtforms.validators import DataRequired, NumberRange, InputRequired
 
+from lib.exceptions import ServerBusyException
 from lib.forms.fields import StartSeparatorField, StopSeparatorField, SliderField, MultiCheckboxField
 from lib.forms.validators import validate_port, validate_host
 from lib.models import Metacard, Edition, Format, Card, User
@@ -87,7 +88,13 @@ class LoginForm(Form):
             self.username.errors.append("Unknown username")
             return False
 
-        if not user.check_password(self.password.data):
+        try:
+            valid_password = user.check_password(self.password.data)
+        except ServerBusyException:
+            self.password.errors.append("The server is busy, please try again in a moment")
+            return False
+
+        if not valid_password:
             self.password.errors.append("Invalid Password")
             return False
 
@@ -5,6 +5,8 @@
 Custom JSON operations
 """
 
+import json
+import zlib
 from decimal import Decimal
 
 import typing
@@ -40,35 +42,284 @@ class CustomJSONEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
-def deck_parser(parsed_dict: typing.Dict):
+class JSONStreamReader:
     """
-    try to convert a dictionary into a deck
+    Reads a json document incrementally from a text stream, keeping only a small buffer in memory.
 
-    :param parsed_dict: dictionary to parse
-    :return: a new CardInDeck object
+    Objects and arrays can be walked item by item with iter_object and iter_array, and small values read at once with
+    read_value
+
+    :param stream: text stream to read from
+    :param buffer_size: number of characters to read at once
     """
-    # CardInDeck (or Side)
-    if set(parsed_dict.keys()) == {"name", "edition", "number", "ed_number"}:
-        return CardInDeck(**parsed_dict)
-    # this is the list of decks
-    elif set(parsed_dict.keys()) == {"main", "side", "name"}:
-        return parsed_dict
-    else:
-        raise JSONDecodeError("Unknown set of keys : {}".format(parsed_dict.keys()))
+    def __init__(self, stream: typing.TextIO, buffer_size: int=65536):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def __fill(self) -> bool:
+        """
+        reads more data from the stream, dropping what was already consumed
+
+        :return: whether new data was read
+        """
+        if self.eof:
+            return False
+        data = self.stream.read(self.buffer_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        skips whitespaces and returns the next character without consuming it
+
+        :return: the next character, or an empty string at the end of the document
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\n\r":
+                self.position += 1
+            if self.position < len(self.buffer) or not self.__fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, character: str) -> None:
+        """
+        consumes the given character
+
+        :param character: the character that must come next in the document
+        """
+        found = self.peek()
+        if found != character:
+            raise JSONDecodeError("Expected '{}' but got '{}' at position {}".format(character, found, self.position))
+        self.position += 1
+
+    def read_value(self) -> typing.Any:
+        """ reads a complete json value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError as exc:
+                if not self.__fill():
+                    raise JSONDecodeError("Invalid json : {}".format(exc))
+            else:
+                # a number at the end of the buffer might continue in the data not read yet
+                if end < len(self.buffer) or not self.__fill():
+                    self.position = end
+                    return value
+
+    def iter_array(self) -> typing.Iterator[None]:
+        """ walks through an array, yielding once for each item, which has to be consumed before continuing """
+        self.expect("[")
+        first = True
+        while self.peek() != "]":
+            if not first:
+                self.expect(",")
+            first = False
+            yield
+        self.expect("]")
+
+    def iter_object(self) -> typing.Iterator[str]:
+        """ walks through an object, yielding each key. The corresponding value has to be consumed before continuing """
+        self.expect("{")
+        first = True
+        while self.peek() != "}":
+            if not first:
+                self.expect(",")
+            first = False
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise JSONDecodeError("Object keys must be strings, got {}".format(key))
+            self.expect(":")
+            yield key
+        self.expect("}")
+
+
+def validate_card_in_collection(data: typing.Any) -> CardInCollection:
+    """
+    Validates a card of the collection
+
+    :param data: json value to validate
+    :return: the corresponding CardInCollection
+    """
+    if not isinstance(data, dict) or set(data.keys()) != {"number", "name", "edition", "normal", "foil"}:
+        raise JSONDecodeError("Invalid card in collection : {}".format(data))
+    for quantity in ("normal", "foil"):
+        if not isinstance(data[quantity], int) or data[quantity] < 0:
+            raise JSONDecodeError("Invalid number of {} cards : {}".format(quantity, data))
+    return CardInCollection(**data)
+
+
+def validate_card_in_deck(data: typing.Any) -> CardInDeck:
+    """
+    Validates a card of a deck or side deck
+
+    :param data: json value to validate
+    :return: the corresponding CardInDeck
+    """
+    if not isinstance(data, dict) or set(data.keys()) != {"name", "edition", "number", "ed_number"}:
+        raise JSONDecodeError("Invalid card in deck : {}".format(data))
+    if not isinstance(data["number"], int) or data["number"] <= 0:
+        raise JSONDecodeError("Invalid number of cards : {}".format(data))
+    return CardInDeck(**data)
+
+
+def parse_deck(reader: JSONStreamReader) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Parses a deck incrementally
+
+    Cards are yielded as soon as they are read when the deck's name comes first, as it does in exported files.
+    Otherwise, they are kept until the name is found
+
+    :param reader: reader positioned at the start of the deck
+    :return: iterator of ("deck", name), ("main", CardInDeck) and ("side", CardInDeck) entries
+    """
+    name = None
+    pending = []
+    keys = set()
+
+    for key in reader.iter_object():
+        keys.add(key)
+        if key == "name":
+            name = reader.read_value()
+            if not isinstance(name, str):
+                raise JSONDecodeError("Invalid deck name : {}".format(name))
+            yield "deck", name
+            yield from pending
+            pending = []
+        elif key in ("main", "side"):
+            for _ in reader.iter_array():
+                entry = key, validate_card_in_deck(reader.read_value())
+                if name is None:
+                    pending.append(entry)
+                else:
+                    yield entry
+        else:
+            raise JSONDecodeError("Unknown key in deck : {}".format(key))
+
+    if keys != {"name", "main", "side"}:
+        raise JSONDecodeError("Invalid deck, got keys {}".format(keys))
+
+
+def parse_collection(reader: JSONStreamReader) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Parses a collection incrementally, validating each entry as it is read
+
+    :param reader: reader positioned at the start of the collection
+    :return: iterator of ("collection", CardInCollection) entries and of the entries of each deck, as parse_deck
+    """
+    for key in reader.iter_object():
+        if key == "collection":
+            for _ in reader.iter_array():
+                yield "collection", validate_card_in_collection(reader.read_value())
+        elif key == "decks":
+            for _ in reader.iter_array():
+                yield from parse_deck(reader)
+        else:
+            raise JSONDecodeError("Unknown key in collection : {}".format(key))
+
+
+def read_deck(stream: typing.TextIO, buffer_size: int=65536) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Reads and validates an uploaded deck incrementally
+
+    :param stream: text stream containing the deck
+    :param buffer_size: number of characters to read at once
+    :return: iterator over the deck's entries, as parse_deck
+    """
+    reader = JSONStreamReader(stream, buffer_size)
+    yield from parse_deck(reader)
+    if reader.peek() != "":
+        raise JSONDecodeError("Unexpected data after the end of the deck")
+
+
+def read_collection(stream: typing.TextIO, buffer_size: int=65536) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Reads and validates an uploaded collection incrementally
+
+    :param stream: text stream containing the collection
+    :param buffer_size: number of characters to read at once
+    :return: iterator over the collection's entries, as parse_collection
+    """
+    reader = JSONStreamReader(stream, buffer_size)
+    yield from parse_collection(reader)
+    if reader.peek() != "":
+        raise JSONDecodeError("Unexpected data after the end of the collection")
+
+
+def stream_collection(entries: typing.Iterable[typing.Tuple[str, typing.Any]], chunk_size: int=65536)\
+        -> typing.Iterator[str]:
+    """
+    Writes the user's collection as json, incrementally, in the format read back by read_collection.
+
+    Entries are encoded one at a time with CustomJSONEncoder and joined with the brackets and keys of the document as
+    they come, decks first and the collection's cards last, so that the whole document is never held in memory
+
+    :param entries: entries of the collection, as given by Collection.iter_export
+    :param chunk_size: approximate size of the chunks to produce
+    :return: iterator over the json document's chunks
+    """
+    buffer = ['{"decks": [']
+    buffered = 0
+    section = None
+    first = True
+
+    def close_deck():
+        """ closes the deck being written """
+        return '], "side": []}' if section == "main" else "]}"
+
+    for kind, value in entries:
+        if kind == "deck":
+            if section is not None:
+                buffer.append(close_deck() + ", ")
+            buffer.append('{{"name": {}, "main": ['.format(json.dumps(value)))
+            section, first = "main", True
+            continue
+
+        if kind != section:
+            if kind == "side":
+                buffer.append('], "side": [')
+            else:  # the collection starts
+                if section is not None:
+                    buffer.append(close_deck())
+                buffer.append('], "collection": [')
+            section, first = kind, True
+
+        if not first:
+            buffer.append(", ")
+        first = False
+        entry = json.dumps(value, cls=CustomJSONEncoder)
+        buffer.append(entry)
+        buffered += len(entry)
+
+        if buffered >= chunk_size:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+
+    if section in ("main", "side"):
+        buffer.append(close_deck())
+    if section != "collection":
+        buffer.append('], "collection": [')
+    buffer.append("]}")
+    yield "".join(buffer)
 
 
-def collection_json_parser(parsed_dict: typing.Dict):
+def gzip_stream(chunks: typing.Iterable[str]) -> typing.Iterator[bytes]:
     """
-    Try to parse the user's collection
+    Compresses the given text chunks with gzip, as they come
 
-    :param parsed_dict: dictionary to parse
-    :return: user's collection
+    :param chunks: text to compress
+    :return: iterator over the compressed data
     """
-    # CardInCollection
-    if set(parsed_dict.keys()) == {"number", "name", "edition", "normal", "foil"}:
-        return CardInCollection(**parsed_dict)
-    # the deck is parsed
-    elif set(parsed_dict.keys()) == {"collection", "decks"}:
-        return parsed_dict
-    else:
-        return deck_parser(parsed_dict)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
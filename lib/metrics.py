@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Metrics registry, exposed in Prometheus' text format.
+
+Metrics are kept by each process. Values computed on demand, as the status of the last database update, are given by
+collectors called at exposition time.
+
+When the application is served by several worker processes, a scrape only reaches one of them. The samples of the
+application's registry are therefore labelled with the pid of the worker exposing them, so that the series of each
+worker are kept apart instead of seeming to jump from one worker's values to another's. Queries aggregate them, with
+`sum without (worker)` for counters, and the series of a replaced worker simply end.
+"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import typing
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+def format_labels(labels: Labels) -> str:
+    """
+    Formats labels for the exposition
+
+    :param labels: pairs of label name and value
+    :return: the labels between braces, or an empty string if there are none
+    """
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    ))
+
+
+def format_value(value: float) -> str:
+    """
+    Formats a sample's value for the exposition
+
+    :param value: value to format
+    :return: the value as Prometheus reads it
+    """
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    Base class for metrics, holding one value per combination of labels
+
+    :param name: name of the metric
+    :param documentation: help text of the metric
+    :param label_names: names of the labels the metric's values are split by
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: typing.Sequence[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = OrderedDict()  # type: typing.Dict[Labels, typing.Any]
+        self._lock = threading.Lock()
+
+    def _labels(self, labels: typing.Dict[str, str]) -> Labels:
+        """
+        Orders the given labels as declared
+
+        :param labels: values of the labels, by name
+        :return: pairs of label name and value
+        """
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.label_names, tuple(labels)))
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, Labels, float]]:
+        """ The samples of the metric, as suffixed name, labels and value """
+        with self._lock:
+            for labels, value in self._values.items():
+                yield self.name, labels, value
+
+    def expose(self, constant_labels: Labels=()) -> str:
+        """
+        The metric in Prometheus' text format
+
+        :param constant_labels: labels added to all samples
+        :return: the help, type and samples of the metric
+        """
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        lines.extend(
+            "{}{} {}".format(name, format_labels(constant_labels + labels), format_value(value))
+            for name, labels, value in self.samples()
+        )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up
+    """
+    type = "counter"
+
+    def inc(self, amount: float=1, **labels: str) -> None:
+        """
+        Increases the counter
+
+        :param amount: how much to add
+        :param labels: values of the labels
+        """
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down
+    """
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """
+        Sets the gauge's value
+
+        :param value: the new value
+        :param labels: values of the labels
+        """
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted in cumulative buckets
+
+    :param buckets: upper bounds of the buckets, +Inf is always added
+    """
+    type = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, label_names: typing.Sequence[str]=(),
+                 buckets: typing.Sequence[float]=default_buckets):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Records a value
+
+        :param value: the observed value
+        :param labels: values of the labels
+        """
+        key = self._labels(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, Labels, float]]:
+        """ The buckets, sum and count of each combination of labels """
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + "_bucket", labels + (("le", format_value(bound)),), count
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, counts[-1]
+
+
+class Registry:
+    """
+    Set of metrics of the process. Metrics are created on first use and shared by name afterwards
+
+    :param worker_label: whether to label all samples with the pid of the process exposing them
+    """
+    def __init__(self, worker_label: bool=False):
+        self.worker_label = worker_label
+        self.__metrics = OrderedDict()  # type: typing.Dict[str, Metric]
+        self.__collectors = OrderedDict()  # type: typing.Dict[str, typing.Callable[[], typing.Iterable[Metric]]]
+        self.__lock = threading.Lock()
+
+    def __get(self, metric_class: type, name: str, *args, **kwargs) -> typing.Any:
+        """
+        Gets the metric with the given name, creating it if needed
+
+        :param metric_class: class of the metric
+        :param name: name of the metric
+        :return: the metric
+        """
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError("{} is already registered as a {}".format(name, metric.type))
+            return metric
+
+    def counter(self, name: str, documentation: str, label_names: typing.Sequence[str]=()) -> Counter:
+        """ Gets or creates a counter, see Counter """
+        return self.__get(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: typing.Sequence[str]=()) -> Gauge:
+        """ Gets or creates a gauge, see Gauge """
+        return self.__get(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: typing.Sequence[str]=(),
+                  buckets: typing.Sequence[float]=Histogram.default_buckets) -> Histogram:
+        """ Gets or creates a histogram, see Histogram """
+        return self.__get(Histogram, name, documentation, label_names, buckets)
+
+    def add_collector(self, name: str, collector: typing.Callable[[], typing.Iterable[Metric]]) -> None:
+        """
+        Adds a function giving metrics computed at exposition time, replacing the one previously added with this name
+
+        :param name: name of the collector
+        :param collector: function returning the metrics to expose
+        """
+        with self.__lock:
+            self.__collectors[name] = collector
+
+    def expose(self) -> str:
+        """ All metrics in Prometheus' text format """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+            collectors = list(self.__collectors.values())
+        for collector in collectors:
+            metrics.extend(collector())
+        # the pid is taken at exposition time, the registry being created before the workers are forked
+        constant_labels = (("worker", str(os.getpid())),) if self.worker_label else ()
+        return "\n".join(metric.expose(constant_labels) for metric in metrics) + "\n"
+
+
+def cache_metrics(caches: typing.Dict[str, typing.Any]) -> typing.List[Metric]:
+    """
+    Metrics of the given caches
+
+    :param caches: lib.cache.TTLCache instances, by name
+    :return: the number of hits, misses and values of each cache
+    """
+    hits = Counter("mtgcollector_cache_hits_total", "Values found in the cache", ["cache"])
+    misses = Counter("mtgcollector_cache_misses_total", "Values missing or expired in the cache", ["cache"])
+    size = Gauge("mtgcollector_cache_size", "Values held by the cache", ["cache"])
+    for name, cache in caches.items():
+        hits.inc(cache.hits, cache=name)
+        misses.inc(cache.misses, cache=name)
+        size.set(len(cache), cache=name)
+    return [hits, misses, size]
+
+
+def executor_metrics(executors: typing.Dict[str, typing.Any]) -> typing.List[Metric]:
+    """
+    Metrics of the given thread pools
+
+    :param executors: lib.threading.BoundedExecutor instances, by name
+    :return: the number of tasks in and refused by each pool
+    """
+    tasks = Gauge("mtgcollector_pool_tasks", "Tasks running or waiting in the pool", ["pool"])
+    rejected = Counter("mtgcollector_pool_rejected_total", "Tasks refused because the pool was full", ["pool"])
+    for name, executor in executors.items():
+        tasks.set(executor.tasks, pool=name)
+        rejected.inc(executor.rejected, pool=name)
+    return [tasks, rejected]
+
+
+registry = Registry(worker_label=True)
@@ -6,6 +6,6 @@ Models for MtgCollector
 """
 
 from lib.models.base import Model
-from lib.models.resources import Edition, Metacard, Card, Format, LegalInFormat
-from lib.models.collection import Collection, Deck
+from lib.models.resources import Edition, Metacard, Card, Format, LegalInFormat, FormatLegality
+from lib.models.collection import Collection, Deck, DeckSummary, DeckCardNeed
 from lib.models.user import User
@@ -6,10 +6,13 @@ Abstract base classes for models
 """
 
 import abc
+import contextlib
 
 import flask
 import typing
 
+from lib.db.instrumentation import TimedCursor
+
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
 
@@ -20,6 +23,8 @@ class Model(metaclass=abc.ABCMeta):
     """
     index = 0
 
+    __transactions = set()  # connections on which modifications are committed at the end of a transaction block
+
     @classmethod
     @abc.abstractmethod
     def _table_creation_command(cls) -> str:
@@ -30,6 +35,20 @@ class Model(metaclass=abc.ABCMeta):
         """ list of triggers to add to the table """
         return []
 
+    @classmethod
+    def _migrations(cls) -> typing.List[typing.List[str]]:
+        """
+        Ordered migrations bringing the tables of this model, as created by older versions, to the current schema.
+        Each migration is a list of commands and is applied once, its position being the resulting schema version.
+        Commands can be steps checking the schema before running, see sql.Migration.for_each
+        """
+        return []
+
+    @classmethod
+    def migrations(cls) -> typing.List[typing.List[str]]:
+        """ Ordered migrations of this model, see _migrations """
+        return cls._migrations()
+
     @classmethod
     @abc.abstractmethod
     def _insertion_command(cls) -> str:
@@ -46,25 +65,31 @@ class Model(metaclass=abc.ABCMeta):
         """ This is a value that can uniquely identify any object (primary key) """
 
     @classmethod
-    def bulk_insert(cls, models: typing.Iterable, connection=None, **kwargs) -> None:
+    def bulk_insert(cls, models: typing.Iterable, connection=None,
+                    progress: typing.Callable[[int, int], None]=None, **kwargs) -> None:
         """
         Inserts many models into the database
 
         :param models: list of models to insert. They have to be all of the same type
         :param connection: the database connection to use. If None, will use flask.g.db
+        :param progress: called after each chunk with the number of models inserted and the total number of models.
+                        Raising from it aborts the insertion before anything is committed
         """
         chunk_size = 2500  # magic number for the size of the query. This works, no idea why
         if connection is None:
             connection = getattr(flask.g, "db")
-        cursor = connection.cursor()
         models = list(models)
         # noinspection PyArgumentList
         chunks = [models[i:i+chunk_size] for i in range(0, len(models), chunk_size)]
 
-        for chunk in chunks:
+        for index, chunk in enumerate(chunks):
             # noinspection PyProtectedMember
-            cursor.executemany(cls._insertion_command(), [dict(model._as_database_object, **kwargs) for model in chunk])
-        connection.commit()
+            cls.__execute(
+                cls._insertion_command(), connection, [dict(model._as_database_object, **kwargs) for model in chunk]
+            )
+            if progress is not None:
+                progress(min(len(models), (index + 1) * chunk_size), len(models))
+        cls.__commit(connection)
 
     @classmethod
     def _get(cls, command: str, connection=None, **kwargs) -> typing.List:
@@ -76,9 +101,27 @@ class Model(metaclass=abc.ABCMeta):
         :param kwargs: additional arguments to add to the prepared sql statement
         :return: all retrieved values
         """
-        cursor, _ = cls.__execute(command, connection, **kwargs)
+        cursor, _ = cls.__execute(command, connection, kwargs)
         return cursor.fetchall()
 
+    @classmethod
+    def _iterate(cls, command: str, connection=None, batch_size: int=500, **kwargs) -> typing.Iterator[typing.Dict]:
+        """
+        Retrieves data from the database row by row, without holding the whole result in memory.
+        The connection cannot be used for anything else until all rows are read
+
+        :param command: the sql command used to retrieve data
+        :param connection: the database connection to use. If None , will use flask.g.db
+        :param batch_size: number of rows to fetch at once from the server
+        :param kwargs: additional arguments to add to the prepared sql statement
+        :return: iterator over the retrieved values
+        """
+        cursor, _ = cls.__execute(command, connection, kwargs)
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(batch_size)
+
     @classmethod
     def setup_table(cls, connection=None) -> None:
         """
@@ -91,21 +134,61 @@ class Model(metaclass=abc.ABCMeta):
             cls.__execute(trigger, connection)
 
     @classmethod
-    def __execute(cls, command: str, connection=None, **kwargs):
+    def __execute(cls, command: str, connection=None, parameters: typing.Union[dict, list]=None):
         """
-        executes the given command on the database
+        executes the given command on the database. All statements of the models go through here, to be recorded in
+        the statistics of the queries
 
         :param command: MySQL command to execute
         :param connection: the connection to the database to use. If not provided will try to get flask.g.db
-        :param kwargs: parameters to give to the MySQL command
-        :return: the MySQL cursor and connection
+        :param parameters: parameters to give to the MySQL command, or a list of them to execute it once for each
+        :return: the MySQL cursor, timing the fetch of the results, and connection
         """
         if connection is None:
             connection = getattr(flask.g, "db")
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(command, kwargs)
+        cursor = TimedCursor(connection.cursor(dictionary=True))
+        if isinstance(parameters, list):
+            cursor.executemany(command, parameters)
+        else:
+            cursor.execute(command, parameters)
         return cursor, connection
 
+    @classmethod
+    def __commit(cls, connection) -> None:
+        """
+        commits the modifications made on the connection, unless they are part of a transaction block
+
+        :param connection: the connection to the database on which to commit
+        """
+        if connection not in cls.__transactions:
+            connection.commit()
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls, connection=None) -> typing.Iterator[None]:
+        """
+        Groups the modifications made by the models in the block in a single transaction, committed when the block
+        ends or rolled back if it raises. Blocks nested in a transaction are part of it
+
+        :param connection: the connection to the database to use. If not provided will try to get flask.g.db
+        """
+        if connection is None:
+            connection = getattr(flask.g, "db")
+        if connection in cls.__transactions:
+            yield
+            return
+
+        cls.__transactions.add(connection)
+        try:
+            yield
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            cls.__transactions.discard(connection)
+
     @classmethod
     def _modify(cls, command: str, connection=None, **kwargs) -> int:
         """
@@ -116,8 +199,8 @@ class Model(metaclass=abc.ABCMeta):
         :param kwargs: arguments to give to the MySQL command
         :return: the last row id affected by the command
         """
-        cursor, connection = cls.__execute(command, connection, **kwargs)
-        connection.commit()
+        cursor, connection = cls.__execute(command, connection, kwargs)
+        cls.__commit(connection)
         return cursor.lastrowid
 
     def __eq__(self, other) -> bool:
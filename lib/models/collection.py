@@ -5,14 +5,16 @@
 Models to handle collections
 """
 
-from collections import OrderedDict
+import re
+from collections import Counter, OrderedDict
 
-import mysql.connector.errors
 import typing
 
-from lib.db import sql
+from lib.cache import TTLCache
+from lib.db import commands as sql
 from lib.exceptions import DataManipulationException
 from lib.models import Model
+from lib.models.resources import FormatLegality
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
@@ -22,6 +24,23 @@ color_list = OrderedDict()
 for color, color_code in ("Red", "{R}"), ("Green", "{G}"), ("White", "{W}"), ("Blue", "{U}"), ("Black", "{B}"):
     color_list[color] = color_code
 
+mana_symbol = re.compile(r"{([^}]+)}")
+
+
+def count_pips(mana_cost: str) -> typing.Dict[str, int]:
+    """
+    Counts the colored mana symbols of a mana cost. Hybrid symbols count for each of their colors
+
+    :param mana_cost: mana cost, as {2}{W}{U/B}
+    :return: number of symbols of each color, by color name
+    """
+    pips = Counter()
+    for symbol in mana_symbol.findall(mana_cost or ""):
+        for color, color_code in color_list.items():
+            if color_code[1] in symbol.split("/"):
+                pips[color] += 1
+    return pips
+
 
 class CardInCollection(Model):
     index = 2
@@ -63,9 +82,49 @@ class CardInCollection(Model):
                     sql.CardInCollection.insert_by_id(), user_id=user_id, card_id=card_id, normal=n_normal, foil=n_foil
             )
 
+    @classmethod
+    def import_cards(cls, user_id: int, cards: typing.Iterable) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Imports many cards in the user's collection at once.
+
+        Cards are staged in a temporary table and resolved to their ids with a single join, quantities of cards
+        already in the collection are replaced
+
+        :param user_id: user owning the cards
+        :param cards: CardInCollection instances to import
+        :return: cards that could not be found in the database
+        """
+        cls.start_import()
+        try:
+            cls.bulk_insert(cards)
+            return cls.finish_import(user_id)
+        finally:
+            cls.end_import()
+
+    @classmethod
+    def start_import(cls) -> None:
+        """ Prepares the staging table. Cards can then be staged in as many batches as needed with bulk_insert """
+        cls._modify(sql.CardInCollection.create_import_table())
+
+    @classmethod
+    def finish_import(cls, user_id: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Resolves all staged cards and sets their quantities in the user's collection
+
+        :param user_id: user owning the cards
+        :return: cards that could not be found in the database
+        """
+        cls._modify(sql.CardInCollection.merge_import(), user_id=user_id)
+        return cls._get(sql.CardInCollection.unresolved_import())
+
+    @classmethod
+    def end_import(cls) -> None:
+        """ Removes the staging table """
+        cls._modify(sql.CardInCollection.drop_import_table())
+
     @classmethod
     def _insertion_command(cls) -> str:
-        return sql.CardInCollection.insert()
+        return sql.CardInCollection.stage()
 
     @classmethod
     def _table_creation_command(cls) -> str:
@@ -95,7 +154,7 @@ class CardInDeck(Model):
         self.__number = number
 
     @classmethod
-    def sql_class(cls) -> sql.CardInDeckEntity:
+    def sql_class(cls) -> type:
         """ the sql commands to the given entity """
         return sql.CardInDeck
 
@@ -167,7 +226,7 @@ class CardInSideDeck(CardInDeck):
     index = 3
 
     @classmethod
-    def sql_class(cls) -> sql.CardInSide:
+    def sql_class(cls) -> type:
         """ gets the sql commands associated to this object """
         return sql.CardInSide
 
@@ -182,23 +241,56 @@ class Collection:
         self.user_id = user_id
         self.decks = Deck(self.user_id)
 
-    def export(self):
-        """ export the whole user's collection """
-        data = {
-            "decks": [self.decks.export(deck["name"]) for deck in self.decks.list()],
-            "collection": CardInCollection.export(self.user_id)
-        }
-        return data
+    def iter_export(self) -> typing.Iterator[typing.Tuple[str, typing.Dict]]:
+        """
+        export the whole user's collection in a single pass, without holding it in memory
 
-    def load(self, data: typing.Dict):
+        :return: iterator of ("deck", name), ("main", card), ("side", card) and ("collection", card) entries, with
+                 all entries of a deck following its name
         """
-        imports user's cards
+        for row in Deck._iterate(sql.Deck.export_all(), user_id=self.user_id):
+            if row["side"] is None:
+                yield "deck", row["deck_name"]
+            else:
+                yield "side" if row["side"] else "main", {
+                    "name": row["name"], "edition": row["edition"], "ed_number": row["ed_number"],
+                    "number": row["number"]
+                }
 
-        :param data: cards to import, json formatted
+        for row in CardInCollection._iterate(sql.CardInCollection.export(), user_id=self.user_id):
+            yield "collection", row
+
+    def load(self, entries: typing.Iterable[typing.Tuple[str, typing.Any]], batch_size: int=2500)\
+            -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        imports user's cards, sending them to the database in batches as they come. Nothing is saved if the entries
+        turn out to be invalid
+
+        :param entries: entries to import, as given by lib.json.read_collection
+        :param batch_size: number of cards to send to the database at once
+        :return: cards that could not be found in the database
         """
-        CardInCollection.bulk_insert(data.get("collection", []), user_id=self.user_id)
-        for deck in data.get("decks", []):
-            self.decks.load(deck)
+        deck_loader = Deck.Loader(self.decks, batch_size)
+        cards = []
+
+        CardInCollection.start_import()
+        try:
+            with Model.transaction():
+                for kind, value in entries:
+                    if kind == "collection":
+                        cards.append(value)
+                        if len(cards) >= batch_size:
+                            CardInCollection.bulk_insert(cards)
+                            cards = []
+                    else:
+                        deck_loader.add(kind, value)
+
+                deck_loader.flush()
+                CardInCollection.bulk_insert(cards)
+                return CardInCollection.finish_import(self.user_id)
+        finally:
+            # after the transaction, the removal of the table could otherwise be rolled back with it
+            CardInCollection.end_import()
 
     def add(self, card_id: int, data: typing.Dict):
         """
@@ -218,6 +310,44 @@ class Deck(Model):
     """
     index = 2
 
+    analytics_cache = TTLCache(max_size=256, ttl=3600)  # deck analytics, by deck id and revision
+
+    class Loader:
+        """
+        Saves decks given entry by entry into the database, sending their cards in batches
+
+        :param deck: deck model of the user owning the decks
+        :param batch_size: number of cards to send to the database at once
+        """
+        def __init__(self, deck, batch_size: int):
+            self.deck = deck
+            self.batch_size = batch_size
+            self.name = None  # type: str
+            self.cards = {"main": [], "side": []}
+
+        def add(self, kind: str, value: typing.Any) -> None:
+            """
+            Adds an entry
+
+            :param kind: "deck" to start a new deck named value, "main" or "side" to add the card value to it
+            :param value: deck name or card
+            """
+            if kind == "deck":
+                self.flush()
+                self.name = value
+                self.deck.add(value)
+            else:
+                self.cards[kind].append(value)
+                if len(self.cards[kind]) >= self.batch_size:
+                    self.flush()
+
+        def flush(self) -> None:
+            """ Sends the pending cards to the database """
+            for kind, model in ("main", CardInDeck), ("side", CardInSideDeck):
+                if self.cards[kind]:
+                    model.bulk_insert(self.cards[kind], deck_name=self.name, user_id=self.deck.user_id)
+                    self.cards[kind] = []
+
     def __init__(self, user_id: int):
         self.user_id = user_id
 
@@ -236,8 +366,11 @@ class Deck(Model):
         decks = self._get(sql.Deck.list(), user_id=self.user_id)
         for deck in decks:
             if deck["colors"]:
-                deck_colors = deck["colors"].split(",")
-                deck["colors"] = [color_list[color_] for color_ in color_list if color_ in deck_colors]
+                deck["colors"] = [
+                    color_code for bit, color_code in enumerate(color_list.values()) if deck["colors"] & 1 << bit
+                ]
+            else:
+                deck["colors"] = None
 
         return decks
 
@@ -248,7 +381,12 @@ class Deck(Model):
         :param name: name of the deck
         :return: the new created deck
         """
-        self._modify(sql.Deck.insert(), user_id=self.user_id, name=name)
+        try:
+            self._modify(sql.Deck.insert(), user_id=self.user_id, name=name)
+        except sql.Error as e:
+            if sql.Errors.duplicate_entry(e):
+                raise DataManipulationException("A deck named {} already exists".format(name))
+            raise
         return self._get(sql.Deck.get(), user_id=self.user_id, name=name)[0]
 
     def delete(self, name: str):
@@ -268,8 +406,8 @@ class Deck(Model):
         """
         try:
             self._modify(sql.Deck.rename(), user_id=self.user_id, name=name, new_name=new_name)
-        except mysql.connector.errors.IntegrityError as e:
-            if e.errno == 1062:
+        except sql.Error as e:
+            if sql.Errors.duplicate_entry(e):
                 raise DataManipulationException("Cannot give the same name to two different decks")
             raise
 
@@ -318,6 +456,94 @@ class Deck(Model):
             "missing": self._get(sql.Deck.get_missing(), user_id=self.user_id, deck_name=deck_name)
         }
 
+    def get_all_missing(self) -> typing.Dict[str, typing.List[typing.Dict[str, int]]]:
+        """
+        gets the cards missing from the user's collection for each of his decks
+
+        :return: the missing cards, by deck name
+        """
+        missing = OrderedDict()
+        for row in self._get(sql.Deck.get_all_missing(), user_id=self.user_id):
+            missing.setdefault(row["name"], []).append({"card_id": row["card_id"], "number": row["number"]})
+        return missing
+
+    def get_analytics(self, deck_name: str) -> typing.Union[typing.Dict, None]:
+        """
+        computes statistics about the given deck : mana curve, colored mana symbols and card types of the main deck,
+        and the deck's legality in each format.
+
+        Results are cached until the deck's content changes
+
+        :param deck_name: name of the deck
+        :return: the deck's statistics, or None if the deck does not exist
+        """
+        revision = self._get(sql.Deck.get_revision(), user_id=self.user_id, deck_name=deck_name)
+        if not revision:
+            return None
+
+        key = revision[0]["deck_id"], revision[0]["revision"]
+        analytics = self.analytics_cache.get(key)
+        if analytics is None:
+            analytics = self.__compute_analytics(revision[0]["deck_id"])
+            self.analytics_cache.set(key, analytics)
+        return analytics
+
+    def __compute_analytics(self, deck_id: int) -> typing.Dict:
+        """
+        computes the statistics of the given deck
+
+        :param deck_id: id of the deck
+        :return: the deck's statistics
+        """
+        curve, pips, types, copies = Counter(), Counter(), Counter(), Counter()
+        n_cards = n_spells = total_cmc = 0
+
+        for card in self._get(sql.Deck.get_analytics_cards(), deck_id=deck_id):
+            number = int(card["number"])
+            copies[card["name"]] += number
+            if card["side"]:
+                continue
+
+            n_cards += number
+            for card_type in card["types"]:
+                types[card_type] += number
+            if "Land" not in card["types"]:
+                curve[int(card["cmc"])] += number
+                n_spells += number
+                total_cmc += card["cmc"] * number
+            for color, count in count_pips(card["manaCost"]).items():
+                pips[color] += count * number
+
+        illegal = FormatLegality.get_matrix().illegal_cards(copies)
+
+        return {
+            "cards": n_cards,
+            "curve": {cmc: curve[cmc] for cmc in range(max(curve, default=0) + 1)},
+            "average_cmc": round(float(total_cmc) / n_spells, 2) if n_spells else 0,
+            "pips": {color: pips[color] for color in color_list},
+            "types": dict(types.most_common()),
+            "legality": {
+                format_name: {"legal": not names, "illegal": names} for format_name, names in illegal.items()
+            }
+        }
+
+    def get_legality(self, deck_name: str) -> typing.Union[typing.Dict[str, bool], None]:
+        """
+        checks the given deck against every format
+
+        :param deck_name: name of the deck
+        :return: whether the deck is legal, by format, or None if the deck does not exist
+        """
+        revision = self._get(sql.Deck.get_revision(), user_id=self.user_id, deck_name=deck_name)
+        if not revision:
+            return None
+
+        copies = {
+            row["name"]: int(row["number"])
+            for row in self._get(sql.Deck.count_by_name(), deck_id=revision[0]["deck_id"])
+        }
+        return FormatLegality.get_matrix().check(copies)
+
     def export(self, deck_name) -> typing.Dict:
         """
         exports all data necessary to allow the user to import the in another instance
@@ -331,15 +557,101 @@ class Deck(Model):
             "side": CardInSideDeck.export_cards(self.user_id, deck_name)
         }
 
-    def load(self, data: typing.Dict):
+    def load(self, entries: typing.Iterable[typing.Tuple[str, typing.Any]], batch_size: int=2500):
+        """
+        Saves the deck given into the database, sending its cards in batches as they come. Nothing is saved if the
+        entries turn out to be invalid
+
+        :param entries: entries of the deck, as given by lib.json.read_deck
+        :param batch_size: number of cards to send to the database at once
+        """
+        loader = self.Loader(self, batch_size)
+        with self.transaction():
+            for kind, value in entries:
+                loader.add(kind, value)
+            loader.flush()
+
+    def _primary_key(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
+
+    def _as_database_object(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
+
+
+class DeckSummary(Model):
+    """
+    Summary of each deck : number of cards in the deck and side deck, and colors. Kept up to date by triggers on the
+    decks' content, so that listing decks only reads the user's rows
+    """
+    index = 4
+
+    @classmethod
+    def _table_creation_command(cls) -> str:
+        """ table creation command """
+        return sql.DeckSummary.create_table()
+
+    @classmethod
+    def _triggers(cls) -> typing.List[str]:
+        """ triggers keeping the summary up to date """
+        return sql.DeckSummary.triggers()
+
+    @classmethod
+    def setup_table(cls, connection=None) -> None:
+        """
+        Creates the table and fills it for the decks that already exist
+
+        :param connection: the database connection to use. If None, will use flask.g.db
+        """
+        super().setup_table(connection=connection)
+        cls._modify(sql.DeckSummary.refresh(), connection=connection)
+
+    @classmethod
+    def _insertion_command(cls) -> str:
+        """ unused, the table is filled by triggers """
+        raise NotImplementedError()
+
+    def _primary_key(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
+
+    def _as_database_object(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
+
+
+class DeckCardNeed(Model):
+    """
+    Number of copies of each card needed by each deck, next to the number owned by the deck's owner. Kept up to date
+    by triggers on the decks and on the collection, so that missing cards are read without aggregating all decks
+    """
+    index = 4
+
+    @classmethod
+    def _table_creation_command(cls) -> str:
+        """ table creation command """
+        return sql.DeckCardNeed.create_table()
+
+    @classmethod
+    def _triggers(cls) -> typing.List[str]:
+        """ triggers keeping the table up to date """
+        return sql.DeckCardNeed.triggers()
+
+    @classmethod
+    def setup_table(cls, connection=None) -> None:
         """
-        Saves the deck given into the database
+        Creates the table and fills it for the decks that already exist
 
-        :param data: dictionary containing the deck
+        :param connection: the database connection to use. If None, will use flask.g.db
         """
-        self.add(data["name"])
-        CardInDeck.bulk_insert(data["main"], deck_name=data["name"], user_id=self.user_id)
-        CardInSideDeck.bulk_insert(data["side"], deck_name=data["name"], user_id=self.user_id)
+        super().setup_table(connection=connection)
+        cls._modify(sql.DeckCardNeed.populate(), connection=connection)
+
+    @classmethod
+    def _insertion_command(cls) -> str:
+        """ unused, the table is filled by triggers """
+        raise NotImplementedError()
 
     def _primary_key(self) -> typing.Dict:
         """ unused """
@@ -7,12 +7,16 @@ Models for resources external to our application
 
 import datetime
 import logging
+import os
 import shlex
+import time
+from collections import OrderedDict
 
 import flask
 import typing
 
-from lib.db import sql
+import lib
+from lib.db import commands as sql
 from lib.models import Model
 
 
@@ -37,6 +41,11 @@ class Edition(Model):
         self.__name = name
         self.__block = block
 
+    @classmethod
+    def _migrations(cls) -> typing.List[typing.List[str]]:
+        """ migrations of the edition table """
+        return [[sql.Migration.online(sql.Edition.add_block_index())]]
+
     @classmethod
     def _insertion_command(cls) -> str:
         """ The command used to insert an edition in the database """
@@ -119,6 +128,14 @@ class Metacard(Model):
         except ValueError:
             self.__toughness = -1
 
+    @classmethod
+    def _migrations(cls) -> typing.List[typing.List[str]]:
+        """ migrations of the metacard table and of the tables referencing it """
+        return [
+            sql.Migration.surrogate_keys(),
+            [sql.Migration.online(sql.Metacard.add_range_indexes())]
+        ]
+
     @classmethod
     def _table_creation_command(cls) -> str:
         """ The command to create the metacard table"""
@@ -266,8 +283,8 @@ class Metacard(Model):
             kwargs["artist"] = add_wildcard(artist)
 
         if in_collection:
-            having = ("HAVING (IFNULL(SUM(card_in_collection.normal), 0)"
-                      " + IFNULL(SUM(card_in_collection.foil), 0)) > 0")
+            # the aggregate is spelled out, SQLite resolving normal and foil to the collection's columns
+            having = "HAVING SUM(collection.normal + collection.foil) > 0"
 
         if edition:
             query_parameters = add_to_parameters(query_parameters, "card.edition = %(edition)s")
@@ -280,18 +297,18 @@ class Metacard(Model):
             kwargs["block"] = block
 
         if supertypes:
-            query_parameters = add_to_parameters(query_parameters, "%(supertypes)s IN (metacard.supertypes)")
+            query_parameters = add_to_parameters(query_parameters, sql.Metacard.has_supertype())
             kwargs["supertypes"] = supertypes
 
         if types:
-            query_parameters = add_to_parameters(query_parameters, "metacard.types LIKE %(types)s")
+            query_parameters = add_to_parameters(query_parameters, sql.Metacard.has_type())
             kwargs["types"] = types + "%"
 
         if format:
             query_parameters = add_to_parameters(
                     query_parameters,
-                    ("card.name IN (SELECT card_name FROM card_legal_in_format WHERE format = %(format)s"
-                        "AND type != 'Banned')")
+                    ("card.metacard_id IN (SELECT metacard_id FROM card_legal_in_format WHERE format_id = "
+                        "(SELECT format_id FROM format WHERE name = %(format)s) AND type != 'Banned')")
             )
             kwargs["format"] = format
 
@@ -343,7 +360,6 @@ class Metacard(Model):
         query_parameters = treat_range(query_parameters, cmc, "cmc")
 
         query = command.format(selection=query_parameters, order=order_by, having=having)
-        print(query % kwargs)
         return cls._get(query, **kwargs)
 
     @classmethod
@@ -394,6 +410,7 @@ class Card(Model):
     :param multiverseid: official card ID given by Wizards of The Coast, can be null for promotional cards
     """
     index = 1
+    gatherer_url = "http://gatherer.wizards.com/Handlers/Image.ashx"  # where images and icons are downloaded from
 
     def __init__(
             self, name: str, rarity: str, number: str, edition: str, artist: str, flavor: str,
@@ -407,6 +424,14 @@ class Card(Model):
         self.__flavor = flavor
         self.__multiverseid = multiverseid
 
+    @classmethod
+    def _migrations(cls) -> typing.List[typing.List[str]]:
+        """ migrations of the card table """
+        return [
+            [sql.Migration.online(sql.Card.add_search_index())],
+            [sql.Migration.drop_single_column_index("card", "edition")]
+        ]
+
     @classmethod
     def _table_creation_command(cls):
         """ The command used to create the card table """
@@ -457,9 +482,7 @@ class Card(Model):
         """
         cards = cls._get(sql.Card.get_multiverseid(), card_id=card_id, connection=connection)
         if len(cards):
-            return "http://gatherer.wizards.com/Handlers/Image.ashx?multiverseid={}&type=card".format(
-                    cards[0]["multiverseid"]
-            )
+            return "{}?multiverseid={}&type=card".format(cls.gatherer_url, cards[0]["multiverseid"])
         logger.warning("Could not download image for {}".format(card_id))
         flask.abort(404)
 
@@ -467,7 +490,7 @@ class Card(Model):
     def get_default_image_url(cls) -> str:
         """ url of a card's back to display when the original image could not be found """
         return (
-            "http://gatherer.wizards.com/Handlers/Image.ashx?size=small&type=card&"
+            cls.gatherer_url + "?size=small&type=card&"
             "name=The%20Ultimate%20Nightmare%20of%20Wizards%20of%20the%20Coast%20Customer%20Service&options="
         )
 
@@ -575,3 +598,190 @@ class LegalInFormat(Model):
     def _insertion_command(cls) -> str:
         """ command to insert an item in the database """
         return sql.LegalInFormat.insert()
+
+
+class LegalityMatrix:
+    """
+    Legality of every card in every format, as bitsets indexed by the cards' ordinal, allowing to validate whole decks
+    with a few integer operations per format
+
+    :param cards: names of the cards, by ordinal
+    :param formats: bitsets of the cards legal and of the cards restricted, by format name
+    """
+    def __init__(self, cards: typing.List[str], formats: typing.Dict[str, typing.Tuple[int, int]]):
+        self.cards = cards
+        self.ordinals = {name: ordinal for ordinal, name in enumerate(cards)}
+        self.formats = formats
+
+    def __masks(self, copies: typing.Dict[str, int]) -> typing.Tuple[int, int, bool]:
+        """
+        computes the bitsets of a deck
+
+        :param copies: number of copies of each card in the deck, by name
+        :return: the bitset of the deck's cards, the bitset of its cards present more than once and whether some cards
+                 are unknown
+        """
+        deck = multiple = 0
+        unknown = False
+        for name, number in copies.items():
+            ordinal = self.ordinals.get(name)
+            if ordinal is None:
+                unknown = True
+                continue
+            deck |= 1 << ordinal
+            if number > 1:
+                multiple |= 1 << ordinal
+        return deck, multiple, unknown
+
+    def check(self, copies: typing.Dict[str, int]) -> typing.Dict[str, bool]:
+        """
+        checks a deck against all formats
+
+        :param copies: number of copies of each card in the deck, by name
+        :return: whether the deck is legal, by format name
+        """
+        deck, multiple, unknown = self.__masks(copies)
+        return {
+            name: not unknown and not deck & ~(legal | restricted) and not multiple & restricted
+            for name, (legal, restricted) in self.formats.items()
+        }
+
+    def illegal_cards(self, copies: typing.Dict[str, int]) -> typing.Dict[str, typing.List[str]]:
+        """
+        finds the cards preventing a deck from being legal in each format
+
+        :param copies: number of copies of each card in the deck, by name
+        :return: the names of the offending cards, by format name
+        """
+        deck, multiple, _ = self.__masks(copies)
+        illegal = {}
+        for name, (legal, restricted) in self.formats.items():
+            offending = (deck & ~(legal | restricted)) | (multiple & restricted)
+            illegal[name] = sorted(
+                card for card in copies if card not in self.ordinals or offending >> self.ordinals[card] & 1
+            )
+        return illegal
+
+    def to_bytes(self, bitset: int) -> bytes:
+        """
+        serializes a bitset of this matrix
+
+        :param bitset: the bitset to serialize
+        :return: the bitset's bytes, little endian
+        """
+        return bitset.to_bytes((len(self.cards) + 7) // 8, "little")
+
+
+class FormatLegality(Model):
+    """
+    Precomputed legality of the cards in each format, mirrored in the database and kept in memory by each process.
+
+    The matrix is rebuilt from card_legal_in_format after each database update. Other processes reload it when the
+    stamp file in the run directory changes
+    """
+    index = 4
+
+    matrix = None  # type: LegalityMatrix
+    __stamp = None
+
+    @classmethod
+    def _table_creation_command(cls) -> str:
+        """ command to create the table of bitsets """
+        return sql.FormatLegality.create_table()
+
+    @classmethod
+    def setup_table(cls, connection=None) -> None:
+        """
+        Creates the tables of the matrix
+
+        :param connection: the database connection to use. If None, will use flask.g.db
+        """
+        cls._modify(sql.FormatLegality.create_card_table(), connection=connection)
+        super().setup_table(connection=connection)
+
+    @staticmethod
+    def stamp_path(app: flask.Flask) -> str:
+        """ path to the file changed each time the matrix is rebuilt """
+        return os.path.join(lib.get_run_directory(app), "legality")
+
+    @classmethod
+    def build(cls, app: flask.Flask, connection) -> LegalityMatrix:
+        """
+        Computes the matrix from the legality of each card and replaces the stored one
+
+        :param app: flask application
+        :param connection: the database connection to use
+        :return: the new matrix
+        """
+        cards = [row["name"] for row in cls._get(sql.FormatLegality.list_metacards(), connection=connection)]
+        ordinals = {name: ordinal for ordinal, name in enumerate(cards)}
+        legal = {row["name"]: 0 for row in cls._get(sql.Format.list(), connection=connection)}
+        restricted = dict.fromkeys(legal, 0)
+
+        for row in cls._iterate(sql.FormatLegality.list_legalities(), connection=connection):
+            if "Legal" in row["type"]:
+                legal[row["format"]] |= 1 << ordinals[row["card_name"]]
+            elif "Restricted" in row["type"]:
+                restricted[row["format"]] |= 1 << ordinals[row["card_name"]]
+
+        matrix = LegalityMatrix(cards, {name: (legal[name], restricted[name]) for name in sorted(legal)})
+
+        cursor = connection.cursor()
+        for command in sql.FormatLegality.clear():
+            cursor.execute(command)
+        cursor.executemany(
+            sql.FormatLegality.insert_card(), [dict(ordinal=ordinal, name=name) for ordinal, name in enumerate(cards)]
+        )
+        cursor.executemany(sql.FormatLegality.insert(), [
+            dict(format_id=format_id, name=name, legal=matrix.to_bytes(bits[0]), restricted=matrix.to_bytes(bits[1]))
+            for format_id, (name, bits) in enumerate(matrix.formats.items())
+        ])
+        connection.commit()
+
+        lib.write_atomically(cls.stamp_path(app), str(time.time()))
+        cls.matrix = matrix
+        return matrix
+
+    @classmethod
+    def is_built(cls, connection=None) -> bool:
+        """
+        Checks whether the stored matrix has every format of the catalog. It does not on databases updated before
+        the matrix existed, which get it built when migrated
+
+        :param connection: the database connection to use. If None, will use flask.g.db
+        :return: whether the matrix is built
+        """
+        counts, = cls._get(sql.FormatLegality.count_formats(), connection=connection)
+        return counts["formats"] == counts["built"]
+
+    @classmethod
+    def get_matrix(cls) -> LegalityMatrix:
+        """ Gets the legality matrix, loading it from the database if it changed since it was last loaded """
+        try:
+            stamp = os.stat(cls.stamp_path(flask.current_app)).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+
+        if cls.matrix is None or stamp != cls.__stamp:
+            cards = [row["name"] for row in cls._get(sql.FormatLegality.list_cards())]
+            cls.matrix = LegalityMatrix(cards, OrderedDict(
+                (row["name"], (int.from_bytes(row["legal"], "little"), int.from_bytes(row["restricted"], "little")))
+                for row in cls._get(sql.FormatLegality.list())
+            ))
+            cls.__stamp = stamp
+        return cls.matrix
+
+    @classmethod
+    def _insertion_command(cls) -> str:
+        """ unused, the matrix is stored by build """
+        raise NotImplementedError()
+
+    @property
+    def _primary_key(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
+
+    @property
+    def _as_database_object(self) -> typing.Dict:
+        """ unused """
+        raise NotImplementedError()
@@ -6,14 +6,18 @@ User's model
 """
 
 import hashlib
+import hmac
 import logging
 import os
 
 import flask
+import typing
 
-from lib.db import sql
+from lib.cache import TTLCache
+from lib.db import commands as sql
 from lib.exceptions import DataManipulationException
 from lib.models import Model, Collection
+from lib.threading import BoundedExecutor, SharedEvent
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
@@ -29,15 +33,22 @@ class User(Model):
     :param is_admin: true if the user is an admin
     :param user_id: user's unique identifier
     :param salt: salt used to encrypt the user password
+    :param iterations: number of PBKDF2 iterations used to encrypt the user password
     """
+    iterations = 1000000  # work factor for new passwords. Passwords hashed with another one are rehashed on login
+    hasher = BoundedExecutor(workers=os.cpu_count() or 1, max_pending=2 * (os.cpu_count() or 1))
+    cache = TTLCache(max_size=1024, ttl=30)  # users loaded for authenticated requests, by id
+    changes = None  # type: SharedEvent  # sends the ids of modified users to the other processes
+
     def __init__(self, username: str, email: str, password: str, is_admin: bool=False, user_id: int=None,
-                 salt: bytes=None):
+                 salt: bytes=None, iterations: int=None):
         self.__user_id = user_id
         self.__username = username
         self.__email = email
 
         self.__salt = salt
         self.__password = password
+        self.__iterations = iterations
 
         if salt is None:  # this is a new user, we encode the password
             self.__hash_password()
@@ -45,11 +56,31 @@ class User(Model):
         self.__is_admin = is_admin
         self.collection = Collection(self.__user_id)
 
+    @classmethod
+    def configure_hashing(cls, iterations: int, workers: int, max_pending: int) -> None:
+        """
+        Configures how passwords are hashed
+
+        :param iterations: number of PBKDF2 iterations for new passwords
+        :param workers: number of passwords that can be hashed at the same time
+        :param max_pending: number of passwords that can wait to be hashed before logins are refused
+        """
+        cls.iterations = iterations
+        old_hasher, cls.hasher = cls.hasher, BoundedExecutor(workers=workers, max_pending=max_pending)
+        old_hasher.shutdown()
+
     @classmethod
     def _insertion_command(cls) -> str:
         """ Command used to insert a user in the database """
         return sql.User.insert()
 
+    @classmethod
+    def _migrations(cls) -> typing.List[typing.List[str]]:
+        """ migrations of the user table """
+        return [
+            [sql.Migration.online(sql.User.add_iterations())]
+        ]
+
     @classmethod
     def _table_creation_command(cls) -> str:
         """ The command to create the user table """
@@ -84,6 +115,24 @@ class User(Model):
         if len(data):
             return User(**data[0])
 
+    @classmethod
+    def get_cached_user_by_id(cls, user_id: int):
+        """
+        Fetches a user by id, from the cache if it was loaded recently.
+
+        Changes made by other processes are received through `changes`, when it is set. Otherwise, they are only seen
+        once the cached value expires.
+
+        :param user_id: the wanted user id
+        :return: User instance or None
+        """
+        user = cls.cache.get(str(user_id))
+        if user is None:
+            user = cls.get_user_by_id(user_id)
+            if user is not None:
+                cls.cache.set(str(user_id), user)
+        return user
+
     @classmethod
     def get_users(cls, limit: int=None, offset: int=0) -> list:
         """
@@ -154,7 +203,15 @@ class User(Model):
         :param password: password to check against
         :return: True if the password is valid
         """
-        return self.__password == hashlib.pbkdf2_hmac('sha512', password.encode("utf-8"), self.__salt, 1000000)
+        valid = hmac.compare_digest(self.__password, self.__hash(password, self.__salt, self.__iterations))
+
+        if valid and self.__iterations != self.iterations:
+            self.__password = password
+            self.__hash_password()
+            self._modify(sql.User.update(), **self._as_database_object())
+            self.__invalidate()
+
+        return valid
 
     def create(self):
         """
@@ -194,6 +251,7 @@ class User(Model):
             self.__email = email
 
         self._modify(sql.User.update(), **self._as_database_object())
+        self.__invalidate()
 
     def set_admin(self, admin: bool=True) -> None:
         """
@@ -204,11 +262,32 @@ class User(Model):
         """
         self._modify(sql.User.set_admin(), user_id=self.get_id(), admin=admin)
         self.__is_admin = admin
+        self.__invalidate()
+
+    def __invalidate(self) -> None:
+        """ Drops the user from the cache, in this process and in the others """
+        self.cache.invalidate(self.get_id())
+        if self.changes is not None:
+            self.changes.set_value(self.get_id())
+            self.changes.clear()
 
     def __hash_password(self):
         """ hashes the user's password and set a new salt """
         self.__salt = os.urandom(255)
-        self.__password = hashlib.pbkdf2_hmac('sha512', self.__password.encode("utf-8"), self.__salt, 1000000)
+        self.__iterations = self.iterations
+        self.__password = self.__hash(self.__password, self.__salt, self.__iterations)
+
+    @classmethod
+    def __hash(cls, password: str, salt: bytes, iterations: int) -> bytes:
+        """
+        hashes the given password in the hashing pool. hashlib releases the GIL, so request threads keep running
+
+        :param password: password to hash
+        :param salt: salt to use
+        :param iterations: number of PBKDF2 iterations
+        :return: the hashed password
+        """
+        return cls.hasher.run(hashlib.pbkdf2_hmac, 'sha512', password.encode("utf-8"), salt, iterations)
 
     def _as_database_object(self) -> dict:
         """ View of the user as a dictionary """
@@ -221,7 +300,8 @@ class User(Model):
             "username": self.__username,
             "email": self.__email,
             "password": self.__password,
-            "salt": self.__salt
+            "salt": self.__salt,
+            "iterations": self.__iterations
         }
 
     @property
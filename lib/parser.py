@@ -9,12 +9,9 @@ import datetime
 import json
 import os
 import re
-import zipfile
 from io import BytesIO
 
 import flask
-import requests
-import requests.exceptions
 import typing
 
 from lib.models import Edition, Metacard, Card, Format
@@ -25,6 +22,9 @@ __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
 
 CardList = typing.Dict[str, typing.Dict[str, typing.Union[str, typing.List]]]
 
+# seconds to wait for the server to answer before giving up, for connection and for each read
+TIMEOUT = (5, 30)
+
 
 class NoJSonFileException(Exception):
     """
@@ -36,6 +36,7 @@ class JSonCardParser:
     """
     A parser for fetching card information from mtgjson.com
     """
+    mtgjson_url = "http://mtgjson.com/json"  # where the files are downloaded from, see configure
 
     def __init__(self, app: flask.Flask):
         self.__app = app
@@ -50,15 +51,24 @@ class JSonCardParser:
         os.makedirs(os.path.join(self.download_directory), exist_ok=True)
         self.__full_path_format = os.path.join(self.download_directory, "cards-{}.json")
 
-    @staticmethod
-    def last_version_check_path():
+    @classmethod
+    def configure(cls, mtgjson_url: str) -> None:
+        """
+        Configures where the files are downloaded from
+
+        :param mtgjson_url: url of the directory containing mtgjson's files
+        """
+        cls.mtgjson_url = mtgjson_url.rstrip("/")
+
+    @classmethod
+    def last_version_check_path(cls):
         """ The download url for the version of the json file """
-        return "http://mtgjson.com/json/version-full.json"
+        return cls.mtgjson_url + "/version-full.json"
 
-    @staticmethod
-    def json_download_file_path():
+    @classmethod
+    def json_download_file_path(cls):
         """ The download url for the json file """
-        return "http://mtgjson.com/json/AllSets-x.json.zip"
+        return cls.mtgjson_url + "/AllSets-x.json.zip"
 
     def load_file(self) -> CardList:
         """ loads the json data in memory """
@@ -66,8 +76,17 @@ class JSonCardParser:
             self.__json = json.load(_file)
 
     def check_update(self) -> bool:
+        """
+        Checks whether there is a new set of cards available or not, and downloads it if there is one
+        """
+        version = self.get_update_version()
+        return version is not None and self.download_version(version)
+
+    def get_update_version(self) -> typing.Union[str, None]:
         """
         Checks whether there is a new set of cards available or not
+
+        :return: the version to download, or None if the local version is up to date
         """
         latest_remote_version = self.get_latest_remote_version()
         try:
@@ -76,13 +95,24 @@ class JSonCardParser:
             latest_local_version = "0"
 
         if latest_local_version < latest_remote_version:
-            try:
-                self.__download_latest_version(latest_remote_version)
-            except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-                self.__app.logger.error("Could not download new version, got : {}".format(e))
-            else:
-                return True
-        return False
+            return latest_remote_version
+        return None
+
+    def download_version(self, version: str) -> bool:
+        """
+        Downloads the given version of the set of cards
+
+        :param version: version to download
+        :return: whether the download succeeded or not
+        """
+        import requests.exceptions  # requests is slow to import and only needed for updates
+
+        try:
+            self.__download_latest_version(version)
+        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError, requests.exceptions.Timeout) as e:
+            self.__app.logger.error("Could not download new version, got : {}".format(e))
+            return False
+        return True
 
     def __load_data(self):
         for edition in self.json.values():
@@ -131,7 +161,10 @@ class JSonCardParser:
                         ))
 
     def __download_latest_version(self, version: str) -> str:
-        request = requests.get(self.json_download_file_path(), stream=True)
+        import requests
+        import zipfile
+
+        request = requests.get(self.json_download_file_path(), stream=True, timeout=TIMEOUT)
         if request.status_code != requests.codes.ok:
             raise request.raise_for_status()
 
@@ -163,9 +196,11 @@ class JSonCardParser:
 
     def get_latest_remote_version(self):
         """ The latest available version for the json file """
+        import requests
+
         try:
-            request = requests.get(self.last_version_check_path())
-        except requests.exceptions.ConnectionError:
+            request = requests.get(self.last_version_check_path(), timeout=TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return self.get_latest_local_version()
         else:
             if request.status_code == requests.codes.ok:
@@ -173,6 +208,10 @@ class JSonCardParser:
             else:
                 return self.get_latest_local_version()
 
+    def parse(self) -> None:
+        """ Builds the editions, metacards, cards, formats and legalities from the json file, loading it if needed """
+        self.__load_data()
+
     @property
     def json(self) -> CardList:
         """ Json loaded from the file"""
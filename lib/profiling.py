@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+On demand profiling of single requests.
+
+When PROFILING_ENABLED is set, administrators can profile a request by sending it with the X-Profile header or the
+profile query argument. The request is run under cProfile and its statistics are stored in the run directory, to be
+downloaded from the api. When profiling is not enabled, no hook is registered and requests are not slowed down at all
+"""
+
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import re
+import threading
+
+import flask
+import typing
+from flask_login import current_user
+
+import lib
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+class RequestProfiler:
+    """
+    Profiles the requests asking for it and keeps the last profiles
+
+    :param app: flask application on which to register the profiling hooks
+    """
+    header = "X-Profile"
+    argument = "profile"
+    extension = ".pstats"
+    unsafe_characters = re.compile(r"[^\w.-]")
+
+    def __init__(self, app: flask.Flask):
+        app.profiler = self
+        self.enabled = app.config.get("PROFILING_ENABLED", False)
+        self.keep = app.config.get("PROFILING_KEEP", 20)
+        self.directory = os.path.join(lib.get_run_directory(app), "profiles")
+        self.logger = app.logger
+        # only one profiler can be active at once, concurrent requests asking for a profile are served without
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            app.before_request(self.start)
+            app.after_request(self.stop)
+            app.teardown_request(self.discard)
+
+    def requested(self) -> bool:
+        """ Checks whether the current request asks to be profiled and is allowed to """
+        request = flask.request
+        if not request.headers.get(self.header) and request.args.get(self.argument) in (None, "", "0"):
+            return False
+        return current_user.is_authenticated and current_user.is_admin
+
+    def start(self) -> None:
+        """ Starts profiling the current request if it asks for it """
+        if not self.requested():
+            return
+        if not self.lock.acquire(blocking=False):
+            self.logger.warning("Not profiling {} : another request is being profiled".format(flask.request.path))
+            return
+        flask.g.profiler = cProfile.Profile()
+        flask.g.profiler.enable()
+
+    def stop(self, response: flask.Response) -> flask.Response:
+        """
+        Stops profiling the current request and saves its profile
+
+        :param response: response to send
+        :return: the response, with the name of the profile in its X-Profile header
+        """
+        profiler = self.__release()
+        if profiler is not None:
+            response.headers[self.header] = self.save(profiler)
+        return response
+
+    # noinspection PyUnusedLocal
+    def discard(self, exception) -> None:
+        """
+        Stops profiling a request that failed before its response was built
+
+        :param exception: the exception if one was thrown
+        """
+        self.__release()
+
+    def __release(self) -> typing.Union[cProfile.Profile, None]:
+        """
+        Stops the profiler of the current request, if any
+
+        :return: the stopped profiler
+        """
+        profiler = getattr(flask.g, "profiler", None)
+        if profiler is None:
+            return None
+        profiler.disable()
+        flask.g.profiler = None
+        self.lock.release()
+        return profiler
+
+    def save(self, profiler: cProfile.Profile) -> str:
+        """
+        Stores a profile and removes the oldest ones over the limit
+
+        :param profiler: profiler to save
+        :return: name of the profile
+        """
+        name = "{}-{}-{}{}".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f"), os.getpid(),
+            self.unsafe_characters.sub("_", flask.request.endpoint or "unknown"), self.extension
+        )
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+        for old_profile in self.list()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, old_profile["name"]))
+            except FileNotFoundError:  # removed by another process
+                pass
+        return name
+
+    def list(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """ The stored profiles, most recent first, with their size and creation time """
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.extension):
+                stat = entry.stat()
+                profiles.append(dict(name=entry.name, size=stat.st_size, created=stat.st_mtime))
+        return sorted(profiles, key=lambda profile: (profile["created"], profile["name"]), reverse=True)
+
+    def path(self, name: str) -> typing.Union[str, None]:
+        """
+        Gets the path of a stored profile
+
+        :param name: name of the profile
+        :return: path to the profile, or None if there is no such profile
+        """
+        if os.path.basename(name) != name or not name.endswith(self.extension):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def report(path: str, sort: str="cumulative", limit: int=50) -> str:
+        """
+        Renders a profile as text
+
+        :param path: path to the profile
+        :param sort: key by which to sort the functions, one of pstats.SortKey's values
+        :param limit: number of functions to show
+        :return: the statistics of the most expensive functions
+        :raise ValueError: if the sort key is unknown
+        """
+        if sort not in {key.value for key in pstats.SortKey}:
+            raise ValueError("Unknown sort key {}, use one of {}".format(
+                sort, ", ".join(sorted(key.value for key in pstats.SortKey))
+            ))
+        stream = io.StringIO()
+        pstats.Stats(path, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Production server : a master process opens the listening socket and forks several workers accepting connections on
+it, each of them answering requests with its own threads. Requests are thus spread over all cores instead of sharing
+a single interpreter.
+
+Background tasks only run in the first worker. The master restarts workers that die, replaces all of them when it
+receives SIGHUP and stops them gracefully on SIGTERM or SIGINT :
+
+    $ python3 -m lib.server --host 0.0.0.0 --port 5000 --workers 4
+    $ kill -HUP ${master_pid}  # reloads the configuration and the code without dropping requests
+
+The application is only imported by the workers, so that new workers always run the latest code.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+
+import typing
+import werkzeug.serving
+import werkzeug.wsgi
+
+import lib
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+logger = logging.getLogger("mtgcollector.server")
+
+
+class RequestTracker:
+    """
+    WSGI middleware counting the requests being answered, so that a worker can let them finish before stopping.
+    A request ends once its whole response is sent
+
+    :param app: WSGI application to wrap
+    """
+    def __init__(self, app: typing.Callable):
+        self.app = app
+        self.active = 0
+        self.__condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self.__condition:
+            self.active += 1
+        try:
+            response = self.app(environ, start_response)
+        except:
+            self.__done()
+            raise
+        return werkzeug.wsgi.ClosingIterator(response, self.__done)
+
+    def __done(self) -> None:
+        """ Marks a request as answered """
+        with self.__condition:
+            self.active -= 1
+            self.__condition.notify_all()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits for all requests to be answered
+
+        :param timeout: maximum time to wait
+        :return: whether all requests were answered in time
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.active == 0, timeout)
+
+
+def load_application(index: int) -> typing.Callable:
+    """
+    Creates mtgcollector's application for a worker. The first worker runs the background tasks
+
+    :param index: index of the worker
+    :return: the application
+    """
+    return lib.import_logged("mtgcollector").create_app(background_tasks=index == 0)
+
+
+class Worker:
+    """
+    Process answering requests on the socket shared by all workers. The background tasks of the application, given in
+    its `background_tasks` attribute, are stopped once the requests are answered : each of them has a `stop` method
+    taking the time it can wait for the task to end
+
+    :param index: index of the worker, stable across restarts
+    :param listener: listening socket
+    :param factory: function creating the WSGI application, given the index of the worker
+    :param graceful_timeout: time given to the requests being answered to finish when stopping
+    """
+    def __init__(self, index: int, listener: socket.socket, factory: typing.Callable[[int], typing.Callable],
+                 graceful_timeout: float):
+        self.index = index
+        self.listener = listener
+        self.factory = factory
+        self.graceful_timeout = graceful_timeout
+        self.master = os.getppid()
+        self.stopped = threading.Event()
+        self.server = None
+
+    def run(self) -> None:
+        """ Serves requests until asked to stop, then waits for the requests being answered """
+        signal.signal(signal.SIGTERM, lambda *_: self.stopped.set())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops workers gracefully on ^C
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        application = self.factory(self.index)
+        tracker = RequestTracker(application)
+        host, port = self.listener.getsockname()[:2]
+        self.server = werkzeug.serving.make_server(host, port, tracker, threaded=True, fd=self.listener.fileno())
+        self.server.daemon_threads = True  # running requests are waited for below, with a timeout
+        # all workers are woken up by a new connection, the ones that don't get it must not block in accept
+        self.server.socket.setblocking(False)
+        self.listener.close()  # the server uses its own copy of the socket
+
+        watcher = threading.Thread(target=self.__watch, name="worker-watcher")
+        watcher.daemon = True
+        watcher.start()
+
+        logger.info("Worker {} ({}) started".format(self.index, os.getpid()))
+        self.server.serve_forever()
+
+        if not tracker.wait(self.graceful_timeout):
+            logger.warning("Worker {} stopped with {} requests still running".format(self.index, tracker.active))
+        for task in getattr(application, "background_tasks", []):
+            if not task.stop(self.graceful_timeout):
+                logger.warning("Worker {} stopped with its {} still running".format(self.index, task.name))
+
+    def __watch(self) -> None:
+        """ Stops the server when asked to or when the master died """
+        while not self.stopped.wait(1):
+            if os.getppid() != self.master:
+                logger.error("Master process died, stopping worker {}".format(self.index))
+                break
+        self.server.shutdown()
+
+
+class PreforkServer:
+    """
+    Master process of the workers
+
+    :param host: address on which to listen
+    :param port: port on which to listen, 0 for any free one
+    :param workers: number of worker processes
+    :param factory: function creating the WSGI application in a worker, given the index of the worker
+    :param graceful_timeout: time given to the requests being answered to finish when stopping a worker
+    """
+    def __init__(self, host: str, port: int, workers: int,
+                 factory: typing.Callable[[int], typing.Callable]=load_application, graceful_timeout: float=30):
+        self.workers = workers
+        self.factory = factory
+        self.graceful_timeout = graceful_timeout
+        self.pids = {}  # type: typing.Dict[int, int]
+        self.started = {}  # type: typing.Dict[int, float]
+        self.retiring = set()  # type: typing.Set[int]
+        self.signals = []  # type: typing.List[int]
+
+        self.listener = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+
+    @property
+    def address(self) -> typing.Tuple[str, int]:
+        """ address on which the server listens """
+        return self.listener.getsockname()[:2]
+
+    def spawn(self, index: int) -> None:
+        """
+        Starts a worker
+
+        :param index: index of the worker to start
+        """
+        pid = os.fork()
+        if pid:
+            self.pids[index] = pid
+            self.started[index] = time.monotonic()
+            return
+
+        status = 1
+        try:
+            Worker(index, self.listener, self.factory, self.graceful_timeout).run()
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def reload(self) -> None:
+        """ Replaces all workers, old ones stopping once they answered their requests """
+        logger.info("Reloading workers")
+        old_pids = list(self.pids.values())
+        for index in range(self.workers):
+            self.spawn(index)
+        self.stop_workers(old_pids)
+
+    def stop_workers(self, pids: typing.Iterable[int]) -> None:
+        """
+        Asks workers to stop
+
+        :param pids: workers to stop
+        """
+        for pid in pids:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self) -> None:
+        """ Collects stopped workers and restarts the ones that died """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid in self.retiring:
+                self.retiring.remove(pid)
+                continue
+            for index, worker_pid in list(self.pids.items()):
+                if worker_pid == pid:
+                    logger.error("Worker {} ({}) died with status {}, restarting it".format(index, pid, status))
+                    if time.monotonic() - self.started[index] < 1:
+                        time.sleep(1)  # the worker fails at startup, don't restart it in a loop
+                    self.spawn(index)
+
+    def run(self) -> None:
+        """ Starts the workers and manages them until asked to stop """
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum_, _: self.signals.append(signum_))
+
+        logger.info("Listening on {}:{} with {} workers".format(*self.address, self.workers))
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while True:
+            self.reap()
+            while self.signals:
+                if self.signals.pop(0) == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            time.sleep(0.1)
+
+    def stop(self) -> None:
+        """ Stops all workers gracefully, killing the ones that are still running after the graceful timeout """
+        logger.info("Stopping workers")
+        self.stop_workers(self.pids.values())
+        self.pids.clear()
+        self.listener.close()
+
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.retiring and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.retiring:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+
+def main() -> None:
+    """ Runs the production server with the given arguments """
+    parser = ArgumentParser("Run mtgcollector with several worker processes")
+    parser.add_argument("-p", "--port", type=int, help="port to use for the server", default=5000)
+    parser.add_argument("--host", type=str, help="address for the server to listen on", default="127.0.0.1")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes, one per core"
+    )
+    parser.add_argument(
+        "--graceful-timeout", type=float, default=30,
+        help="time given to running requests when stopping or reloading workers, in seconds"
+    )
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(message)s")
+    PreforkServer(arguments.host, arguments.port, arguments.workers, graceful_timeout=arguments.graceful_timeout).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,30 @@
 Background tasks utilities
 """
 
+import fcntl
 import os
 import tempfile
 import threading
+import time
 
 import flask
-import requests
+import typing
 
 import lib.db
 import lib.db.maintenance
 import lib.models
+from lib.metrics import registry
+from lib.parser import JSonCardParser, NoJSonFileException
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
 
 
+download_duration = registry.histogram(
+    "mtgcollector_download_duration_seconds", "Time taken to download images and icons", ["kind"]
+)
+
+
 class ImageHandler:
     """
     Card downloader, for caching and pre-caching
@@ -27,7 +36,6 @@ class ImageHandler:
     def __init__(self, app: flask.Flask):
         super().__init__()
         app.image_handler = self
-        self.db = lib.db.maintenance.MaintenanceDB(app)
         self.download_folder = os.path.join(app.static_folder, "images")
         self.logger = app.logger
 
@@ -61,6 +69,8 @@ class ImageHandler:
         :param url: where to fetch the resource
         :param file_path: where to store the resource
         """
+        import requests  # requests is slow to import and only needed for downloads
+
         request = requests.get(url, stream=True)
 
         if request.status_code != requests.codes.ok:
@@ -91,7 +101,9 @@ class ImageHandler:
         else:
             url = lib.models.Card.get_image_url(image, logger=self.logger, connection=connection)
         file_path = self.get_image_path(image)
+        start = time.perf_counter()
         self.download_item(url, file_path)
+        download_duration.observe(time.perf_counter() - start, kind="image")
 
     def download_icon(self, icon: str) -> None:
         """
@@ -104,22 +116,30 @@ class ImageHandler:
             icon_name = "tap"
         elif icon_name == "Q":
             icon_name = "untap"
-        url = "http://gatherer.wizards.com/Handlers/Image.ashx?size=small&name={}&type=symbol".format(icon_name)
+        url = "{}?size=small&name={}&type=symbol".format(lib.models.Card.gatherer_url, icon_name)
         file_path = self.get_icon_path(icon)
+        start = time.perf_counter()
         self.download_item(url, file_path)
+        download_duration.observe(time.perf_counter() - start, kind="icon")
 
 
 class DBUpdater(threading.Thread):
     """
     Database updater. Waits for a signal and, on signal, tries to update the database
 
+    Updates are requested through the app's `update_db` event, which is shared between processes when the application
+    is served by several workers, so that the updater only has to run in one of them.
+
     :param app: flask application to obtain database information
     """
     def __init__(self, app: flask.Flask):
-        super().__init__()
+        super().__init__(name="database updater")
         self.db = lib.db.maintenance.MaintenanceDB(app)
-        self.event = threading.Event()
-        app.update_db = self.event
+        if not hasattr(app, "update_db"):
+            app.update_db = threading.Event()
+        self.event = app.update_db
+        self.stopped = threading.Event()
+        self.updating = threading.Lock()
         self.daemon = True
 
     def run(self):
@@ -127,7 +147,195 @@ class DBUpdater(threading.Thread):
         try:
             while True:
                 self.event.wait()
-                self.event.clear()
-                self.db.update()
+                with self.updating:
+                    if self.stopped.is_set():
+                        return
+                    self.event.clear()
+                    self.db.update(self.stopped)
         except KeyboardInterrupt:
             exit(0)
+
+    def stop(self, timeout: float=None) -> bool:
+        """
+        Stops the updater. A running update is cancelled at its next batch and waited for, instead of being killed
+        with the process halfway through its insertions. It is then asked again, for the updater of the process
+        replacing this one to run it
+
+        :param timeout: maximum time to wait for the update to end, None to wait as long as needed
+        :return: whether the updater stopped in time
+        """
+        self.stopped.set()
+        interrupted = self.updating.locked()
+        if not self.updating.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        self.updating.release()
+
+        status = lib.db.maintenance.UpdateJob.status(self.db.app)
+        if interrupted and status is not None and status["state"] == "cancelled":
+            self.event.set()
+        return True
+
+
+class CatalogWatcher(threading.Thread):
+    """
+    Periodically checks whether a new version of the card catalog is available and, if so, asks for a database update.
+
+    Checks use conditional requests so that an unchanged catalog costs a single 304 answer. Failures are retried
+    sooner, with an exponential backoff.
+
+    :param app: flask application to configure the watcher and to signal updates to
+    :param url: url of the version file to watch, defaults to CATALOG_CHECK_URL or mtgjson's version file
+    """
+    def __init__(self, app: flask.Flask, url: str=None):
+        super().__init__(name="catalog watcher")
+        self.app = app
+        self.url = url or app.config.get("CATALOG_CHECK_URL", JSonCardParser.last_version_check_path())
+        self.interval = app.config.get("CATALOG_CHECK_INTERVAL", 24 * 3600)
+        self.timeout = app.config.get("CATALOG_CHECK_TIMEOUT", 10)
+        self.retry_delay = app.config.get("CATALOG_CHECK_RETRY_DELAY", 60)
+        self.failures = 0
+        self.etag = None  # type: str
+        self.last_modified = None  # type: str
+        self.version = None  # type: str
+        self.stopped = threading.Event()
+        self.daemon = True
+
+    @property
+    def delay(self) -> float:
+        """ time to wait before the next check """
+        if self.failures:
+            return min(self.retry_delay * 2 ** (self.failures - 1), self.interval)
+        return self.interval
+
+    def check(self) -> bool:
+        """
+        Checks the catalog's version. An unchanged catalog is compared to the local version too, as the update asked
+        for when it was found may have failed
+
+        :return: True if the remote version is newer than the local one
+        """
+        import requests
+
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        response = requests.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status_code != requests.codes.not_modified:
+            response.raise_for_status()
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            self.version = response.json()["version"]
+        elif self.version is None:
+            return False
+
+        try:
+            local_version = JSonCardParser(self.app).get_latest_local_version()
+        except NoJSonFileException:
+            local_version = "0"
+        return local_version < self.version
+
+    def tick(self) -> typing.Union[bool, None]:
+        """
+        Runs a check, asking for an update when a new version is found and keeping track of failures
+
+        :return: the result of the check, or None if it failed
+        """
+        import requests.exceptions
+
+        try:
+            new_version = self.check()
+        except (requests.exceptions.RequestException, ValueError, KeyError) as exc:
+            self.failures += 1
+            self.app.logger.warning("Could not check for a new catalog version, got : {}".format(exc))
+            return None
+
+        self.failures = 0
+        if new_version:
+            self.app.logger.info("Catalog version {} is available, updating".format(self.version))
+            self.app.update_db.set()
+        return new_version
+
+    def run(self):
+        """ Checks the catalog every CATALOG_CHECK_INTERVAL seconds until stopped """
+        while not self.stopped.wait(self.delay):
+            self.tick()
+
+    def stop(self, timeout: float=None) -> bool:
+        """
+        Stops the watcher. A running check is not waited for, it only reads the catalog's version
+
+        :param timeout: unused, the watcher stops at once
+        :return: True, the watcher being stopped
+        """
+        self.stopped.set()
+        return True
+
+
+class TaskClaim(threading.Thread):
+    """
+    Runs background tasks in a single process among those sharing the run directory, whichever claims them first.
+
+    Processes claim the tasks by locking a file of the run directory. The lock is released when the claiming process
+    stops or dies, and another process then claims the tasks in turn, so that they keep running while workers are
+    replaced.
+
+    :param app: flask application whose run directory holds the lock
+    :param factory: function creating the tasks, once they are claimed. Tasks have a `stop` method, see DBUpdater
+    :param poll_interval: time to wait between two attempts to claim the tasks
+    """
+    def __init__(self, app: flask.Flask, factory: typing.Callable[[], typing.List[threading.Thread]],
+                 poll_interval: float=1):
+        super().__init__(name="task claim")
+        self.path = os.path.join(lib.get_run_directory(app), "background-tasks.lock")
+        self.factory = factory
+        self.poll_interval = poll_interval
+        self.tasks = []  # type: typing.List[threading.Thread]
+        self.stopped = threading.Event()
+        self.__lock = threading.Lock()
+        self.__lock_file = None  # kept open while the tasks are claimed
+        self.daemon = True
+
+    def claim(self) -> bool:
+        """
+        Tries to claim the tasks, starting them if it succeeds
+
+        :return: whether this process runs the tasks
+        """
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        with self.__lock:
+            if self.stopped.is_set():
+                lock_file.close()
+                return False
+            self.__lock_file = lock_file
+            self.tasks = self.factory()
+            for task in self.tasks:
+                task.start()
+        return True
+
+    def run(self):
+        """ Claims the tasks as soon as no other process holds them """
+        while not self.claim() and not self.stopped.wait(self.poll_interval):
+            pass
+
+    def stop(self, timeout: float=None) -> bool:
+        """
+        Stops the tasks if this process runs them, then releases them for another process to claim
+
+        :param timeout: time each task can take to stop, None to wait as long as needed
+        :return: whether all tasks stopped in time
+        """
+        with self.__lock:
+            self.stopped.set()
+            stopped = all([task.stop(timeout) for task in self.tasks])
+            if self.tasks:
+                self.__lock_file.close()
+        return stopped
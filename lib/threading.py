@@ -5,7 +5,15 @@
 Threading event able to send data alongside the event
 """
 
+import concurrent.futures
+import os
 import threading
+import time
+
+import typing
+
+import lib
+from lib.exceptions import ServerBusyException
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
@@ -39,3 +47,119 @@ class Event(threading.Event):
         if not event:
             raise TimeoutError("No value was given during the given timeout")
         return self.value
+
+
+class SharedEvent(Event):
+    """
+    Event able to send data with the event, to threads of every process sharing the same file
+
+    Values are written to the given file and a watcher thread polls it in order to wake up local threads whenever
+    another process sends a value. Only the last value is kept : values sent by other processes between two checks are
+    not all received, although at least one is.
+
+    :param path: path of the file used to share values between processes
+    :param poll_interval: time to wait between two checks of the file
+    :param callback: function called by the watcher with each value received from another process
+    """
+    def __init__(self, path: str, poll_interval: float=0.5, callback: typing.Callable[[str], None]=None):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.callback = callback
+        self.__last_token = self.__read()[0]
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        watcher = threading.Thread(target=self.__watch, name="notifier-watcher")
+        watcher.daemon = True
+        watcher.start()
+
+    def set_value(self, value: str):
+        """
+        send the event to all processes, passing it a value
+
+        :param value: value to send to other threads
+        """
+        token = "{}-{}".format(os.getpid(), time.time())
+        # known before the file is written, for the watcher not to take the value for another process'
+        self.__last_token = token
+        lib.write_atomically(self.path, "{}\n{}".format(token, value))
+        super().set_value(value)
+
+    def set(self):
+        """ send the event to all processes, without any value """
+        self.set_value("")
+
+    def __read(self) -> tuple:
+        """
+        reads the last value sent
+
+        :return: token identifying the value and the value itself
+        """
+        try:
+            with open(self.path, encoding="utf-8") as shared_file:
+                token, _, value = shared_file.read().partition("\n")
+        except FileNotFoundError:
+            return None, None
+        return token, value
+
+    def __watch(self):
+        """ Polls the shared file and wakes up local threads when another process sent a new value """
+        while True:
+            time.sleep(self.poll_interval)
+            token, value = self.__read()
+            if token is not None and token != self.__last_token:
+                self.__last_token = token
+                super().set_value(value)
+                self.clear()
+                if self.callback is not None:
+                    self.callback(value)
+
+
+class BoundedExecutor:
+    """
+    Thread pool accepting only a limited number of waiting tasks. When it is full, new tasks are refused instead of
+    being queued, so that a burst of expensive tasks cannot hold every server thread.
+
+    :param workers: number of threads running the tasks
+    :param max_pending: number of tasks that can wait for a thread
+    :param admission_timeout: time to wait for a place before refusing a task
+    """
+    def __init__(self, workers: int, max_pending: int, admission_timeout: float=1):
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.__slots = threading.BoundedSemaphore(workers + max_pending)
+        self.__lock = threading.Lock()
+        self.admission_timeout = admission_timeout
+        self.tasks = 0  # tasks running or waiting
+        self.rejected = 0  # tasks refused since the pool was created
+
+    def run(self, function: typing.Callable, *args):
+        """
+        Runs the function in the pool and waits for its result
+
+        :param function: function to run
+        :param args: arguments to give to the function
+        :return: the function's result
+        """
+        if not self.__slots.acquire(timeout=self.admission_timeout):
+            with self.__lock:
+                self.rejected += 1
+            raise ServerBusyException("Too many tasks are already waiting")
+        with self.__lock:
+            self.tasks += 1
+        try:
+            future = self.__executor.submit(function, *args)
+        except:
+            self.__release()
+            raise
+        future.add_done_callback(lambda _: self.__release())
+        return future.result()
+
+    def __release(self) -> None:
+        """ Frees the place of a finished task """
+        with self.__lock:
+            self.tasks -= 1
+        self.__slots.release()
+
+    def shutdown(self) -> None:
+        """ Stops the pool once all running tasks are done """
+        self.__executor.shutdown()
@@ -6,21 +6,30 @@ MTGCollector : an application to easily handle your Magic The Gathering collecti
 """
 
 import hashlib
+import logging
 import os
 import random
-from argparse import ArgumentParser
-
 import sys
+import time
+from argparse import ArgumentParser
 
 import flask_login
-import flask_wtf.csrf
+import typing
 from flask import Flask
 
+import lib.compression
+import lib.csrf
 import lib.db
+import lib.db.maintenance
+import lib.metrics
+import lib.profiling
 import lib.tasks
 import lib.threading
+from lib.cache import TTLCache
+from lib.db.instrumentation import QueryStats
 from lib.json import CustomJSONEncoder
-from lib.models import User
+from lib.models import Card, Deck, User
+from lib.parser import JSonCardParser
 
 
 __author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
@@ -34,12 +43,47 @@ def parse_args():
     return vars(parser.parse_args(sys.argv[1:]))
 
 
-def setup_app(_app: Flask) -> None:
+def create_background_tasks(_app: Flask) -> list:
+    """
+    Creates the database updater and the catalog watcher, if enabled
+
+    :param _app: application for which to run the tasks
+    :return: the tasks, not started
+    """
+    tasks = [lib.tasks.DBUpdater(_app)]
+    if _app.config.get("CATALOG_CHECK_INTERVAL", 24 * 3600) > 0:
+        tasks.append(lib.tasks.CatalogWatcher(_app))
+    return tasks
+
+
+def configure_logging(_app: Flask) -> None:
     """
-    setups flask application
+    Writes the messages of the application's logger to stderr, from the level given by LOG_LEVEL, INFO by default.
+
+    Outside of debug mode, Flask only gives its logger a handler for errors and does not let its messages propagate to
+    the handlers a server might configure : reports logged at INFO, as the time taken to start, would be dropped
+
+    :param _app: application whose logger to configure
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(process)d] %(levelname)s %(message)s"))
+    # Flask's handlers already write everything in debug mode, and errors otherwise
+    handler.addFilter(lambda record: not _app.debug and record.levelno < logging.ERROR)
+    _app.logger.addHandler(handler)
+    _app.logger.setLevel(_app.config.get("LOG_LEVEL", "INFO"))
+
+
+def setup_app(_app: Flask, background_tasks: typing.Union[bool, None]=True) -> None:
+    """
+    setups flask application, migrating its database if needed
 
     :param _app: application to configure
+    :param background_tasks: whether to run the database updater and the catalog watcher in this process. When the
+                             application is served by several processes, only one of them should run them : None lets
+                             the first process claiming them run them, see lib.tasks.TaskClaim. They are kept in the
+                             application's `background_tasks`, for servers to stop them
     """
+    setup_started = time.perf_counter()
     _app.config["CONFIG_PATH"] = os.environ.get("MTG_COLLECTOR_CONFIG", os.path.join(_app.root_path, "config.cfg"))
 
     try:
@@ -50,13 +94,86 @@ def setup_app(_app: Flask) -> None:
             SECRET_KEY=hashlib.sha512(str(random.randint(0, 2**64)).encode()).hexdigest(),
         )
 
+    configure_logging(_app)
+    while lib.import_reports:
+        _app.logger.info(lib.import_reports.pop(0))
+
+    lib.db.configure(_app)
+    User.configure_hashing(
+        iterations=_app.config.get("PASSWORD_ITERATIONS", 1000000),
+        workers=_app.config.get("PASSWORD_HASHING_WORKERS", os.cpu_count() or 1),
+        max_pending=_app.config.get("PASSWORD_HASHING_QUEUE", 2 * (os.cpu_count() or 1))
+    )
+    User.cache = TTLCache(
+        max_size=_app.config.get("USER_CACHE_SIZE", 1024), ttl=_app.config.get("USER_CACHE_TTL", 30)
+    )
+    Deck.analytics_cache = TTLCache(
+        max_size=_app.config.get("DECK_ANALYTICS_CACHE_SIZE", 256),
+        ttl=_app.config.get("DECK_ANALYTICS_CACHE_TTL", 3600)
+    )
+
+    Card.gatherer_url = _app.config.get("GATHERER_URL", Card.gatherer_url)
+    JSonCardParser.configure(_app.config.get("MTGJSON_URL", JSonCardParser.mtgjson_url))
+
+    QueryStats.configure(
+        slow_query_threshold=_app.config.get("SLOW_QUERY_THRESHOLD", 0.5),
+        slow_request_threshold=_app.config.get("SLOW_REQUEST_THRESHOLD", 1.0)
+    )
+    if _app.config.get("SLOW_QUERY_LOG"):
+        handler = logging.FileHandler(_app.config["SLOW_QUERY_LOG"])
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        QueryStats.logger.addHandler(handler)
+
     csrf.init_app(_app)
     login_manager.init_app(_app)
     lib.tasks.ImageHandler(_app)
-    lib.tasks.DBUpdater(_app).start()
+    lib.profiling.RequestProfiler(_app)
+    lib.compression.ResponseCompressor(_app)
 
     _app.json_encoder = CustomJSONEncoder
-    _app.notifier = lib.threading.Event()
+    _app.notifier = lib.threading.SharedEvent(os.path.join(lib.get_run_directory(_app), "notifications"))
+    _app.update_db = lib.threading.SharedEvent(os.path.join(lib.get_run_directory(_app), "update-requests"))
+    # the changes received are not all kept when several are sent at once, hence the whole cache is dropped
+    User.changes = lib.threading.SharedEvent(
+        os.path.join(lib.get_run_directory(_app), "user-changes"), callback=lambda _: User.cache.clear()
+    )
+
+    if _app.config.get("DATABASE_NAME") is not None:
+        try:
+            lib.db.maintenance.MaintenanceDB(_app).migrate()
+        except lib.db.commands.Error:
+            _app.logger.exception("Could not migrate the database")
+
+    _app.background_tasks = []
+    if background_tasks is None:
+        _app.background_tasks.append(lib.tasks.TaskClaim(_app, lambda: create_background_tasks(_app)))
+    elif background_tasks:
+        _app.background_tasks.extend(create_background_tasks(_app))
+    for task in _app.background_tasks:
+        task.start()
+
+    lib.metrics.registry.add_collector("caches", lambda: lib.metrics.cache_metrics({
+        "user": User.cache, "deck_analytics": Deck.analytics_cache
+    }))
+    lib.metrics.registry.add_collector("pools", lambda: lib.metrics.executor_metrics({
+        "password_hashing": User.hasher
+    }))
+    lib.metrics.registry.add_collector("update", lambda: lib.db.maintenance.UpdateJob.metrics(_app))
+
+    _app.logger.info("Application configured in {:.0f}ms".format((time.perf_counter() - setup_started) * 1000))
+
+
+def create_app(background_tasks: typing.Union[bool, None]=True) -> Flask:
+    """
+    Configures the application, ready to be given to a WSGI server
+
+    Views are registered on the module's application, which is therefore the one configured and returned
+
+    :param background_tasks: whether to run the background tasks in this process, see `setup_app`
+    :return: the configured application
+    """
+    setup_app(app, background_tasks)
+    return app
 
 
 app = Flask(__name__)
@@ -64,19 +181,18 @@ app = Flask(__name__)
 login_manager = flask_login.LoginManager()
 login_manager.login_view = 'login'
 
-# noinspection PyUnresolvedReferences
-csrf = flask_wtf.CsrfProtect()
+csrf = lib.csrf.MaskedCsrfProtect()
 
 
 @login_manager.user_loader
 def load_user(user_id: int) -> User:
     """
-    Loads the user from the database
+    Loads the user from the cache or the database
 
     :param user_id: id of the user to load
     :return: a User instance
     """
-    return User.get_user_by_id(user_id)
+    return User.get_cached_user_by_id(user_id)
 
 
 # noinspection PyPep8
@@ -85,5 +201,4 @@ from views import *
 if __name__ == '__main__':
     arguments = parse_args()
 
-    setup_app(app)
-    app.run(threaded=True, debug=os.environ.get("MTG_COLLECTOR_DEBUG", False), **arguments)
+    create_app().run(threaded=True, debug=os.environ.get("MTG_COLLECTOR_DEBUG", False), **arguments)
@@ -18,6 +18,8 @@ from typing import Iterable
 
 import shutil
 
+import lib.db
+import lib.db.sqlite
 import mtgcollector
 from mtgcollector import setup_app
 
@@ -27,8 +29,12 @@ download_file_resources = os.path.join(os.path.dirname(__file__), "resources", "
 class DBConnectionMixin:
     """
     This mixin gives multiple helpers for dealing with database creation and deletion. It also take cares of setting
-    default values if some are not provided in environment variables
+    default values if some are not provided in environment variables.
+
+    Tests run against a MySQL server unless MTG_TEST_DB_BACKEND is "sqlite", in which case the database is a file in
+    the temporary directory
     """
+    DATABASE_BACKEND = os.environ.get("MTG_TEST_DB_BACKEND", "mysql")
     DATABASE_USER = os.environ.get("MTG_TEST_DB_USER", "root")
     DATABASE_PASSWORD = os.environ.get("MTG_TEST_DB_PASSWORD", "")
     DATABASE_HOST = os.environ.get("MTG_TEST_DB_HOST", "127.0.0.1")
@@ -44,6 +50,9 @@ class DBConnectionMixin:
         :param database: if not None, will directly connect to this database
         :return: a connection to the database
         """
+        if cls.DATABASE_BACKEND == "sqlite":
+            return lib.db.sqlite.connect(os.path.join(tempfile.gettempdir(), database or cls.DATABASE_NAME))
+
         kwargs = {
             "user": cls.DATABASE_USER,
             "password": cls.DATABASE_PASSWORD,
@@ -58,6 +67,10 @@ class DBConnectionMixin:
     @classmethod
     def drop_database(cls):
         """ Completely destroys the database """
+        if cls.DATABASE_BACKEND == "sqlite":
+            os.remove(os.path.join(tempfile.gettempdir(), cls.DATABASE_NAME))
+            return
+
         conn = None
         try:
             conn = cls.get_connection()
@@ -71,6 +84,9 @@ class DBConnectionMixin:
     @classmethod
     def create_database(cls):
         """ Creates the needed database """
+        if cls.DATABASE_BACKEND == "sqlite":  # created on the first connection
+            return
+
         conn = None
         try:
             conn = cls.get_connection()
@@ -130,6 +146,7 @@ class TestCaseWithDB(DBConnectionMixin, ApplicationContextWrapper, metaclass=abc
     def setUpClass(cls):
         """ Creates the database """
         super().setUpClass()
+        lib.db.use(cls.DATABASE_BACKEND)
         cls.create_database()
         conn = None
         try:
@@ -155,8 +172,9 @@ class TestCaseWithDB(DBConnectionMixin, ApplicationContextWrapper, metaclass=abc
     def tearDown(self):
         """ Truncates all tables defined and reset the flask.g.db object """
         cursor = flask.g.db.cursor()
+        truncate = "DELETE FROM" if self.DATABASE_BACKEND == "sqlite" else "TRUNCATE TABLE"
         for table in self.tables_to_truncate():
-            cursor.execute("TRUNCATE TABLE {}".format(table))
+            cursor.execute("{} {}".format(truncate, table))
         flask.g.db.commit()
         flask.g.db.close()
         flask.g.db = None
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic catalogs shaped like mtgjson's AllSets-x.json, scaled to multiples of its real size, and synthetic users
+owning part of them. They fill the databases of the tests and of the benchmarks
+"""
+
+import hashlib
+import json
+import os
+import random
+import zipfile
+from collections import OrderedDict
+
+import flask
+import typing
+
+import lib.models
+from lib.db import commands as sql
+from lib.db.maintenance import MaintenanceDB
+from lib.parser import JSonCardParser
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+# approximate size of AllSets-x.json, used as the 1x scale
+EDITIONS = 200
+CARDS_PER_EDITION = 160
+REPRINT_RATIO = 0.5  # share of printings reusing the name of another printing
+
+FORMATS = ["Vintage", "Legacy", "Modern", "Standard", "Commander", "Pauper", "Frontier", "Ice Age Block"]
+LEGALITIES = ["Legal", "Legal", "Legal", "Restricted", "Banned"]
+COLORS = ["White", "Blue", "Black", "Red", "Green"]
+TYPES = ["Creature", "Instant", "Sorcery", "Enchantment", "Artifact", "Land", "Planeswalker"]
+RARITIES = ["Common", "Uncommon", "Rare", "Mythic Rare"]
+
+
+def generate_metacard(index: int) -> typing.Dict[str, typing.Any]:
+    """
+    Generates the attributes shared by all printings of a card, always the same for a given index
+
+    :param index: index of the card
+    :return: the card's attributes, as in mtgjson's dump
+    """
+    generator = random.Random(index)
+    types = [generator.choice(TYPES)]
+    colors = generator.sample(COLORS, generator.choice([0, 1, 1, 1, 2]))
+    cmc = generator.randint(0, 8)
+    card = OrderedDict([
+        ("name", "Synthetic Card {}".format(index)),
+        ("types", types),
+        ("subtypes", ["Goblin", "Warrior"] if types == ["Creature"] else None),
+        ("supertypes", ["Legendary"] if generator.random() < 0.1 else None),
+        ("manaCost", "{{{}}}".format(cmc) + "".join("{{{}}}".format(color[0]) for color in colors)),
+        ("cmc", cmc),
+        ("colors", colors or None),
+        ("power", str(generator.randint(0, 8)) if types == ["Creature"] else None),
+        ("toughness", str(generator.randint(1, 8)) if types == ["Creature"] else None),
+        ("originalText", "When this enters the battlefield, draw a card. " * generator.randint(1, 4)),
+        ("legalities", [
+            dict(format=name, legality=generator.choice(LEGALITIES))
+            for name in FORMATS if generator.random() < 0.7
+        ]),
+    ])
+    return card
+
+
+def generate_dump(scale: float, seed: int=0) -> typing.Dict[str, typing.Dict]:
+    """
+    Generates a synthetic dump
+
+    :param scale: size of the dump, as a multiple of the real one
+    :param seed: seed of the random choices, the same seed giving the same dump
+    :return: the dump, as mtgjson's AllSets-x.json
+    """
+    generator = random.Random(seed)
+    editions = max(1, int(EDITIONS * scale))
+    names = max(1, int(editions * CARDS_PER_EDITION * (1 - REPRINT_RATIO)))
+    metacards = {}
+    dump = OrderedDict()
+    multiverseid = 0
+
+    for edition_index in range(editions):
+        code = "S{:05d}".format(edition_index)
+        cards = []
+        for number in range(1, CARDS_PER_EDITION + 1):
+            name_index = generator.randrange(names)
+            if name_index not in metacards:
+                metacards[name_index] = generate_metacard(name_index)
+            multiverseid += 1
+            card = dict(metacards[name_index])
+            card.update(
+                multiverseid=multiverseid, number=str(number), rarity=generator.choice(RARITIES),
+                artist="Artist {}".format(generator.randrange(500)), flavor="Flavor text of the card."
+            )
+            cards.append(card)
+
+        dump[code] = OrderedDict([
+            ("code", code),
+            ("name", "Synthetic Edition {}".format(edition_index)),
+            ("type", "expansion"),
+            ("releaseDate", "{:04d}-{:02d}-01".format(1993 + edition_index % 30, 1 + edition_index % 12)),
+            ("block", "Synthetic Block {}".format(edition_index // 3)),
+            ("cards", cards),
+        ])
+    return dump
+
+
+def write_dump(dump: typing.Dict, path: str) -> None:
+    """
+    Writes a dump compressed as mtgjson distributes it
+
+    :param dump: the dump to write
+    :param path: path of the zip file to create
+    """
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("AllSets-x.json", json.dumps(dump))
+
+
+def insert_catalog(app: flask.Flask, dump: typing.Dict, connection) -> None:
+    """
+    Inserts a dump in the database as an update would
+
+    :param app: application to use, with its static folder and run directory in a temporary directory
+    :param dump: the dump to insert
+    :param connection: connection to the database
+    """
+    parser = JSonCardParser(app)
+    with open(os.path.join(parser.download_directory, "cards-1.0.0.json"), "w", encoding="utf8") as dump_file:
+        json.dump(dump, dump_file)
+    for model, entities in MaintenanceDB.insertions(parser):
+        model.bulk_insert(entities, connection=connection)
+    lib.models.FormatLegality.build(app, connection)
+
+
+def populate(app: flask.Flask, connection, scale: float, users: int, collection_size: int, seed: int=0,
+             password: str="", iterations: int=1) -> typing.List:
+    """
+    Fills the database with a synthetic catalog and the collections of synthetic users, named user0, user1 and so on
+
+    :param app: application to use, with its static folder and run directory in a temporary directory
+    :param connection: connection to the database
+    :param scale: size of the catalog, as a multiple of the real one
+    :param users: number of users to create
+    :param collection_size: number of different cards in each user's collection
+    :param seed: seed of the random choices
+    :param password: password of all users
+    :param iterations: number of PBKDF2 iterations of the users' password
+    :return: the ids of the created users
+    """
+    insert_catalog(app, generate_dump(scale, seed), connection)
+    generator = random.Random(seed)
+    cursor = connection.cursor()
+
+    # users are inserted directly and share their salt, hashing each password would only slow the setup down
+    salt = os.urandom(16)
+    hashed_password = hashlib.pbkdf2_hmac("sha512", password.encode("utf-8"), salt, iterations)
+    cursor.executemany(sql.User.insert(), [
+        dict(username="user{}".format(index), email="user{}@example.com".format(index), password=hashed_password,
+             salt=salt, iterations=iterations)
+        for index in range(users)
+    ])
+    connection.commit()
+    cursor.execute("SELECT user_id FROM user")
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT card_id FROM card")
+    card_ids = [row[0] for row in cursor.fetchall()]
+
+    for user_id in user_ids:
+        cursor.executemany(sql.CardInCollection.insert_by_id(), [
+            dict(user_id=user_id, card_id=card_id, normal=generator.randint(0, 4), foil=generator.randint(0, 1))
+            for card_id in generator.sample(card_ids, min(collection_size, len(card_ids)))
+        ])
+        connection.commit()
+    return user_ids
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the collection and preparation of the queries explained by the index advisor
+"""
+
+import unittest
+
+from lib.db import advisor
+
+
+class TestAdvisor(unittest.TestCase):
+    """
+    Checks which queries the advisor explains and how it fills them
+    """
+    def setUp(self):
+        """ Collects the queries once for each test """
+        self.statements = dict(advisor.get_statements())
+
+    def test_only_select_statements(self):
+        """ only queries reading data are explained """
+        self.assertIn("Card.get", self.statements)
+        self.assertIn("CardInDeck.get_cards", self.statements)
+        self.assertNotIn("Card.insert", self.statements)
+        self.assertNotIn("Card.create_table", self.statements)
+
+    def test_abstract_commands_are_skipped(self):
+        """ commands of abstract helpers have no table to read """
+        self.assertFalse([name for name in self.statements if name.startswith("CardInDeckEntity.")])
+
+    def test_all_statements_can_be_prepared(self):
+        """ every template and parameter gets a value """
+        for name, statement in self.statements.items():
+            with self.subTest(name=name):
+                prepared, parameters = advisor.prepare(statement)
+                self.assertNotIn("{", prepared)
+                self.assertEqual(set(advisor.parameter.findall(prepared)), set(parameters))
+
+    def test_search_template(self):
+        """ searches are explained with filters on the indexed columns """
+        prepared, parameters = advisor.prepare(self.statements["Metacard.get_ids"])
+        self.assertIn("block", parameters)
+        self.assertIn("metacard.cmc", prepared)
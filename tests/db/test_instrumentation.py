@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the instrumentation of database queries
+"""
+
+import time
+import unittest
+
+import flask
+
+import lib.db.sqlite
+from lib.db.instrumentation import QueryStats, fingerprint
+from lib.models import Model
+
+
+class TestFingerprint(unittest.TestCase):
+    """
+    Checks the normalization of statements
+    """
+    def test_parameters_and_literals(self):
+        """ values are replaced, whatever their form """
+        self.assertEqual(
+            fingerprint("SELECT * FROM card WHERE card_id = %(card_id)s AND name = 'Forest' LIMIT 10"),
+            "SELECT * FROM card WHERE card_id = ? AND name = ? LIMIT ?"
+        )
+
+    def test_value_lists(self):
+        """ lists of values of any length share a fingerprint """
+        self.assertEqual(
+            fingerprint("SELECT * FROM card WHERE rarity IN (%(rarity_0)s, %(rarity_1)s)"),
+            fingerprint("SELECT * FROM card WHERE rarity IN (%(rarity_0)s)")
+        )
+
+    def test_whitespace(self):
+        """ indentation does not change the fingerprint """
+        self.assertEqual(fingerprint("\n    SELECT name\n    FROM format\n"), "SELECT name FROM format")
+
+
+class TestQueryStats(unittest.TestCase):
+    """
+    Checks the statistics gathered for each request
+    """
+    def setUp(self):
+        """ Creates an application to get request contexts from """
+        self.app = flask.Flask(__name__)
+
+    def test_record_outside_request(self):
+        """ statements executed outside of requests are not counted anywhere """
+        QueryStats.record("SELECT 1", 0.1, 1)
+
+    def test_record(self):
+        """ statements are aggregated by fingerprint """
+        with self.app.test_request_context():
+            flask.g.query_stats = QueryStats()
+            QueryStats.record("SELECT * FROM card WHERE card_id = %(card_id)s", 0.002, 1)
+            QueryStats.record("SELECT * FROM card WHERE card_id = 12", 0.003, 1)
+            QueryStats.record("UPDATE card SET price = 2", 0.005, -1)
+
+            stats = flask.g.query_stats
+            self.assertEqual((stats.count, stats.rows), (3, 2))
+            self.assertAlmostEqual(stats.time, 0.01)
+            self.assertEqual(stats.statements["SELECT * FROM card WHERE card_id = ?"][0], 2)
+            self.assertEqual(stats.server_timing(), 'db;dur=10.0;desc="3 queries, 2 rows"')
+
+    def test_slow_logs(self):
+        """ slow queries and requests are logged """
+        stats = QueryStats()
+        with self.app.test_request_context(), self.assertLogs(QueryStats.logger, "WARNING") as logs:
+            flask.g.query_stats = stats
+            QueryStats.record("SELECT * FROM card", QueryStats.slow_query_threshold + 1, 3)
+            stats.log_if_slow("GET /search")
+
+        self.assertIn("Slow query", logs.output[0])
+        self.assertIn("Slow request GET /search : 1 queries", logs.output[1])
+
+
+class Number(Model):
+    """
+    Model of a single table of numbers, stored in an in-memory SQLite database
+    """
+    def __init__(self, value: int):
+        self.value = value
+
+    @classmethod
+    def _table_creation_command(cls) -> str:
+        return "CREATE TABLE number (value INTEGER)"
+
+    @classmethod
+    def _insertion_command(cls) -> str:
+        return "INSERT INTO number (value) VALUES (%(value)s)"
+
+    @property
+    def _as_database_object(self) -> dict:
+        return {"value": self.value}
+
+    @property
+    def _primary_key(self) -> dict:
+        return self._as_database_object
+
+
+class TestModelStatements(unittest.TestCase):
+    """
+    Checks that every statement run by the models is recorded
+    """
+    def setUp(self):
+        """ Creates the table in a request context """
+        self.context = flask.Flask(__name__).test_request_context()
+        self.context.push()
+        flask.g.db = lib.db.sqlite.connect(":memory:")
+        Number.setup_table()
+        flask.g.query_stats = self.stats = QueryStats()
+
+    def tearDown(self):
+        """ Closes the database """
+        flask.g.db.close()
+        self.context.pop()
+
+    def test_statements_are_recorded(self):
+        """ insertions, modifications and reads are counted with their rows """
+        Number.bulk_insert([Number(value) for value in range(10)])
+        Number._modify("DELETE FROM number WHERE value >= %(value)s", value=8)
+        self.assertEqual(len(Number._get("SELECT * FROM number")), 8)
+        self.assertEqual(sum(row["value"] for row in Number._iterate("SELECT * FROM number", batch_size=3)), 28)
+
+        self.assertEqual(self.stats.count, 4)
+        self.assertEqual(self.stats.rows, 10 + 2 + 8 + 8)
+        self.assertEqual(self.stats.statements["SELECT * FROM number"][0], 2)
+
+    def test_caller_time_is_not_counted(self):
+        """ the time spent handling rows read one batch at a time is not time spent in the database """
+        Number.bulk_insert([Number(value) for value in range(4)])
+        for _ in Number._iterate("SELECT * FROM number", batch_size=2):
+            time.sleep(0.1)
+        self.assertLess(self.stats.statements["SELECT * FROM number"][1], 0.1)
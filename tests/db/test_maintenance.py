@@ -5,16 +5,91 @@
 This module tests entry of the data into the database
 """
 
-import mysql.connector
+import json
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
+import unittest.mock
 from flask import Flask
 
-from lib.db.maintenance import MaintenanceDB, lib
+import lib.exceptions
+from lib.db.maintenance import MaintenanceDB, UpdateJob, lib
 from lib.parser import JSonCardParser
 from tests import DBConnectionMixin, DownloadProxy, download_file_resources
 
 
+# catalog tables as created before metacards and formats had integer ids, with foreign keys named by hand
+LEGACY_CATALOG = [
+    """
+        CREATE TABLE metacard (
+            name VARCHAR(150) PRIMARY KEY,
+            types SET ('Land', 'Creature', 'Sorcery', 'Instant', 'Artifact', 'Planeswalker', 'Enchantment') NOT NULL,
+            subtypes VARCHAR(80),
+            supertypes SET('Legendary', 'Snow', 'World', 'Basic', 'Ongoing'),
+            manaCost VARCHAR(50),
+            power DECIMAL(3,1),
+            toughness DECIMAL(3,1),
+            colors SET('Red', 'Green', 'White', 'Blue', 'Black'),
+            cmc DECIMAL(8,1) NOT NULL,
+            orig_text TEXT
+        )
+    """,
+    """
+        CREATE TABLE card (
+            card_id INT PRIMARY KEY AUTO_INCREMENT,
+            multiverseid INT,
+            name VARCHAR(150) NOT NULL,
+            edition VARCHAR(8) NOT NULL,
+            rarity SET ('Basic Land', 'Common', 'Uncommon', 'Rare', 'Mythic Rare', 'Special') NOT NULL,
+            number VARCHAR(4) NOT NULL,
+            artist VARCHAR(150) NOT NULL,
+            flavor TEXT,
+            price DECIMAL(7,2),
+
+            CONSTRAINT card_metacard FOREIGN KEY (name) REFERENCES metacard(name)
+                ON DELETE RESTRICT ON UPDATE RESTRICT,
+            FOREIGN KEY (edition) REFERENCES edition(code) ON DELETE RESTRICT ON UPDATE RESTRICT,
+            UNIQUE (multiverseid, edition, number)
+        )
+    """,
+    "CREATE TABLE format (name VARCHAR(150) PRIMARY KEY)",
+    """
+        CREATE TABLE card_legal_in_format (
+            card_name VARCHAR(150) NOT NULL,
+            format VARCHAR(150) NOT NULL,
+            type SET('Restricted', 'Legal', 'Banned') NOT NULL,
+
+            CONSTRAINT legal_metacard FOREIGN KEY (card_name) REFERENCES metacard(name)
+                ON DELETE RESTRICT ON UPDATE RESTRICT,
+            CONSTRAINT legal_format FOREIGN KEY (format) REFERENCES format(name) ON DELETE RESTRICT ON UPDATE RESTRICT,
+            UNIQUE (card_name, format)
+        )
+    """,
+    """
+        INSERT INTO edition (code, releaseDate, name, type)
+        VALUES ('LEA', '1993-08-05', 'Limited Edition Alpha', 'core')
+    """,
+    """
+        INSERT INTO metacard (name, types, colors, cmc)
+        VALUES ('Lightning Bolt', 'Instant', 'Red', 1), ('Black Lotus', 'Artifact', NULL, 0)
+    """,
+    """
+        INSERT INTO card (multiverseid, name, edition, rarity, number, artist)
+        VALUES (209, 'Lightning Bolt', 'LEA', 'Common', '161', 'Christopher Rush'),
+            (3, 'Black Lotus', 'LEA', 'Rare', '232', 'Christopher Rush')
+    """,
+    "INSERT INTO format (name) VALUES ('Vintage'), ('Legacy')",
+    """
+        INSERT INTO card_legal_in_format (card_name, format, type)
+        VALUES ('Lightning Bolt', 'Vintage', 'Legal'), ('Lightning Bolt', 'Legacy', 'Legal'),
+            ('Black Lotus', 'Vintage', 'Restricted'), ('Black Lotus', 'Legacy', 'Banned')
+    """,
+    "DELETE FROM schema_migration WHERE model IN ('Metacard', 'Card')"
+]
+
+
 class TestMaintenanceDB(unittest.TestCase):
     """
     Tests the maintenance database
@@ -25,19 +100,14 @@ class TestMaintenanceDB(unittest.TestCase):
         self.app = Flask(__name__, static_folder=self.directory.name)
         self.app.notifier = lib.threading.Event()
         self.app.config.from_object(DBConnectionMixin)
+        self.app.config["RUN_DIRECTORY"] = self.directory.name
+        lib.db.configure(self.app)
         self.maintenance = MaintenanceDB(self.app)
         self.maintenance.setup_db()
 
     def tearDown(self):
         """ Connects to the database and empties it """
-        conn = mysql.connector.connect(
-            user=self.app.config["DATABASE_USER"], password=self.app.config["DATABASE_PASSWORD"],
-            host=self.app.config["DATABASE_HOST"], port=self.app.config["DATABASE_PORT"]
-        )
-        cursor = conn.cursor()
-        cursor.execute("DROP DATABASE IF EXISTS {}".format(self.app.config["DATABASE_NAME"]))
-        conn.commit()
-        conn.close()
+        lib.db.commands.drop_database(self.app)
         self.directory.cleanup()
 
     def test_update_empty_db(self):
@@ -52,3 +122,164 @@ class TestMaintenanceDB(unittest.TestCase):
 
         with DownloadProxy(JSonCardParser(self.app), version="3.3.4"):
             self.maintenance.update()
+
+    def test_setup_existing_db(self):
+        """ Setting up an already configured database keeps it as it is """
+        self.maintenance.setup_db()
+
+    @unittest.skipIf(DBConnectionMixin.DATABASE_BACKEND != "mysql", "databases older than migrations are MySQL ones")
+    def test_migrate_legacy_user_table(self):
+        """ Tables created before a migration get it applied, and only once """
+        conn = lib.db.get_connection(self.app)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("ALTER TABLE user DROP COLUMN iterations")
+            cursor.execute("DELETE FROM schema_migration WHERE model = 'User'")
+            conn.commit()
+
+            self.maintenance.migrate()
+            self.maintenance.migrate()
+
+            cursor.execute("SELECT version FROM schema_migration WHERE model = 'User'")
+            self.assertEqual(cursor.fetchall(), [(1,)])
+            cursor.execute("SHOW COLUMNS FROM user LIKE 'iterations'")
+            self.assertEqual(len(cursor.fetchall()), 1)
+        finally:
+            conn.close()
+
+    @unittest.skipIf(DBConnectionMixin.DATABASE_BACKEND != "mysql", "databases older than migrations are MySQL ones")
+    def test_migrate_surrogate_keys(self):
+        """ Catalogs keyed by names get integer ids, resuming the migration when it was interrupted """
+        conn = lib.db.get_connection(self.app)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+            # the legality matrix is newer than the surrogate keys, it is created once the catalog is migrated
+            for table in "legality_card", "legality_format", "metacard", "card", "format", "card_legal_in_format":
+                cursor.execute("DROP TABLE {}".format(table))
+            cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+            for command in LEGACY_CATALOG:
+                cursor.execute(command)
+            conn.commit()
+
+            steps = lib.db.commands.Migration.surrogate_keys()
+            interrupted = steps[:6] + ["SELECT * FROM interrupted_migration"]
+            with unittest.mock.patch.object(lib.db.commands.Migration, "surrogate_keys", return_value=interrupted):
+                self.assertRaises(lib.db.commands.Error, self.maintenance.migrate)
+            self.maintenance.migrate()
+
+            cursor.execute("SELECT model, version FROM schema_migration WHERE model IN ('Metacard', 'Card')")
+            self.assertEqual(sorted(cursor.fetchall()), [("Card", 2), ("Metacard", 2)])
+            cursor.execute("""
+                SELECT metacard.name, format.name, card_legal_in_format.type
+                FROM card_legal_in_format
+                INNER JOIN metacard ON metacard.metacard_id = card_legal_in_format.metacard_id
+                INNER JOIN format ON format.format_id = card_legal_in_format.format_id
+                ORDER BY metacard.name, format.name
+            """)
+            self.assertEqual(cursor.fetchall(), [
+                ("Black Lotus", "Legacy", {"Banned"}), ("Black Lotus", "Vintage", {"Restricted"}),
+                ("Lightning Bolt", "Legacy", {"Legal"}), ("Lightning Bolt", "Vintage", {"Legal"})
+            ])
+            cursor.execute("""
+                SELECT card.multiverseid, metacard.name
+                FROM card INNER JOIN metacard ON metacard.metacard_id = card.metacard_id
+                ORDER BY card.multiverseid
+            """)
+            self.assertEqual(cursor.fetchall(), [(3, "Black Lotus"), (209, "Lightning Bolt")])
+            for table, referenced in ("card", "metacard"), ("card_legal_in_format", "metacard"):
+                cursor.execute("""
+                    SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %(table)s
+                        AND REFERENCED_TABLE_NAME = %(referenced)s
+                """, dict(table=table, referenced=referenced))
+                self.assertEqual(cursor.fetchall(), [(1,)], table)
+            cursor.execute("""
+                SELECT GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'card' AND INDEX_NAME IN (
+                    SELECT INDEX_NAME FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'card' AND COLUMN_NAME = 'edition'
+                )
+                GROUP BY INDEX_NAME
+            """)
+            self.assertEqual(cursor.fetchall(), [("edition,rarity,number",)])
+        finally:
+            conn.close()
+
+
+class TestUpdateJob(unittest.TestCase):
+    """
+    Tests the progress and cancellation of update jobs
+    """
+    def setUp(self):
+        """ Creates an app with its run directory in a temporary directory """
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__, static_folder=self.directory.name)
+        self.app.notifier = lib.threading.Event()
+        self.app.config["RUN_DIRECTORY"] = self.directory.name
+        self.job = UpdateJob(self.app)
+
+    def tearDown(self):
+        """ Cleans the run directory """
+        self.directory.cleanup()
+
+    def test_progress_and_timings(self):
+        """ Checks that phases are timed and that progress is reported to other processes """
+        with self.job.phase("version check", 10):
+            pass
+        with self.job.phase("insert Card", 90):
+            self.job.advance(1, 2)
+            self.assertEqual(self.job.progress, 55)
+        self.job.end("finished")
+
+        status = UpdateJob.status(self.app)
+        self.assertEqual(status["state"], "finished")
+        self.assertEqual(status["progress"], 100)
+        self.assertEqual(list(status["timings"].keys()), ["version check", "insert Card"])
+        self.assertEqual(status["rows"], {"insert Card": 2})
+
+    def test_rewind(self):
+        """ Checks that phases run again after rewinding are not counted twice """
+        with self.job.phase("parse", 40):
+            pass
+        with self.assertRaises(lib.db.commands.Error):
+            with self.job.phase("insert Card", 60):
+                self.job.advance(1, 2)
+                raise lib.db.commands.Error("Unknown database")
+        self.job.rewind(40)
+        self.assertEqual(self.job.progress, 40)
+
+        with self.job.phase("insert Card", 60):
+            self.job.advance(1, 2)
+            self.assertEqual(self.job.progress, 70)
+        self.job.end("finished")
+        self.assertEqual(UpdateJob.status(self.app)["progress"], 100)
+
+    def test_cancel(self):
+        """ Checks that a cancelled job stops at the next batch """
+        with self.job.phase("insert Card", 100):
+            self.job.advance(1, 3)
+            UpdateJob.cancel(self.app)
+            self.assertRaises(lib.exceptions.UpdateCancelledException, self.job.advance, 2, 3)
+        self.job.end("cancelled")
+        self.assertEqual(UpdateJob.status(self.app)["state"], "cancelled")
+        self.assertIsNone(UpdateJob(self.app).check_cancelled())
+
+    def test_cancelled_when_stopping(self):
+        """ Checks that a job is cancelled when its process stops """
+        stopped = threading.Event()
+        job = UpdateJob(self.app, stopped)
+        job.check_cancelled()
+        stopped.set()
+        self.assertRaises(lib.exceptions.UpdateCancelledException, job.check_cancelled)
+
+    def test_dead_process(self):
+        """ Checks that a job left running by a process that died is failed """
+        self.job.publish()
+        self.assertEqual(UpdateJob.status(self.app)["state"], "running")
+
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        with open(UpdateJob.status_path(self.app), "w") as status_file:
+            status_file.write(json.dumps(dict(self.job.as_dict(), pid=process.pid)))
+        self.assertEqual(UpdateJob.status(self.app)["state"], "failed")
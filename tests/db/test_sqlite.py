@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the SQLite backend, which runs in-process and needs no server
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+
+import lib.db
+import lib.exceptions
+from lib.db import sqlite
+from lib.db.maintenance import MaintenanceDB
+from lib.models import Card, Deck, Metacard
+from lib.models.collection import CardInCollection
+from tests.catalog import populate
+
+
+class TestTranslation(unittest.TestCase):
+    """
+    Checks that statements written for the MySQL connector are understood by SQLite
+    """
+    def test_parameters_are_named(self):
+        """ %(name)s parameters become :name ones """
+        self.assertEqual(
+            sqlite.translate("SELECT * FROM user WHERE user_id = %(user_id)s"),
+            ("SELECT * FROM user WHERE user_id = :user_id;",)
+        )
+
+    def test_statements_are_split(self):
+        """ each command of a statement is run on its own, triggers staying whole """
+        self.assertEqual(len(sqlite.translate(sqlite.Metacard.create_table())), 4)
+        for trigger in sqlite.DeckCardNeed.triggers():
+            self.assertEqual(len(sqlite.translate(trigger)), 1)
+
+
+class TestSets(unittest.TestCase):
+    """
+    Checks the bitmasks replacing MySQL's SET columns
+    """
+    def test_bits_are_mysql_ones(self):
+        """ members have the values MySQL gives them, which the color searches rely on """
+        self.assertEqual(sqlite.to_mask("colors", "Red,Black"), 1 + 16)
+        self.assertEqual(sqlite.to_members("colors", 1 + 16), "Red,Black")
+        self.assertEqual(sqlite.to_set("supertypes", b"3"), {"Legendary", "Snow"})
+
+    def test_empty_sets(self):
+        """ NULL stays NULL and the empty set is 0 """
+        self.assertIsNone(sqlite.to_mask("colors", None))
+        self.assertEqual(sqlite.to_mask("colors", ""), 0)
+        self.assertEqual(sqlite.to_set("colors", b"0"), set())
+
+    def test_unknown_member(self):
+        """ values outside of the set are refused, as MySQL does in strict mode """
+        with self.assertRaises(ValueError):
+            sqlite.to_mask("colors", "Purple")
+
+
+class TestSQLiteDatabase(unittest.TestCase):
+    """
+    Runs the models against a SQLite database holding a small synthetic catalog
+    """
+    def setUp(self):
+        """ Creates the database in a temporary directory and fills it """
+        self.directory = tempfile.mkdtemp()
+        self.backend = lib.db.commands.backend
+        self.app = flask.Flask(__name__, static_folder=os.path.join(self.directory, "static"))
+        self.app.config.update(
+            DATABASE_BACKEND="sqlite", DATABASE_NAME="mtg_test.sqlite3", RUN_DIRECTORY=self.directory
+        )
+        lib.db.configure(self.app)
+        MaintenanceDB(self.app).setup_db()
+
+        self.context = self.app.app_context()
+        self.context.push()
+        flask.g.db = lib.db.get_connection(self.app)
+        self.user_id, = populate(self.app, flask.g.db, 0.02, users=1, collection_size=50)
+
+    def tearDown(self):
+        """ Closes the database and removes it """
+        flask.g.db.close()
+        self.context.pop()
+        lib.db.use(self.backend)
+        shutil.rmtree(self.directory)
+
+    def test_setup_existing_db(self):
+        """ Setting up an existing database keeps it as it is """
+        MaintenanceDB(self.app).setup_db()
+        self.assertEqual(len(Card.get_collection(self.user_id)), 50)
+
+    def test_sets_are_read_as_sets(self):
+        """ set columns are given back as python sets, as the MySQL connector does """
+        card = Card.get(Metacard.get_ids_where(types="Creature")[0]["card_id"])[0]
+        self.assertIn("Creature", card["types"])
+        self.assertEqual(len(card["rarity"]), 1)
+        self.assertTrue(set(Card.rarities()) <= set(sqlite.rarities))
+
+    def test_color_searches(self):
+        """ searches by color work on the bitmasks """
+        red = Metacard.get_ids_where(colors=["Red", "all_selected", "only_selected"])
+        self.assertTrue(red)
+        for row in red:
+            self.assertEqual(Card.get(row["card_id"])[0]["colors"], {"Red"})
+
+        for row in Metacard.get_ids_where(colors=["Colorless"]):
+            self.assertIsNone(Card.get(row["card_id"])[0]["colors"])
+
+    def test_collection_search(self):
+        """ the search in the user's collection only gives back owned cards """
+        owned = Metacard.get_ids_where(user_id=self.user_id, in_collection=True)
+        self.assertTrue(owned)
+        for row in owned:
+            self.assertGreater(row["normal"] + row["foil"], 0)
+
+    def test_deck_triggers(self):
+        """ the summary and needed cards of decks are kept up to date by triggers, for each printing """
+        decks = Deck(self.user_id)
+        card_ids = [row["card_id"] for row in Metacard.get_ids_where(colors=["Red", "all_selected", "only_selected"])]
+        decks.add("burn")
+        for card_id in card_ids:
+            decks.add_card("burn", card_id, 3, side=False)
+            decks.add_card("burn", card_id, 1, side=True)
+
+        summary, = decks.list()
+        self.assertEqual(
+            (summary["n_deck"], summary["n_side"], summary["colors"]), (3 * len(card_ids), len(card_ids), ["{R}"])
+        )
+        missing = {row["card_id"]: row["number"] for row in decks.get_all_missing().get("burn", [])}
+        cursor = flask.g.db.cursor()
+        for card_id in card_ids:
+            cursor.execute(
+                "SELECT normal + foil FROM card_in_collection WHERE user_id = %(user_id)s AND card_id = %(card_id)s",
+                dict(user_id=self.user_id, card_id=card_id)
+            )
+            owned = sum(row[0] for row in cursor.fetchall())
+            self.assertEqual(missing.get(card_id, 0), max(0, 4 - owned), card_id)
+        cursor.close()
+
+        for card_id in card_ids:
+            decks.remove_card("burn", card_id, side=False)
+            decks.remove_card("burn", card_id, side=True)
+        self.assertEqual(decks.list()[0]["n_deck"], 0)
+        self.assertEqual(decks.get_all_missing(), {})
+        decks.delete("burn")
+        self.assertEqual(decks.list(), [])
+
+    def test_duplicate_deck_name(self):
+        """ renaming a deck to the name of another one is refused """
+        decks = Deck(self.user_id)
+        decks.add("first")
+        decks.add("second")
+        with self.assertRaises(lib.exceptions.DataManipulationException):
+            decks.rename("first", "second")
+
+    def test_collection_import(self):
+        """ imported cards are resolved in the temporary table and unknown ones are reported """
+        card = CardInCollection.export(self.user_id)[0]
+        unresolved = CardInCollection.import_cards(self.user_id, [
+            CardInCollection(card["name"], card["edition"], card["number"], 7, 2),
+            CardInCollection("Unknown card", "XXX", "1", 1, 0),
+        ])
+        self.assertEqual([row["name"] for row in unresolved], ["Unknown card"])
+        self.assertIn(
+            dict(card, normal=7, foil=2), CardInCollection.export(self.user_id)
+        )
+
+        # the temporary table is dropped after each import
+        self.assertEqual(CardInCollection.import_cards(self.user_id, []), [])
+
+    def test_update_lock(self):
+        """ only one holder of the update lock at once """
+        with MaintenanceDB(self.app).update_lock() as acquired:
+            self.assertTrue(acquired)
+            with MaintenanceDB(self.app).update_lock() as acquired_again:
+                self.assertFalse(acquired_again)
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the collection models
+"""
+
+import io
+import json
+from collections import Counter
+import tempfile
+import typing
+import unittest
+
+import flask
+
+import lib.db
+import lib.exceptions
+import lib.json
+from lib.db.maintenance import MaintenanceDB
+from lib.models import Card, Deck, FormatLegality, Metacard, User
+from lib.models.collection import CardInCollection, Collection, count_pips
+from tests import DBConnectionMixin
+from tests.catalog import populate
+
+
+class TestCountPips(unittest.TestCase):
+    """
+    Checks the counting of colored mana symbols in mana costs
+    """
+    def test_generic_mana_is_ignored(self):
+        """ generic and colorless mana are not pips """
+        self.assertEqual(count_pips("{3}{X}{C}"), {})
+
+    def test_colored_symbols(self):
+        """ each colored symbol counts once """
+        self.assertEqual(count_pips("{2}{W}{W}{U}"), {"White": 2, "Blue": 1})
+
+    def test_hybrid_and_phyrexian_symbols(self):
+        """ hybrid symbols count for each of their colors, phyrexian ones for their color """
+        self.assertEqual(count_pips("{R/G}{2/B}{W/P}"), {"Red": 1, "Green": 1, "Black": 1, "White": 1})
+
+    def test_no_mana_cost(self):
+        """ lands have no mana cost """
+        self.assertEqual(count_pips(None), {})
+
+
+class CollectionTestCase(unittest.TestCase):
+    """
+    Creates a database holding a small synthetic catalog and a user owning some of its cards
+    """
+    def setUp(self):
+        """ Creates the database and fills it """
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = flask.Flask(__name__, static_folder=self.directory.name)
+        self.app.config.from_object(DBConnectionMixin)
+        self.app.config["RUN_DIRECTORY"] = self.directory.name
+        lib.db.configure(self.app)
+        MaintenanceDB(self.app).setup_db()
+
+        self.context = self.app.app_context()
+        self.context.push()
+        flask.g.db = lib.db.get_connection(self.app)
+        self.user_id, = populate(self.app, flask.g.db, 0.02, users=1, collection_size=50)
+        self.decks = Deck(self.user_id)
+
+    def tearDown(self):
+        """ Drops the database """
+        flask.g.db.close()
+        self.context.pop()
+        lib.db.commands.drop_database(self.app)
+        self.directory.cleanup()
+
+    @staticmethod
+    def card_ids(count: int, **search) -> list:
+        """
+        Gets the ids of cards of different names
+
+        :param count: number of cards to get
+        :param search: criteria of the cards, as for Metacard.get_ids_where
+        :return: the ids of the cards
+        """
+        return [row["card_id"] for row in Metacard.get_ids_where(**search)[:count]]
+
+
+class TestDeckUpload(CollectionTestCase):
+    """
+    Checks that uploads are saved entirely or not at all
+    """
+    def setUp(self):
+        """ Creates the json of a deck of a few cards """
+        super().setUp()
+        self.decks.add("burn")
+        for card_id in self.card_ids(3):
+            self.decks.add_card("burn", card_id, 2, side=False)
+        self.decks.add_card("burn", self.card_ids(1)[0], 1, side=True)
+        self.deck = json.dumps(self.decks.export("burn"), cls=lib.json.CustomJSONEncoder)
+        self.decks.delete("burn")
+
+    def test_upload_deck(self):
+        """ a valid deck is saved with all its cards """
+        self.decks.load(lib.json.read_deck(io.StringIO(self.deck), buffer_size=16), batch_size=1)
+        self.assertEqual(json.loads(self.deck), json.loads(json.dumps(
+            self.decks.export("burn"), cls=lib.json.CustomJSONEncoder
+        )))
+
+    def test_malformed_deck_is_not_saved(self):
+        """ a truncated deck saves nothing, even cards read before the error, and can be uploaded again """
+        with self.assertRaises(lib.json.JSONDecodeError):
+            self.decks.load(lib.json.read_deck(io.StringIO(self.deck[:-20]), buffer_size=16), batch_size=1)
+        self.assertEqual(self.decks.list(), [])
+
+        self.decks.load(lib.json.read_deck(io.StringIO(self.deck)))
+        self.assertEqual([deck["name"] for deck in self.decks.list()], ["burn"])
+
+    def test_existing_deck(self):
+        """ uploading a deck with the name of an existing one is refused """
+        self.decks.load(lib.json.read_deck(io.StringIO(self.deck)))
+        with self.assertRaises(lib.exceptions.DataManipulationException):
+            self.decks.load(lib.json.read_deck(io.StringIO(self.deck)))
+        self.assertEqual(len(self.decks.list()), 1)
+
+    def test_malformed_collection_is_not_saved(self):
+        """ a truncated collection changes neither the cards owned nor the decks """
+        collection = Collection(self.user_id)
+        owned = sorted(map(json.dumps, collection.iter_export()))
+        document = json.dumps({"decks": [json.loads(self.deck)], "collection": [
+            {"name": row["name"], "edition": row["edition"], "number": row["number"], "normal": 9, "foil": 9}
+            for _, row in collection.iter_export()
+        ]})
+
+        with self.assertRaises(lib.json.JSONDecodeError):
+            collection.load(lib.json.read_collection(io.StringIO(document[:-20]), buffer_size=16), batch_size=1)
+        self.assertEqual(sorted(map(json.dumps, collection.iter_export())), owned)
+
+        self.assertEqual(collection.load(lib.json.read_collection(io.StringIO(document))), [])
+        self.assertEqual([deck["name"] for deck in self.decks.list()], ["burn"])
+
+
+class TestDeckSummary(CollectionTestCase):
+    """
+    Checks that the triggers keep the summary of the decks up to date
+    """
+    def setUp(self):
+        """ Creates an empty deck """
+        super().setUp()
+        self.decks.add("burn")
+
+    def summary(self) -> typing.Dict:
+        """ Gets the summary of the deck """
+        summary, = self.decks.list()
+        return summary
+
+    def assertSummaryIsRecomputed(self):
+        """ Checks that the summary kept by the triggers is the one computed again from the content of the deck """
+        summary = self.summary()
+        cursor = flask.g.db.cursor()
+        cursor.execute(lib.db.commands.DeckSummary.refresh())
+        cursor.close()
+        flask.g.db.commit()
+        self.assertEqual(self.summary(), summary)
+
+    def test_empty_deck(self):
+        """ a new deck has an empty summary """
+        self.assertEqual(self.summary(), {"name": "burn", "user_index": 0, "n_deck": 0, "n_side": 0, "colors": None})
+
+    def test_add_cards(self):
+        """ adding cards adds their copies to the counts """
+        first, second = self.card_ids(2)
+        self.decks.add_card("burn", first, 2, side=False)
+        self.decks.add_card("burn", second, 3, side=False)
+        self.decks.add_card("burn", first, 1, side=True)
+        self.assertEqual((self.summary()["n_deck"], self.summary()["n_side"]), (5, 1))
+        self.assertSummaryIsRecomputed()
+
+    def test_change_number(self):
+        """ changing the number of copies of a card moves the counts by the difference """
+        card_id, = self.card_ids(1)
+        self.decks.add_card("burn", card_id, 4, side=False)
+        self.decks.add_card("burn", card_id, 1, side=False)
+        self.assertEqual(self.summary()["n_deck"], 1)
+        self.decks.add_card("burn", card_id, 3, side=False)
+        self.assertEqual(self.summary()["n_deck"], 3)
+        self.assertSummaryIsRecomputed()
+
+    def test_remove_card(self):
+        """ removing the only card of a color removes the color """
+        first, *others = self.card_ids(30)
+        self.decks.add_card("burn", first, 2, side=False)
+        colors = self.summary()["colors"]
+        for card_id in others:
+            self.decks.add_card("burn", card_id, 1, side=True)
+            if self.summary()["colors"] != colors:
+                break
+            self.decks.remove_card("burn", card_id, side=True)
+        else:
+            self.skipTest("the catalog has no card of another color")
+
+        self.decks.remove_card("burn", card_id, side=True)
+        self.assertEqual((self.summary()["n_side"], self.summary()["colors"]), (0, colors))
+        self.assertSummaryIsRecomputed()
+
+
+class TestDeckCardNeed(CollectionTestCase):
+    """
+    Checks that the triggers keep the cards missing from the decks up to date
+    """
+    def setUp(self):
+        """ Creates a deck and gives the user one copy of a card and none of another """
+        super().setUp()
+        self.decks.add("burn")
+        self.owned, self.unowned = self.card_ids(2)
+        CardInCollection.insert(self.user_id, self.owned, 1, 0)
+        CardInCollection.insert(self.user_id, self.unowned, 0, 0)
+
+    def missing(self) -> typing.Dict[int, int]:
+        """ Gets the number of missing copies of each card of the deck, as listed for all decks """
+        missing = self.decks.get_all_missing()
+        self.assertEqual(
+            sorted(missing.get("burn", []), key=lambda row: row["card_id"]),
+            sorted(self.decks.get_cards("burn")["missing"], key=lambda row: row["card_id"])
+        )
+        return {row["card_id"]: row["number"] for row in missing.get("burn", [])}
+
+    def test_card_added(self):
+        """ copies needed by the deck and side deck together are compared to the copies owned """
+        self.decks.add_card("burn", self.owned, 1, side=False)
+        self.assertEqual(self.missing(), {})
+
+        self.decks.add_card("burn", self.owned, 2, side=True)
+        self.decks.add_card("burn", self.unowned, 2, side=False)
+        self.assertEqual(self.missing(), {self.owned: 2, self.unowned: 2})
+
+    def test_card_removed(self):
+        """ removing a card or copies of it lowers the number missing """
+        self.decks.add_card("burn", self.owned, 4, side=False)
+        self.decks.add_card("burn", self.unowned, 2, side=True)
+
+        self.decks.remove_card("burn", self.unowned, side=True)
+        self.assertEqual(self.missing(), {self.owned: 3})
+        self.decks.add_card("burn", self.owned, 2, side=False)
+        self.assertEqual(self.missing(), {self.owned: 1})
+
+    def test_collection_changed(self):
+        """ adding normal or foil copies to the collection, or removing them, changes the number missing """
+        self.decks.add_card("burn", self.owned, 3, side=False)
+        self.decks.add_card("burn", self.unowned, 1, side=False)
+        self.decks.add("sligh")
+        self.decks.add_card("sligh", self.unowned, 2, side=False)
+
+        CardInCollection.insert(self.user_id, self.owned, 1, 1)
+        CardInCollection.insert(self.user_id, self.unowned, 1, 0)
+        self.assertEqual(self.missing(), {self.owned: 1})
+        self.assertEqual(self.decks.get_all_missing()["sligh"], [{"card_id": self.unowned, "number": 1}])
+
+        CardInCollection.insert(self.user_id, self.owned, 0, 0)
+        self.assertEqual(self.missing(), {self.owned: 3})
+
+    def test_other_users(self):
+        """ the collection of another user does not count """
+        other_user = User("goat", "goat@goatsy.com", "1234").create()
+        CardInCollection.insert(int(other_user.get_id()), self.unowned, 4, 0)
+        self.decks.add_card("burn", self.unowned, 1, side=False)
+        self.assertEqual(self.missing(), {self.unowned: 1})
+
+
+class TestCollectionSearch(CollectionTestCase):
+    """
+    Checks the search restricted to the cards of the user's collection
+    """
+    def test_in_collection(self):
+        """ every metacard with an owned copy is found, with the copies of all its cards, and only those """
+        cursor = flask.g.db.cursor()
+        cursor.execute("SELECT card_id, metacard_id FROM card")
+        metacards = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT card.metacard_id, SUM(card_in_collection.normal), SUM(card_in_collection.foil)
+            FROM card_in_collection
+            INNER JOIN card ON card.card_id = card_in_collection.card_id
+            WHERE card_in_collection.user_id = %(user_id)s
+            GROUP BY card.metacard_id
+            HAVING SUM(card_in_collection.normal + card_in_collection.foil) > 0
+        """, dict(user_id=self.user_id))
+        owned = {metacard_id: (int(normal), int(foil)) for metacard_id, normal, foil in cursor.fetchall()}
+        cursor.close()
+
+        found = Metacard.get_ids_where(user_id=self.user_id, in_collection=True)
+        self.assertTrue(owned)
+        self.assertEqual(
+            {metacards[row["card_id"]]: (int(row["normal"]), int(row["foil"])) for row in found}, owned
+        )
+        self.assertEqual(len(found), len(owned))
+
+
+class TestDeckAnalytics(CollectionTestCase):
+    """
+    Checks the statistics of decks and their cache
+    """
+    def setUp(self):
+        """ Creates a deck of a land, two spells and a card in the side deck """
+        super().setUp()
+        Deck.analytics_cache.clear()
+        self.land, = self.card_ids(1, types="Land")
+        self.spells = self.card_ids(2, types="Creature")
+        self.side, = self.card_ids(1, types="Instant")
+        self.decks.add("burn")
+        self.decks.add_card("burn", self.land, 4, side=False)
+        for spell in self.spells:
+            self.decks.add_card("burn", spell, 2, side=False)
+        self.decks.add_card("burn", self.side, 3, side=True)
+
+    def tearDown(self):
+        """ Empties the cache, decks of the next test getting the same ids """
+        Deck.analytics_cache.clear()
+        super().tearDown()
+
+    def test_unknown_deck(self):
+        """ a deck that does not exist has no statistics """
+        self.assertIsNone(self.decks.get_analytics("sligh"))
+
+    def test_statistics(self):
+        """ the main deck's curve, colored symbols and types are counted, the side deck only counts for legality """
+        main = [(Card.get(self.land)[0], 4)] + [(Card.get(card_id)[0], 2) for card_id in self.spells]
+        spells = [card for card, _ in main[1:]]
+        curve = Counter(int(spell["cmc"]) for spell in spells for _ in range(2))
+        pips, types = Counter(), Counter()
+        for card, number in main:
+            for color, count in count_pips(card["manaCost"]).items():
+                pips[color] += number * count
+            for card_type in card["types"]:
+                types[card_type] += number
+
+        analytics = self.decks.get_analytics("burn")
+        self.assertEqual(analytics["cards"], 8)
+        self.assertEqual({cmc: count for cmc, count in analytics["curve"].items() if count}, dict(curve))
+        self.assertEqual(analytics["average_cmc"], round(sum(float(spell["cmc"]) for spell in spells) / 2, 2))
+        self.assertEqual({color: count for color, count in analytics["pips"].items() if count}, dict(pips))
+        self.assertEqual(analytics["types"], dict(types))
+
+        legality = FormatLegality.get_matrix().illegal_cards({
+            Card.get(card_id)[0]["name"]: number
+            for card_id, number in [(self.land, 4), (self.side, 3)] + [(spell, 2) for spell in self.spells]
+        })
+        self.assertEqual(analytics["legality"], {
+            format_name: {"legal": not names, "illegal": names} for format_name, names in legality.items()
+        })
+
+    def test_cached_until_changed(self):
+        """ statistics are computed once for each revision of the deck """
+        analytics = self.decks.get_analytics("burn")
+        self.assertIs(self.decks.get_analytics("burn"), analytics)
+
+        self.decks.add_card("burn", self.spells[0], 4, side=False)
+        changed = self.decks.get_analytics("burn")
+        self.assertIsNot(changed, analytics)
+        self.assertEqual(changed["cards"], 10)
+
+        self.decks.remove_card("burn", self.side, side=True)
+        self.assertIsNot(self.decks.get_analytics("burn"), changed)
+
+    def test_deck_recreated(self):
+        """ a deck deleted and created again under the same name does not get the statistics of the old one """
+        self.decks.get_analytics("burn")
+        self.decks.delete("burn")
+        self.decks.add("burn")
+        self.assertEqual(self.decks.get_analytics("burn")["cards"], 0)
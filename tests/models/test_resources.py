@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the legality matrix
+"""
+
+import unittest
+
+import flask
+
+import lib.db
+from lib.db.maintenance import MaintenanceDB
+from lib.models.resources import FormatLegality, LegalityMatrix
+from tests.models.test_collection import CollectionTestCase
+
+
+class TestLegalityMatrix(unittest.TestCase):
+    """
+    Checks deck validation against the legality bitsets
+    """
+    def setUp(self):
+        """ Three cards : Bolt is legal everywhere, Lotus restricted in Vintage and Ring banned in Legacy """
+        self.matrix = LegalityMatrix(["Bolt", "Lotus", "Ring"], {
+            "Legacy": (0b001, 0b000),
+            "Vintage": (0b101, 0b010),
+        })
+
+    def test_legal_deck(self):
+        """ a deck of legal cards is legal """
+        self.assertEqual(self.matrix.check({"Bolt": 4}), {"Legacy": True, "Vintage": True})
+
+    def test_banned_card(self):
+        """ a card absent from both bitsets makes the deck illegal """
+        self.assertEqual(self.matrix.check({"Bolt": 4, "Ring": 1}), {"Legacy": False, "Vintage": True})
+        self.assertEqual(self.matrix.illegal_cards({"Bolt": 4, "Ring": 1}), {"Legacy": ["Ring"], "Vintage": []})
+
+    def test_restricted_card(self):
+        """ restricted cards are allowed only once """
+        self.assertTrue(self.matrix.check({"Lotus": 1})["Vintage"])
+        self.assertFalse(self.matrix.check({"Lotus": 2})["Vintage"])
+        self.assertEqual(self.matrix.illegal_cards({"Lotus": 2})["Vintage"], ["Lotus"])
+
+    def test_unknown_card(self):
+        """ cards missing from the matrix are never legal """
+        self.assertEqual(self.matrix.check({"Bolt": 1, "Unknown": 1}), {"Legacy": False, "Vintage": False})
+        self.assertEqual(self.matrix.illegal_cards({"Unknown": 1})["Vintage"], ["Unknown"])
+
+    def test_serialization(self):
+        """ bitsets are stored on as many bytes as needed for all cards """
+        self.assertEqual(int.from_bytes(self.matrix.to_bytes(0b101), "little"), 0b101)
+        self.assertEqual(len(self.matrix.to_bytes(0)), 1)
+
+
+class TestFormatLegality(CollectionTestCase):
+    """
+    Checks the legality matrix stored in the database
+    """
+    def test_built_when_migrating(self):
+        """ a catalog inserted before the matrix existed gets it built by the migration """
+        matrix = FormatLegality.get_matrix()
+        self.assertTrue(matrix.formats)
+
+        cursor = flask.g.db.cursor()
+        for command in lib.db.commands.FormatLegality.clear():
+            cursor.execute(command)
+        cursor.close()
+        flask.g.db.commit()
+        self.assertFalse(FormatLegality.is_built())
+
+        MaintenanceDB(self.app).migrate()
+        self.assertTrue(FormatLegality.is_built())
+        self.assertEqual(FormatLegality.get_matrix().formats, matrix.formats)
+        self.assertEqual(FormatLegality.get_matrix().cards, matrix.cards)
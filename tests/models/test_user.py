@@ -6,12 +6,16 @@ Tests for the User model. These tests are critical as they are our only guarante
 safely kept in our application
 """
 
+import os
+import queue
+import tempfile
 import unittest
 from typing import Iterable
 
 import lib.exceptions
 from tests import TestCaseWithDB
 from lib.models import User
+from lib.threading import SharedEvent
 
 
 # noinspection SpellCheckingInspection
@@ -107,3 +111,45 @@ class TestUser(TestCaseWithDB, unittest.TestCase):
     def test_user_can_have_same_name_and_email(self):
         """ Checks that a user can have the same email and username """
         User("goat@tsy.com", "goat@tsy.com", "hi").create()
+
+    def test_rehash_on_login(self):
+        """ Checks that passwords are transparently rehashed with the new work factor on login """
+        old_iterations = User.iterations
+        User.iterations = 1000
+        try:
+            self.assertFalse(self.user1.check_password("NotVerySecure"))
+            self.assertTrue(self.user1.check_password("verysecure"))
+
+            user = User.get_user_by_id(self.user1.get_id())
+            self.assertEqual(user._as_database_object()["iterations"], 1000)
+            self.assertTrue(user.check_password("verysecure"))
+            self.assertFalse(user.check_password("NotVerySecure"))
+        finally:
+            User.iterations = old_iterations
+
+    def test_cached_user_invalidation(self):
+        """ Checks that cached users are dropped when they are modified """
+        User.cache.clear()
+        user = User.get_cached_user_by_id(self.user1.get_id())
+        self.assertIs(User.get_cached_user_by_id(self.user1.get_id()), user)
+
+        user.set_admin()
+        self.assertIsNot(User.get_cached_user_by_id(self.user1.get_id()), user)
+        self.assertTrue(User.get_cached_user_by_id(self.user1.get_id()).is_admin)
+
+        user = User.get_cached_user_by_id(self.user1.get_id())
+        user.update("goat", self.email1)
+        self.assertEqual(User.get_cached_user_by_id(self.user1.get_id()).username, "goat")
+
+    def test_cached_user_invalidation_is_sent(self):
+        """ Checks that other processes are told when a user is modified, for them to drop it from their cache """
+        received = queue.Queue()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "user-changes")
+            old_changes, User.changes = User.changes, SharedEvent(path, poll_interval=0.01)
+            try:
+                SharedEvent(path, poll_interval=0.01, callback=received.put)
+                self.user1.set_admin(False)
+                self.assertEqual(received.get(timeout=2), self.user1.get_id())
+            finally:
+                User.changes = old_changes
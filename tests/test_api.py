@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the json API on a configured application
+"""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class TestDeckApi(unittest.TestCase):
+    """
+    Edits a deck through the API, in a new interpreter configuring the application on a SQLite database
+    """
+    setup = "\n".join([
+        "import json",
+        "import os",
+        "import lib.db",
+        "import mtgcollector",
+        "from tests.catalog import populate",
+        "app = mtgcollector.create_app(background_tasks=False)",
+        "app.static_folder = os.path.dirname(os.environ['MTG_COLLECTOR_CONFIG'])",
+        "connection = lib.db.get_connection(app)",
+        "user_id, = populate(app, connection, 0.01, users=1, collection_size=10)",
+        "card_id, other_card_id = [row[0] for row in connection.cursor().execute('SELECT card_id FROM card LIMIT 2')]",
+        "connection.close()",
+        "client = app.test_client()",
+        "with client.session_transaction() as session:",
+        "    session['user_id'] = str(user_id)",
+        "",
+    ])
+
+    def setUp(self):
+        """ Writes the configuration in a temporary directory, which also holds the database """
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.directory.name, "config.cfg")
+        with open(self.config, "w") as config_file:
+            config_file.write("DATABASE_BACKEND = 'sqlite'\nDATABASE_NAME = 'mtg.db'\nRUN_DIRECTORY = {!r}\n"
+                              "SECRET_KEY = 'test'\nWTF_CSRF_ENABLED = False\n".format(self.directory.name))
+
+    def tearDown(self):
+        """ Removes the configuration and the database """
+        self.directory.cleanup()
+
+    def run_client(self, code: str):
+        """
+        Runs the code with a client logged in as a user owning some cards
+
+        :param code: code using the client and printing what to check as json
+        :return: what the code printed
+        """
+        return json.loads(subprocess.check_output([
+            sys.executable, "-c", self.setup + code
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=dict(os.environ, MTG_COLLECTOR_CONFIG=self.config)).decode())
+
+    def test_remove_card_from_deck(self):
+        """ Checks that removing a card from a deck leaves only the other cards in it """
+        statuses, other_card_id = self.run_client("\n".join([
+            "statuses = [",
+            "    client.post('/api/decks/burn').status_code,",
+            "    client.post('/api/decks/burn/{}'.format(card_id), data={'n_cards': 2}).status_code,",
+            "    client.post('/api/decks/burn/{}'.format(other_card_id), data={'n_cards': 3}).status_code,",
+            "    client.delete('/api/decks/burn/{}'.format(card_id)).status_code,",
+            "]",
+            "print(json.dumps([statuses, other_card_id]))",
+        ]))
+        self.assertEqual(statuses, [200, 200, 200, 200])
+
+        connection = sqlite3.connect(os.path.join(self.directory.name, "mtg.db"))
+        try:
+            cards = connection.execute("SELECT card_id, number FROM card_in_deck").fetchall()
+        finally:
+            connection.close()
+        self.assertEqual(cards, [(other_card_id, 3)])
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the helpers of the benchmarks
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import zipfile
+
+import requests
+
+from benchmarks import Recorder, compare, summarize
+from benchmarks.load import StandIn, Statistics
+from benchmarks.search import default_mix, load_mix
+from lib.parser import JSonCardParser
+from tests import test_parser
+from tests.catalog import generate_dump, write_dump
+
+
+class TestUpdateBenchmark(unittest.TestCase):
+    """
+    Checks the synthetic dumps used to benchmark the update
+    """
+    def setUp(self):
+        """ Creates a folder for the parser """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Removes the parser's folder """
+        shutil.rmtree(self.directory)
+
+    def test_dump_is_reproducible_and_scaled(self):
+        """ the same seed gives the same dump, and the scale multiplies the number of editions """
+        self.assertEqual(generate_dump(0.01, seed=3), generate_dump(0.01, seed=3))
+        self.assertEqual(len(generate_dump(0.05)), 5 * len(generate_dump(0.01)))
+
+    def test_dump_is_parsed(self):
+        """ the parser reads synthetic dumps as real ones """
+        dump = generate_dump(0.01)
+        parser = JSonCardParser(test_parser.TestJSonCardParser.DummyFlask(self.directory))
+        write_dump(dump, os.path.join(self.directory, "dump.zip"))
+        shutil.unpack_archive(os.path.join(self.directory, "dump.zip"), self.directory)
+        os.rename(
+            os.path.join(self.directory, "AllSets-x.json"), os.path.join(parser.download_directory, "cards-1.0.0.json")
+        )
+
+        self.assertEqual(len(parser.editions), len(dump))
+        self.assertEqual(len(parser.cards), sum(len(edition["cards"]) for edition in dump.values()))
+        self.assertLess(len(parser.metacards), len(parser.cards))
+        self.assertTrue(parser.legal_in_format)
+
+
+class TestRecorder(unittest.TestCase):
+    """
+    Checks the measures of the stages
+    """
+    def test_memory_is_measured(self):
+        """ the memory allocated by a stage is recorded, and the tracing stopped afterwards """
+        recorder = Recorder(memory=True)
+        with recorder.stage("allocate"):
+            data = bytearray(1 << 20)
+        del data
+        self.assertGreaterEqual(recorder.stages["allocate"]["peak_bytes"], 1 << 20)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_failed_stage_stops_tracing(self):
+        """ a stage raising an exception is not recorded and does not leave the tracing on """
+        recorder = Recorder(memory=True)
+        with self.assertRaises(ValueError):
+            with recorder.stage("fail"):
+                raise ValueError()
+        self.assertNotIn("fail", recorder.stages)
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class TestCompare(unittest.TestCase):
+    """
+    Checks the comparison of two runs
+    """
+    def test_compare(self):
+        """ only timings present in both runs are compared """
+        lines = list(compare(
+            {"1x": {"stages": {"parse": {"seconds": 2.0, "peak_bytes": 10}}}},
+            {"1x": {"stages": {"parse": {"seconds": 1.0, "peak_bytes": 5}, "unzip": {"seconds": 1.0}}}}
+        ))
+        self.assertEqual(len(lines), 1)
+        self.assertIn("1x / stages / parse / seconds", lines[0])
+        self.assertIn("-50.0%", lines[0])
+
+
+class TestSearchBenchmark(unittest.TestCase):
+    """
+    Checks the summaries and the mix of searches
+    """
+    def test_summarize(self):
+        """ percentiles are taken with the nearest rank """
+        summary = summarize([i / 100 for i in range(100, 0, -1)], [2] * 100)
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50_seconds"], 0.5)
+        self.assertEqual(summary["p95_seconds"], 0.95)
+        self.assertEqual(summary["p99_seconds"], 0.99)
+        self.assertEqual(summary["mean_queries"], 2)
+
+    def test_default_mix(self):
+        """ every search of the default mix is named, weighted and only uses fields of the search form """
+        fields = {
+            "name", "subtypes", "text", "context", "number", "artist", "power", "toughness", "cmc", "colors", "rarity",
+            "edition", "block", "format", "supertypes", "types", "in_collection"
+        }
+        mix = load_mix(default_mix)
+        self.assertEqual(len({search["name"] for search in mix}), len(mix))
+        for search in mix:
+            self.assertGreater(search["weight"], 0)
+            self.assertLessEqual(set(search["query"]), fields)
+            if search["query"].get("in_collection"):
+                self.assertTrue(search.get("authenticated"))
+
+
+class TestLoadBenchmark(unittest.TestCase):
+    """
+    Checks the stand-in server and the statistics of the load test
+    """
+    def test_stand_in(self):
+        """ the stand-in serves the catalog as mtgjson and images as gatherer """
+        dump = generate_dump(0.01)
+        stand_in = StandIn(dump, version="2.0.0")
+        stand_in.start()
+        try:
+            JSonCardParser.configure(stand_in.url + "/json/")
+            version = requests.get(JSonCardParser.last_version_check_path()).json()["version"]
+            archive = requests.get(JSonCardParser.json_download_file_path()).content
+            image = requests.get(stand_in.url + "/Handlers/Image.ashx?multiverseid=1&type=card")
+            missing = requests.get(stand_in.url + "/missing")
+        finally:
+            JSonCardParser.configure("http://mtgjson.com/json")
+            stand_in.shutdown()
+            stand_in.server_close()
+
+        self.assertEqual(version, "2.0.0")
+        with zipfile.ZipFile(io.BytesIO(archive)) as zipped:
+            self.assertEqual(json.loads(zipped.read("AllSets-x.json").decode()), dump)
+        self.assertEqual(image.headers["Content-Type"], "image/png")
+        self.assertEqual(missing.status_code, 404)
+
+    def test_statistics(self):
+        """ errors and throughput are computed by endpoint and overall """
+        statistics = Statistics()
+        statistics.record("GET /search", 0.1, False)
+        statistics.record("GET /search", 0.3, True)
+        statistics.record("POST /login", 0.2, False)
+        summary = statistics.summary(2)
+
+        self.assertEqual(list(summary), ["all", "GET /search", "POST /login"])
+        self.assertEqual(summary["all"]["count"], 3)
+        self.assertEqual(summary["all"]["throughput"], 1.5)
+        self.assertEqual(summary["GET /search"]["error_rate"], 0.5)
+        self.assertEqual(summary["POST /login"]["errors"], 0)
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the in-memory caches
+"""
+
+import time
+import unittest
+
+from lib.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    """
+    Tests the expiration and size bounds of the TTL cache
+    """
+    def test_get_and_invalidate(self):
+        """ Checks that values are kept until invalidated """
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set(1, "goatsy")
+        self.assertEqual(cache.get(1), "goatsy")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_expiration(self):
+        """ Checks that values expire after the ttl """
+        cache = TTLCache(max_size=2, ttl=0.01)
+        cache.set(1, "goatsy")
+        time.sleep(0.02)
+        self.assertEqual(cache.get(1, "expired"), "expired")
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_dropped(self):
+        """ Checks that the cache never grows over its maximum size """
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
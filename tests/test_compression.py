@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the compression of responses and of static files
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import flask
+import flask_login
+
+import lib.compression
+from lib.compression import ResponseCompressor, precompress
+from lib.csrf import MaskedCsrfProtect
+
+
+class CompressionTestCase(unittest.TestCase):
+    """
+    Creates an application with a few responses of different kinds and a static folder
+    """
+    page = "<html>{}</html>".format("<p>card</p>" * 500)
+    stylesheet = "body { color: black; }\n" * 200
+
+    def setUp(self):
+        """ Creates the application and its static files """
+        self.directory = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.directory.name, "css"))
+        with open(os.path.join(self.directory.name, "css", "style.css"), "w") as stylesheet:
+            stylesheet.write(self.stylesheet)
+        with open(os.path.join(self.directory.name, "small.js"), "w") as script:
+            script.write("var a = 1;")
+
+        self.app = flask.Flask(__name__, static_folder=self.directory.name, static_url_path="/static")
+        self.app.config.update(self.config())
+        self.app.add_url_rule("/page", "page", lambda: self.page)
+        self.app.add_url_rule("/small", "small", lambda: "<html></html>")
+        self.app.add_url_rule("/image", "image", lambda: flask.Response(b"\x89PNG" * 1000, mimetype="image/png"))
+        self.app.add_url_rule("/export", "export", lambda: flask.Response(
+            (json.dumps({"card": index}) + "\n" for index in range(1000)), mimetype="application/json"
+        ))
+        self.app.add_url_rule("/encoded", "encoded", lambda: flask.Response(
+            gzip.compress(self.page.encode()), headers={"Content-Encoding": "gzip"}, mimetype="text/html"
+        ))
+        ResponseCompressor(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """ Removes the static files """
+        self.directory.cleanup()
+
+    def config(self) -> dict:
+        """ configuration of the application """
+        return {}
+
+    def get(self, path: str, accept_encoding: str=None):
+        """
+        Requests the given path
+
+        :param path: path to request
+        :param accept_encoding: encodings accepted
+        :return: the response
+        """
+        headers = {} if accept_encoding is None else {"Accept-Encoding": accept_encoding}
+        return self.client.get(path, headers=headers)
+
+
+class TestResponseCompressor(CompressionTestCase):
+    """
+    Tests the compression of dynamic responses
+    """
+    def test_compressed_when_accepted(self):
+        """ Checks that responses are compressed with gzip when the client accepts it """
+        response = self.get("/page", "gzip, deflate")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.data).decode(), self.page)
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+    def test_not_compressed_when_not_accepted(self):
+        """ Checks that clients not accepting compression get the plain response, that caches must not share """
+        for accept_encoding in (None, "identity", "gzip;q=0"):
+            response = self.get("/page", accept_encoding)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertEqual(response.data.decode(), self.page)
+            self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+    def test_small_responses_are_not_compressed(self):
+        """ Checks that responses under the minimum size are sent as they are """
+        self.assertNotIn("Content-Encoding", self.get("/small", "gzip").headers)
+
+    def test_only_allowed_types_are_compressed(self):
+        """ Checks that content types absent from the allowlist, as images, are not compressed """
+        response = self.get("/image", "gzip")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertNotIn("Vary", response.headers)
+
+    def test_encoded_responses_are_not_compressed_again(self):
+        """ Checks that responses already encoded are left alone """
+        response = self.get("/encoded", "gzip")
+        self.assertEqual(gzip.decompress(response.data).decode(), self.page)
+
+    def test_streamed_responses(self):
+        """ Checks that streamed responses are compressed as they are sent """
+        response = self.get("/export", "gzip")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual([json.loads(line)["card"] for line in lines], list(range(1000)))
+
+    @unittest.skipIf(lib.compression.brotli is None, "brotli is not installed")
+    def test_brotli_is_preferred(self):
+        """ Checks that brotli is used when available and accepted, unless the client prefers gzip """
+        response = self.get("/page", "gzip, br")
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(lib.compression.brotli.decompress(response.data).decode(), self.page)
+        self.assertEqual(self.get("/page", "gzip, br;q=0.5").headers["Content-Encoding"], "gzip")
+
+
+class TestPageCompression(unittest.TestCase):
+    """
+    Tests the compression of the application's pages, which carry the CSRF token
+    """
+    def setUp(self):
+        """ Creates an application rendering the search results with the application's templates """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.app = flask.Flask(__name__, template_folder=os.path.join(root, "templates"))
+        self.app.config["SECRET_KEY"] = "test"
+        for endpoint in ("index", "search", "collection", "decks", "login", "parameters", "logout"):
+            self.app.add_url_rule("/" + endpoint, endpoint, lambda: "")
+        self.app.add_url_rule("/result", "result", lambda: flask.render_template("result.html", cards=[
+            {"card_id": card_id, "normal": card_id % 4, "foil": card_id % 2} for card_id in range(100)
+        ]))
+        flask_login.LoginManager(self.app)
+        MaskedCsrfProtect(self.app)
+        ResponseCompressor(self.app)
+
+    def test_result_page_is_compressed(self):
+        """ Checks that the search results are compressed, the token in them being masked """
+        response = self.app.test_client().get("/result", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        page = gzip.decompress(response.data).decode()
+        self.assertIn('data-normal="3"', page)
+        self.assertIn('<meta name="csrf-token"', page)
+
+
+class TestDisabledCompression(CompressionTestCase):
+    """
+    Tests that compression can be disabled
+    """
+    def config(self) -> dict:
+        """ configuration disabling compression """
+        return {"COMPRESSION_ENABLED": False}
+
+    def test_not_compressed(self):
+        """ Checks that responses are sent as they are """
+        self.assertNotIn("Content-Encoding", self.get("/page", "gzip").headers)
+
+
+class TestPrecompressedStaticFiles(CompressionTestCase):
+    """
+    Tests the precompression of static files and their use
+    """
+    def test_precompress(self):
+        """ Checks that compressed versions are written for big compressible files, and only rewritten when stale """
+        stylesheet = os.path.join(self.directory.name, "css", "style.css")
+        expected = [stylesheet + suffix for encoding, suffix in lib.compression.suffixes.items()
+                    if encoding in lib.compression.encodings]
+
+        self.assertEqual(sorted(precompress(self.directory.name)), sorted(expected))
+        with open(stylesheet + ".gz", "rb") as compressed:
+            self.assertEqual(gzip.decompress(compressed.read()).decode(), self.stylesheet)
+        self.assertEqual(precompress(self.directory.name), [])
+
+        modified = time.time() + 10
+        os.utime(stylesheet, (modified, modified))
+        self.assertEqual(sorted(precompress(self.directory.name)), sorted(expected))
+
+    def test_precompressed_file_is_sent(self):
+        """ Checks that the compressed version of a static file is sent to clients accepting it """
+        precompress(self.directory.name)
+        response = self.get("/static/css/style.css", "gzip")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.mimetype, "text/css")
+        self.assertEqual(gzip.decompress(response.data).decode(), self.stylesheet)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+        response = self.get("/static/css/style.css")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data.decode(), self.stylesheet)
+
+    def test_stale_file_is_not_sent(self):
+        """ Checks that a compressed version older than its static file is ignored """
+        precompress(self.directory.name)
+        stylesheet = os.path.join(self.directory.name, "css", "style.css")
+        modified = time.time() + 10
+        os.utime(stylesheet, (modified, modified))
+
+        response = self.get("/static/css/style.css", "gzip")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data.decode(), self.stylesheet)
+
+    def test_missing_files(self):
+        """ Checks that files without compressed version are sent as they are, and unknown ones are not found """
+        precompress(self.directory.name)
+        self.assertEqual(self.get("/static/small.js", "gzip").data.decode(), "var a = 1;")
+        self.assertEqual(self.get("/static/unknown.css", "gzip").status_code, 404)
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the CSRF protection with masked tokens
+"""
+
+import re
+import unittest
+
+import flask
+import flask_wtf
+from wtforms import StringField
+
+from lib.csrf import MaskedCsrfProtect, mask, unmask
+
+
+class NameForm(flask_wtf.Form):
+    """
+    Form checking its own token
+    """
+    name = StringField("Name")
+
+
+class TestMaskedCsrfProtect(unittest.TestCase):
+    """
+    Checks that the tokens written in pages are masked and accepted once sent back
+    """
+    def setUp(self):
+        """ Creates an application with a page giving a token, and views checking it """
+        self.app = flask.Flask(__name__)
+        self.app.config["SECRET_KEY"] = "test"
+        self.app.add_url_rule("/page", "page", lambda: flask.render_template_string(
+            '<meta name="csrf-token" content="{{ csrf_token() }}">'
+        ))
+        self.app.add_url_rule("/post", "post", lambda: "posted", methods=["POST"])
+        self.app.add_url_rule("/form", "form", lambda: str(NameForm().validate_on_submit()), methods=["POST"])
+        MaskedCsrfProtect(self.app)
+        self.client = self.app.test_client()
+
+    def token(self) -> str:
+        """ Gets a token from a page, as the browser would """
+        return re.search('content="([^"]+)"', self.client.get("/page").data.decode()).group(1)
+
+    def test_mask(self):
+        """ Checks that masks change each time and are removed """
+        self.assertNotEqual(mask("token"), mask("token"))
+        self.assertEqual(unmask(mask("token")), "token")
+        self.assertEqual(unmask("not masked"), "not masked")
+
+    def test_tokens_differ_by_page(self):
+        """ Checks that the same session gets a different value in each page """
+        self.assertNotEqual(self.token(), self.token())
+
+    def test_masked_tokens_are_accepted(self):
+        """ Checks that the masked tokens are accepted in forms and headers """
+        token = self.token()
+        self.assertEqual(self.client.post("/post", data={"csrf_token": token}).status_code, 200)
+        self.assertEqual(self.client.post("/post", headers={"X-CSRFToken": self.token()}).status_code, 200)
+        self.assertEqual(self.client.post("/form", data={"csrf_token": token, "name": "goat"}).data, b"True")
+
+    def test_invalid_tokens_are_refused(self):
+        """ Checks that missing and forged tokens are still refused """
+        self.token()
+        self.assertEqual(self.client.post("/post").status_code, 400)
+        self.assertEqual(self.client.post("/post", data={"csrf_token": mask("forged")}).status_code, 400)
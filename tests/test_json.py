@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the custom json operations
+"""
+
+import gzip
+import io
+import json
+import unittest
+
+from lib.json import stream_collection, gzip_stream, read_collection, read_deck, JSONStreamReader, JSONDecodeError
+
+
+class TestStreamCollection(unittest.TestCase):
+    """
+    Tests the incremental writing of collections
+    """
+    card = {"name": "Forest", "edition": "BFZ", "ed_number": "270", "number": 4}
+    owned = {"name": "Forest", "edition": "BFZ", "number": "270", "normal": 10, "foil": 1}
+
+    def export(self, entries, chunk_size=65536):
+        """
+        Writes the entries and parses the result back
+
+        :param entries: entries to write
+        :param chunk_size: size of the chunks to produce
+        :return: the parsed json
+        """
+        return json.loads("".join(stream_collection(entries, chunk_size=chunk_size)))
+
+    def test_empty(self):
+        """ Checks that an empty collection is still valid json """
+        self.assertEqual(self.export([]), {"decks": [], "collection": []})
+
+    def test_decks_and_collection(self):
+        """ Checks that decks, empty or not, and cards are all written """
+        entries = [
+            ("deck", "empty"),
+            ("deck", "main only"), ("main", self.card), ("main", self.card),
+            ("deck", "with side"), ("main", self.card), ("side", self.card),
+            ("deck", "side only"), ("side", self.card),
+            ("collection", self.owned), ("collection", self.owned)
+        ]
+        self.assertEqual(self.export(entries, chunk_size=1), {
+            "decks": [
+                {"name": "empty", "main": [], "side": []},
+                {"name": "main only", "main": [self.card, self.card], "side": []},
+                {"name": "with side", "main": [self.card], "side": [self.card]},
+                {"name": "side only", "main": [], "side": [self.card]},
+            ],
+            "collection": [self.owned, self.owned]
+        })
+
+    def test_decks_without_collection(self):
+        """ Checks that the document is closed correctly when no cards are owned """
+        self.assertEqual(
+            self.export([("deck", "deck"), ("side", self.card)]),
+            {"decks": [{"name": "deck", "main": [], "side": [self.card]}], "collection": []}
+        )
+
+    def test_gzip(self):
+        """ Checks that the compressed stream can be decompressed """
+        data = b"".join(gzip_stream(stream_collection([("collection", self.owned)])))
+        self.assertEqual(json.loads(gzip.decompress(data).decode()), {"decks": [], "collection": [self.owned]})
+
+
+class TestStreamReader(unittest.TestCase):
+    """
+    Tests the incremental reading and validation of uploads
+    """
+    card = {"name": "Forest", "edition": "BFZ", "ed_number": "270", "number": 4}
+    owned = {"name": "Forest", "edition": "BFZ", "number": "270", "normal": 10, "foil": 1}
+
+    @staticmethod
+    def read(function, data, buffer_size=3):
+        """
+        Reads the given data with a tiny buffer, to force refills in the middle of values
+
+        :param function: the reading function to use
+        :param data: json text to read
+        :param buffer_size: size of the reader's buffer
+        :return: list of (kind, value) entries, with models as dictionaries
+        """
+        return [
+            (kind, value if isinstance(value, str) else value._as_database_object)
+            for kind, value in function(io.StringIO(data), buffer_size=buffer_size)
+        ]
+
+    def test_values(self):
+        """ Checks that values split between two reads are correctly decoded """
+        reader = JSONStreamReader(io.StringIO('[12345, "a long string", {"key": [1, 2]}, true]'), buffer_size=2)
+        values = []
+        for _ in reader.iter_array():
+            values.append(reader.read_value())
+        self.assertEqual(values, [12345, "a long string", {"key": [1, 2]}, True])
+
+    def test_round_trip(self):
+        """ Checks that an exported collection is read back identically """
+        entries = [
+            ("deck", "empty"), ("deck", "deck"), ("main", self.card), ("side", self.card),
+            ("collection", self.owned), ("collection", self.owned)
+        ]
+        data = "".join(stream_collection(entries))
+        self.assertEqual(self.read(read_collection, data), entries)
+
+    def test_deck_name_after_cards(self):
+        """ Checks that cards read before the deck's name are kept until it is known """
+        data = json.dumps({"main": [self.card], "side": [], "name": "late"})
+        self.assertEqual(self.read(read_deck, data), [("deck", "late"), ("main", self.card)])
+
+    def test_invalid_documents(self):
+        """ Checks that invalid uploads are refused """
+        for data in [
+            '{"collection": [{"name": "Forest"}], "decks": []}',
+            json.dumps({"collection": [dict(self.owned, normal=-1)], "decks": []}),
+            json.dumps({"collection": [], "unknown": []}),
+            '{"collection": [], "decks": []} trailing',
+            '{"collection": [',
+        ]:
+            with self.subTest(data=data):
+                self.assertRaises(JSONDecodeError, self.read, read_collection, data)
+
+        self.assertRaises(JSONDecodeError, self.read, read_deck, json.dumps({"name": "no side", "main": []}))
+        self.assertRaises(JSONDecodeError, self.read, read_deck, json.dumps(
+            {"name": "no cards", "main": [dict(self.card, number=0)], "side": []}
+        ))
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the metrics registry and its exposition
+"""
+
+import os
+import unittest
+
+from lib.cache import TTLCache
+from lib.metrics import Registry, cache_metrics
+
+
+class TestRegistry(unittest.TestCase):
+    """
+    Checks the metrics and their Prometheus text format
+    """
+    def setUp(self):
+        """ Creates an empty registry """
+        self.registry = Registry()
+
+    def test_counter(self):
+        """ counters are exposed by label """
+        counter = self.registry.counter("hits_total", "Hits", ["kind"])
+        counter.inc(kind="image")
+        counter.inc(2, kind="image")
+        counter.inc(kind="ic\"on")
+
+        self.assertEqual(self.registry.expose(), "\n".join([
+            "# HELP hits_total Hits",
+            "# TYPE hits_total counter",
+            'hits_total{kind="image"} 3',
+            'hits_total{kind="ic\\"on"} 1',
+        ]) + "\n")
+
+    def test_metrics_are_shared_by_name(self):
+        """ getting a metric twice gives the same metric, of the same type only """
+        self.assertIs(self.registry.counter("a", "A"), self.registry.counter("a", "A"))
+        with self.assertRaises(ValueError):
+            self.registry.gauge("a", "A")
+
+    def test_labels_are_checked(self):
+        """ values need all declared labels """
+        with self.assertRaises(ValueError):
+            self.registry.counter("a", "A", ["kind"]).inc()
+
+    def test_histogram(self):
+        """ histogram buckets are cumulative and end with +Inf """
+        histogram = self.registry.histogram("duration_seconds", "Duration", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = self.registry.expose().splitlines()[2:]
+        self.assertEqual(lines, [
+            'duration_seconds_bucket{le="0.1"} 1',
+            'duration_seconds_bucket{le="1"} 2',
+            'duration_seconds_bucket{le="+Inf"} 3',
+            "duration_seconds_sum 5.55",
+            "duration_seconds_count 3",
+        ])
+
+    def test_collectors(self):
+        """ collectors are called at exposition time and replaced by name """
+        cache = TTLCache(10, 10)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.registry.add_collector("caches", lambda: cache_metrics({"user": cache}))
+        self.registry.add_collector("caches", lambda: cache_metrics({"user": cache}))
+
+        exposed = self.registry.expose()
+        self.assertEqual(exposed.count("# TYPE mtgcollector_cache_hits_total counter"), 1)
+        self.assertIn('mtgcollector_cache_hits_total{cache="user"} 1', exposed)
+        self.assertIn('mtgcollector_cache_misses_total{cache="user"} 1', exposed)
+        self.assertIn('mtgcollector_cache_size{cache="user"} 1', exposed)
+
+    def test_worker_label(self):
+        """ samples are labelled with the pid of the process exposing them, before their own labels """
+        registry = Registry(worker_label=True)
+        registry.counter("hits_total", "Hits", ["kind"]).inc(kind="image")
+        registry.histogram("duration_seconds", "Duration", buckets=(1,)).observe(0.5)
+
+        worker = 'worker="{}"'.format(os.getpid())
+        lines = registry.expose().splitlines()
+        self.assertIn("hits_total{" + worker + ',kind="image"} 1', lines)
+        self.assertIn("duration_seconds_bucket{" + worker + ',le="1"} 1', lines)
+        self.assertIn("duration_seconds_count{" + worker + "} 1", lines)
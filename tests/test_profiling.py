@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the on demand profiling of requests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+import flask_login
+
+from lib.profiling import RequestProfiler
+
+
+class FakeUser(flask_login.UserMixin):
+    """ Logged in user, administrator or not depending on the request """
+    def __init__(self, is_admin: bool):
+        self.id = 1
+        self.is_admin = is_admin
+
+
+class TestRequestProfiler(unittest.TestCase):
+    """
+    Checks that only administrators' requests are profiled, and only when profiling is enabled
+    """
+    def setUp(self):
+        """ Creates an application with a single page """
+        self.directory = tempfile.mkdtemp()
+        self.app = flask.Flask(__name__)
+        self.app.config.update(RUN_DIRECTORY=self.directory, PROFILING_KEEP=2)
+
+        login_manager = flask_login.LoginManager(self.app)
+        login_manager.request_loader(lambda request: FakeUser(request.args.get("admin") == "1"))
+
+        @self.app.route("/slow")
+        def slow():
+            """ page to profile """
+            return str(sum(range(1000)))
+
+    def tearDown(self):
+        """ Removes the stored profiles """
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        """ no hook is registered when profiling is disabled """
+        profiler = RequestProfiler(self.app)
+        response = self.app.test_client().get("/slow?admin=1&profile=1")
+
+        self.assertNotIn(RequestProfiler.header, response.headers)
+        self.assertNotIn(profiler.start, self.app.before_request_funcs.get(None, []))
+        self.assertNotIn(profiler.stop, self.app.after_request_funcs.get(None, []))
+        self.assertFalse(os.path.exists(profiler.directory))
+
+    def test_profile(self):
+        """ administrators' requests asking for it are profiled and only the last profiles are kept """
+        self.app.config["PROFILING_ENABLED"] = True
+        profiler = RequestProfiler(self.app)
+        client = self.app.test_client()
+
+        self.assertNotIn(RequestProfiler.header, client.get("/slow?admin=1").headers)
+        self.assertNotIn(RequestProfiler.header, client.get("/slow?profile=1").headers)
+
+        names = [
+            client.get("/slow?admin=1", headers={RequestProfiler.header: "1"}).headers[RequestProfiler.header],
+            client.get("/slow?admin=1&profile=1").headers[RequestProfiler.header]
+        ]
+        for name in names:
+            self.assertIn("slow", profiler.report(profiler.path(name)))
+        self.assertIn("slow", profiler.report(profiler.path(names[0]), sort="time"))
+        self.assertRaises(ValueError, profiler.report, profiler.path(names[0]), sort="__class__")
+
+        client.get("/slow?admin=1&profile=1")
+        self.assertEqual(len(profiler.list()), 2)
+        self.assertFalse(profiler.lock.locked())
+
+    def test_path(self):
+        """ only stored profiles can be accessed """
+        profiler = RequestProfiler(self.app)
+        self.assertIsNone(profiler.path("../config.cfg"))
+        self.assertIsNone(profiler.path("missing.pstats"))
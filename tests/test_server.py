@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the prefork server
+"""
+
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from lib.server import PreforkServer, RequestTracker
+
+
+class BackgroundTask:
+    """
+    Background task leaving a file behind when it is stopped
+
+    :param path: path of the file to write
+    """
+    name = "background task"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def stop(self, timeout: float) -> bool:
+        """
+        Writes the file
+
+        :param timeout: time the task can take to stop
+        :return: True, the task being stopped
+        """
+        with open(self.path, "w") as stopped_file:
+            stopped_file.write(str(timeout))
+        return True
+
+
+def application(index: int, directory: str):
+    """
+    Creates an application telling which worker answered, slowly when asked to
+
+    :param index: index of the worker
+    :param directory: directory in which its background task writes when stopped
+    :return: the WSGI application
+    """
+    def answer(environ, start_response):
+        if environ["PATH_INFO"] == "/slow":
+            time.sleep(1)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["{} {}".format(index, os.getpid()).encode()]
+    answer.background_tasks = [BackgroundTask(os.path.join(directory, "stopped-{}".format(index)))]
+    return answer
+
+
+class TestRequestTracker(unittest.TestCase):
+    """
+    Tests the counting of running requests
+    """
+    def test_request_ends_with_response(self):
+        """ Checks that a request is running until its response is closed """
+        tracker = RequestTracker(lambda environ, start_response: iter([b"a", b"b"]))
+        response = tracker({}, None)
+        self.assertEqual(tracker.active, 1)
+        self.assertFalse(tracker.wait(0.01))
+
+        self.assertEqual(list(response), [b"a", b"b"])
+        response.close()
+        self.assertTrue(tracker.wait(0.01))
+
+    def test_failed_request_ends(self):
+        """ Checks that requests failing before giving a response are not counted anymore """
+        def fail(environ, start_response):
+            raise ValueError()
+
+        tracker = RequestTracker(fail)
+        self.assertRaises(ValueError, tracker, {}, None)
+        self.assertEqual(tracker.active, 0)
+
+
+class TestPreforkServer(unittest.TestCase):
+    """
+    Runs a prefork server in another process, as it handles signals
+    """
+    workers = 2
+
+    def setUp(self):
+        """ Starts the server and waits for it to answer """
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = PreforkServer(
+            "127.0.0.1", 0, self.workers, factory=lambda index: application(index, self.directory.name),
+            graceful_timeout=5
+        )
+        self.url = "http://{}:{}".format(*self.server.address)
+        self.process = multiprocessing.get_context("fork").Process(target=self.server.run)
+        self.process.start()
+        self.server.listener.close()
+        self.wait_for(lambda: self.answering_workers(1))
+
+    def tearDown(self):
+        """ Stops the server if it is still running """
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGTERM)
+            self.process.join(10)
+        self.directory.cleanup()
+
+    @staticmethod
+    def wait_for(condition, timeout: float=10):
+        """
+        Waits for the condition to be true
+
+        :param condition: function checking the condition, returning a truthy value once it is met
+        :param timeout: maximum time to wait
+        :return: the value given by the condition
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                value = condition()
+            except requests.exceptions.ConnectionError:
+                value = None
+            if value:
+                return value
+            time.sleep(0.05)
+        raise AssertionError("Condition not met in {} seconds".format(timeout))
+
+    def answering_workers(self, requests_count: int=20) -> set:
+        """
+        Sends requests to the server
+
+        :param requests_count: number of requests to send
+        :return: the index and pid of the workers that answered them
+        """
+        return {tuple(map(int, requests.get(self.url).text.split())) for _ in range(requests_count)}
+
+    def test_reload(self):
+        """ Checks that new workers replace the old ones on SIGHUP, old ones finishing their running requests """
+        old_pids = {pid for _, pid in self.answering_workers()}
+        slow_response = []
+        slow_request = threading.Thread(target=lambda: slow_response.append(requests.get(self.url + "/slow")))
+        slow_request.start()
+        time.sleep(0.2)
+
+        os.kill(self.process.pid, signal.SIGHUP)
+        slow_request.join()
+        self.assertEqual(slow_response[0].status_code, 200)
+
+        def new_workers():
+            workers = self.answering_workers()
+            return workers if not {pid for _, pid in workers} & old_pids else None
+
+        self.assertTrue({index for index, _ in self.wait_for(new_workers)} <= set(range(self.workers)))
+
+    def test_dead_worker_is_restarted(self):
+        """ Checks that a worker killed is replaced by a new one with the same index """
+        index, pid = next(iter(self.answering_workers(1)))
+        os.kill(pid, signal.SIGKILL)
+        self.wait_for(lambda: any(
+            new_index == index and new_pid != pid for new_index, new_pid in self.answering_workers()
+        ))
+
+    def test_stop(self):
+        """ Checks that the server stops with its workers and their background tasks on SIGTERM """
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.process.join(10)
+        self.assertEqual(self.process.exitcode, 0)
+        self.assertRaises(requests.exceptions.ConnectionError, requests.get, self.url)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["stopped-0", "stopped-1"])
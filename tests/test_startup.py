@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests that starting the application only loads what it needs, and brings the database up to date
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import typing
+
+
+class TestLazyImports(unittest.TestCase):
+    """
+    Imports the application in a new interpreter and checks which modules it loaded
+    """
+    @staticmethod
+    def loaded_modules(code: str, *modules: str) -> list:
+        """
+        Runs the code in a new interpreter
+
+        :param code: code to run
+        :param modules: modules to look for
+        :return: the given modules that were loaded once the code ran
+        """
+        output = subprocess.check_output([
+            sys.executable, "-c", "{}\nimport sys\nprint(' '.join(m for m in {!r} if m in sys.modules))".format(
+                code, modules
+            )
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return output.decode().split()
+
+    def test_heavy_modules_are_not_imported(self):
+        """ Checks that the http client, the database driver and the zip module are only loaded once needed """
+        self.assertEqual(self.loaded_modules("import mtgcollector", "requests", "mysql.connector", "zipfile"), [])
+
+    def test_backend_is_imported_on_first_use(self):
+        """ Checks that selecting a backend does not import it before a command is needed """
+        self.assertEqual(self.loaded_modules("import lib.db\nlib.db.use('sqlite')", "lib.db.sql", "lib.db.sqlite"), [])
+        self.assertEqual(
+            self.loaded_modules("import lib.db\nlib.db.use('sqlite')\nlib.db.commands.User", "lib.db.sqlite"),
+            ["lib.db.sqlite"]
+        )
+
+
+class TestSetup(unittest.TestCase):
+    """
+    Configures the application on a SQLite database in a new interpreter, as a WSGI server would
+    """
+    def setUp(self):
+        """ Writes the configuration in a temporary directory, which also holds the database """
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.directory.name, "config.cfg")
+        with open(self.config, "w") as config_file:
+            config_file.write("DATABASE_BACKEND = 'sqlite'\nDATABASE_NAME = 'mtg.db'\nRUN_DIRECTORY = {!r}\n"
+                              "SECRET_KEY = 'test'\n".format(self.directory.name))
+
+    def tearDown(self):
+        """ Removes the configuration and the database """
+        self.directory.cleanup()
+
+    def create_app(self, code: str) -> typing.List[str]:
+        """
+        Creates the application without its background tasks, then runs the code
+
+        :param code: code printing what to check
+        :return: the words printed
+        """
+        setup = "import sys\nimport mtgcollector\nmtgcollector.create_app(background_tasks=False)\n"
+        return subprocess.check_output([
+            sys.executable, "-c", setup + code
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=dict(os.environ, MTG_COLLECTOR_CONFIG=self.config)).decode().split()
+
+    def test_database_is_migrated(self):
+        """ Checks that the database is brought to the current schema without running the background tasks """
+        self.assertEqual(self.create_app("print(len(mtgcollector.app.background_tasks))"), ["0"])
+
+        connection = sqlite3.connect(os.path.join(self.directory.name, "mtg.db"))
+        try:
+            versions = dict(connection.execute("SELECT model, version FROM schema_migration").fetchall())
+        finally:
+            connection.close()
+        self.assertIn("User", versions)
+
+    def test_mysql_driver_is_not_imported(self):
+        """ Checks that the SQLite backend runs without the MySQL driver, even when setting up the database """
+        self.assertEqual(self.create_app(
+            "print('mysql.connector' in sys.modules, 'lib.db.sql' in sys.modules)"
+        ), ["False", "True"])
+
+    def test_startup_is_reported(self):
+        """ Checks that the import and configuration times are logged, although nothing configures logging """
+        output = subprocess.run([
+            sys.executable, "-c", "import lib\nlib.import_logged('mtgcollector').create_app(background_tasks=False)"
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=dict(os.environ, MTG_COLLECTOR_CONFIG=self.config), stderr=subprocess.PIPE, check=True).stderr.decode()
+        self.assertRegex(output, r"INFO mtgcollector imported in \d+ms, loading \d+ modules")
+        self.assertRegex(output, r"INFO Application configured in \d+ms")
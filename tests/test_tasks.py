@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the background tasks
+"""
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import Flask
+
+import lib.threading
+from lib.db.maintenance import UpdateJob
+from lib.exceptions import UpdateCancelledException
+from lib.tasks import CatalogWatcher, DBUpdater, TaskClaim
+
+
+class VersionServer(http.server.HTTPServer):
+    """
+    Local stand-in for mtgjson's version file, answering to conditional requests
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        Serves the version file, with an ETag
+        """
+        def do_GET(self):
+            """ Sends the version, or 304 if the client already has it """
+            self.server.requests.append(dict(self.headers))
+            time.sleep(self.server.delay)
+            etag = '"{}"'.format(self.server.version)
+
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            body = json.dumps({"version": self.server.version}).encode()
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            """ Keeps the test output clean """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        self.version = "3.3.3"
+        self.delay = 0
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        """ url of the version file """
+        return "http://127.0.0.1:{}/version-full.json".format(self.server_address[1])
+
+
+class TestCatalogWatcher(unittest.TestCase):
+    """
+    Tests the periodic catalog check
+    """
+    def setUp(self):
+        """ Starts a local version server and creates an app in a temporary directory """
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = VersionServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.app = Flask(__name__, static_folder=self.directory.name)
+        self.app.update_db = threading.Event()
+        self.app.config.update(CATALOG_CHECK_TIMEOUT=0.2, CATALOG_CHECK_RETRY_DELAY=1, CATALOG_CHECK_INTERVAL=30)
+        self.watcher = CatalogWatcher(self.app, url=self.server.url)
+
+    def tearDown(self):
+        """ Stops the server and cleans the temporary directory """
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_new_version_triggers_update(self):
+        """ Checks that a version newer than the local one asks for an update """
+        self.assertTrue(self.watcher.tick())
+        self.assertTrue(self.app.update_db.is_set())
+
+    def download(self, version: str) -> None:
+        """
+        Stands for the download of the catalog by an update
+
+        :param version: version of the downloaded catalog
+        """
+        os.makedirs(os.path.join(self.directory.name, "downloads"), exist_ok=True)
+        open(os.path.join(self.directory.name, "downloads", "cards-{}.json".format(version)), "w").close()
+
+    def test_conditional_request(self):
+        """ Checks that an unchanged catalog is not downloaded again """
+        self.watcher.tick()
+        self.app.update_db.clear()
+        self.download("3.3.3")
+
+        self.assertFalse(self.watcher.tick())
+        self.assertEqual(self.server.requests[-1].get("If-None-Match"), '"3.3.3"')
+        self.assertFalse(self.app.update_db.is_set())
+
+        self.server.version = "3.3.4"
+        self.assertTrue(self.watcher.tick())
+        self.assertEqual(self.watcher.version, "3.3.4")
+
+    def test_failed_update_is_asked_again(self):
+        """ Checks that an unchanged catalog still asks for an update while the local version is older """
+        self.assertTrue(self.watcher.tick())
+        self.app.update_db.clear()
+
+        self.assertTrue(self.watcher.tick())
+        self.assertEqual(self.server.requests[-1].get("If-None-Match"), '"3.3.3"')
+        self.assertTrue(self.app.update_db.is_set())
+
+    def test_timeout_backoff(self):
+        """ Checks that a slow server does not block the watcher and that retries back off """
+        self.server.delay = 0.5
+        self.assertIsNone(self.watcher.tick())
+        self.assertEqual(self.watcher.delay, 1)
+        self.assertIsNone(self.watcher.tick())
+        self.assertEqual(self.watcher.delay, 2)
+
+        self.server.delay = 0
+        self.assertTrue(self.watcher.tick())
+        self.assertEqual(self.watcher.delay, 30)
+
+
+class TestDBUpdater(unittest.TestCase):
+    """
+    Tests the stop of the database updater
+    """
+    def setUp(self):
+        """ Creates an app with its run directory in a temporary directory """
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__, static_folder=self.directory.name)
+        self.app.config["RUN_DIRECTORY"] = self.directory.name
+        self.app.notifier = lib.threading.Event()
+        self.app.update_db = threading.Event()
+        self.updater = DBUpdater(self.app)
+        self.updating = threading.Event()
+        self.updater.db.update = self.update
+
+    def tearDown(self):
+        """ Cleans the run directory """
+        self.directory.cleanup()
+
+    def update(self, stopped: threading.Event) -> None:
+        """
+        Stands for an update, inserting batches until cancelled
+
+        :param stopped: event cancelling the update
+        """
+        job = UpdateJob(self.app, stopped)
+        self.updating.set()
+        try:
+            with job.phase("insert Card", 100):
+                while True:
+                    job.advance(1, 2)
+                    time.sleep(0.01)
+        except UpdateCancelledException:
+            job.end("cancelled")
+
+    def test_stop_cancels_update(self):
+        """ Checks that a running update is cancelled and waited for, and asked again for another process """
+        self.updater.start()
+        self.app.update_db.set()
+        self.assertTrue(self.updating.wait(5))
+
+        self.assertTrue(self.updater.stop(5))
+        self.assertEqual(UpdateJob.status(self.app)["state"], "cancelled")
+        self.updater.join(5)
+        self.assertFalse(self.updater.is_alive())
+        self.assertTrue(self.app.update_db.is_set())
+
+    def test_stop_when_idle(self):
+        """ Checks that an idle updater stops at once, without asking for an update """
+        self.updater.start()
+        self.assertTrue(self.updater.stop(0))
+        self.assertFalse(self.app.update_db.is_set())
+
+
+class Task(threading.Thread):
+    """
+    Background task doing nothing until stopped
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+
+    def run(self):
+        """ Waits to be stopped """
+        self.stopped.wait()
+
+    def stop(self, timeout: float=None) -> bool:
+        """
+        Stops the task
+
+        :param timeout: unused, the task stops at once
+        :return: True, the task being stopped
+        """
+        self.stopped.set()
+        return True
+
+
+class TestTaskClaim(unittest.TestCase):
+    """
+    Tests that background tasks run in a single process, and in another one once it stops
+    """
+    def setUp(self):
+        """ Creates an app with its run directory in a temporary directory """
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__, static_folder=self.directory.name)
+        self.app.config["RUN_DIRECTORY"] = self.directory.name
+
+    def tearDown(self):
+        """ Cleans the run directory """
+        self.directory.cleanup()
+
+    def test_single_claim(self):
+        """ Checks that the tasks are claimed by one process, then by another once the first one stopped """
+        # each claim opens its own lock file, as the processes sharing the run directory would
+        first, second = TaskClaim(self.app, lambda: [Task()]), TaskClaim(self.app, lambda: [Task()], poll_interval=0.01)
+        self.assertTrue(first.claim())
+        self.assertTrue(first.tasks[0].is_alive())
+        second.start()
+        time.sleep(0.05)
+        self.assertEqual(second.tasks, [])
+
+        self.assertTrue(first.stop(1))
+        self.assertTrue(first.tasks[0].stopped.is_set())
+        second.join(1)
+        self.assertTrue(second.tasks[0].is_alive())
+        self.assertTrue(second.stop(1))
+
+    def test_stop_before_claim(self):
+        """ Checks that a process stopped before claiming the tasks does not run them """
+        first, second = TaskClaim(self.app, lambda: [Task()]), TaskClaim(self.app, lambda: [Task()], poll_interval=0.01)
+        self.assertTrue(first.claim())
+        second.start()
+        self.assertTrue(second.stop(1))
+        first.stop(1)
+        second.join(1)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(second.tasks, [])
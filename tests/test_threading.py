@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests the threading utilities
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import lib
+from lib.exceptions import ServerBusyException
+from lib.threading import BoundedExecutor, SharedEvent
+
+
+class TestSharedEvent(unittest.TestCase):
+    """
+    Tests that events are shared between different instances using the same file, as different processes would do
+    """
+    def setUp(self):
+        """ Isolates the shared file in a new directory """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "notifications")
+
+    def tearDown(self):
+        """ Cleans the shared file """
+        self.directory.cleanup()
+
+    def test_value_is_received_by_other_instance(self):
+        """ Checks that a value sent by one instance wakes up the threads waiting on the other """
+        sender = SharedEvent(self.path, poll_interval=0.01)
+        receiver = SharedEvent(self.path, poll_interval=0.01)
+
+        sender.set_value("Database update started")
+        self.assertEqual(receiver.wait_value(2), "Database update started")
+
+    def test_set_is_received_by_other_instance(self):
+        """ Checks that setting the event without a value also wakes up the threads of other instances """
+        sender = SharedEvent(self.path, poll_interval=0.01)
+        receiver = SharedEvent(self.path, poll_interval=0.01)
+
+        sender.set()
+        self.assertTrue(receiver.wait(2))
+
+    def test_old_value_is_not_received(self):
+        """ Checks that a value sent before the instance was created is not sent again """
+        SharedEvent(self.path, poll_interval=0.01).set_value("old")
+        receiver = SharedEvent(self.path, poll_interval=0.01)
+        self.assertRaises(TimeoutError, receiver.wait_value, 0.1)
+
+    def test_callback(self):
+        """ Checks that the callback is given the values of other instances only """
+        received = queue.Queue()
+        sender = SharedEvent(self.path, poll_interval=0.01)
+        receiver = SharedEvent(self.path, poll_interval=0.01, callback=received.put)
+
+        receiver.set_value("own")
+        sender.set_value("other")
+        self.assertEqual(received.get(timeout=2), "other")
+        self.assertTrue(received.empty())
+
+    def test_own_value_is_not_received(self):
+        """ Checks that the watcher does not take a value for another process' while it is being written """
+        received = queue.Queue()
+        event = SharedEvent(self.path, poll_interval=0.01, callback=received.put)
+        write_atomically = lib.write_atomically
+
+        def slow_write(path: str, content: str) -> None:
+            """ writes the file and leaves the watcher time to read it before returning """
+            write_atomically(path, content)
+            time.sleep(0.1)
+
+        with unittest.mock.patch.object(lib, "write_atomically", slow_write):
+            event.set_value("own")
+        self.assertTrue(received.empty())
+
+
+class TestBoundedExecutor(unittest.TestCase):
+    """
+    Tests the admission control of the bounded executor
+    """
+    def test_run(self):
+        """ Checks that results are given back to the caller """
+        self.assertEqual(BoundedExecutor(workers=1, max_pending=0).run(pow, 2, 10), 1024)
+
+    def test_refuses_when_full(self):
+        """ Checks that tasks are refused once all threads are busy and the queue is full """
+        executor = BoundedExecutor(workers=1, max_pending=0, admission_timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+        blocker = threading.Thread(target=executor.run, args=(lambda: started.set() or release.wait(),))
+        blocker.start()
+        started.wait()
+
+        self.assertRaises(ServerBusyException, executor.run, pow, 2, 10)
+        release.set()
+        blocker.join()
+        self.assertEqual(executor.run(pow, 2, 10), 1024)
@@ -5,9 +5,9 @@
 These are the main views for MTGCollector
 """
 
+import time
+
 import flask
-import mysql.connector.errorcode
-import mysql.connector.errors
 import typing
 import werkzeug.wrappers
 from flask_login import current_user, login_required
@@ -16,6 +16,8 @@ import lib.db.maintenance
 import views.api
 import views.auth
 import views.conf
+from lib.db.instrumentation import QueryStats
+from lib.metrics import registry
 from lib.forms import SearchForm, ImportJSonForm
 from lib.models import Metacard, Card
 from mtgcollector import app, lib
@@ -24,25 +26,68 @@ from mtgcollector import app, lib
 __author__ = "Benjamin Schubert, <ben.c.schubert@gmail.com>"
 
 
+request_duration = registry.histogram(
+    "mtgcollector_request_duration_seconds", "Time taken to answer requests, until the response is sent",
+    ["endpoint", "method", "status"]
+)
+
+
 @app.before_request
 def setup_db() -> typing.Union[werkzeug.wrappers.Response, None]:
     """ setups a db object before serving the user """
+    flask.g.request_start = time.perf_counter()
+    flask.g.query_stats = QueryStats()
     try:
         flask.g.db = lib.db.get_connection(app)
-    except (mysql.connector.errors.ProgrammingError, KeyError) as exc:
-        if app.config.get("DATABASE_NAME") is None:
-            if type(exc) == KeyError or exc.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-                if flask.request.endpoint in ["install", "static"]:
-                    return
-                else:
-                    return flask.redirect(flask.url_for("install"))
-        else:
+    except (lib.db.commands.Error, KeyError) as exc:
+        unknown_database = not isinstance(exc, KeyError) and lib.db.commands.Errors.unknown_database(exc)
+        if app.config.get("DATABASE_NAME") is None and (isinstance(exc, KeyError) or unknown_database):
+            if flask.request.endpoint in ["install", "static"]:
+                return
+            else:
+                return flask.redirect(flask.url_for("install"))
+        elif app.config.get("DATABASE_NAME") is not None and unknown_database:
             db = lib.db.maintenance.MaintenanceDB(app)
             db.setup_db()
             app.update_db.set()
 
             if flask.request.endpoint != 'install':
                 return flask.redirect(flask.url_for("install"))
+        else:
+            # the server being down or refusing connections is no reason to install the database again
+            raise
+
+
+@app.after_request
+def add_query_stats(response: werkzeug.wrappers.Response) -> werkzeug.wrappers.Response:
+    """
+    Reports the time spent in the database in the Server-Timing header and logs requests spending too much there
+
+    :param response: response to send
+    :return: the response, with its Server-Timing header
+    """
+    stats = getattr(flask.g, "query_stats", None)
+    if stats is not None:
+        response.headers.add("Server-Timing", stats.server_timing())
+        stats.log_if_slow("{} {}".format(flask.request.method, flask.request.path))
+    return response
+
+
+@app.after_request
+def record_request_duration(response: werkzeug.wrappers.Response) -> werkzeug.wrappers.Response:
+    """
+    Records the time taken to answer the request, by endpoint
+
+    :param response: response to send
+    :return: the response
+    """
+    start = getattr(flask.g, "request_start", None)
+    if start is not None:
+        request_duration.observe(
+            time.perf_counter() - start, endpoint=flask.request.endpoint or "unknown", method=flask.request.method,
+            status=str(response.status_code)
+        )
+    return response
 
 
 # noinspection PyUnusedLocal
@@ -6,7 +6,6 @@ RESTful API for mtgcollector
 """
 
 import io
-import json
 import os
 
 import flask
@@ -15,13 +14,22 @@ from flask.ext.login import login_required, current_user
 
 import mtgcollector
 from lib import models
+from lib.db.maintenance import UpdateJob
 from lib.exceptions import DataManipulationException
+from lib.json import JSONDecodeError
+from lib.metrics import registry
 from lib.forms import AddToCollectionForm, RenameDeck, ChangeDeckIndex, AddToDeckForm, ImportJSonForm
 
 
 __author__ = "Benjamin Schubert, <ben.c.schubert@gmail.com>"
 
 
+image_cache = registry.counter(
+    "mtgcollector_image_cache_total", "Requests for images and icons, by whether they were already downloaded",
+    ["kind", "result"]
+)
+
+
 @mtgcollector.app.route("/api/images/<card_id>")
 def get_image(card_id: int):
     """
@@ -32,7 +40,10 @@ def get_image(card_id: int):
     """
     filename = mtgcollector.app.image_handler.get_image_path(card_id)
     if not os.path.exists(os.path.join(mtgcollector.app.static_folder, filename)):
+        image_cache.inc(kind="image", result="miss")
         mtgcollector.app.image_handler.download_image(card_id, getattr(flask.g, "db"))
+    else:
+        image_cache.inc(kind="image", result="hit")
 
     return send_from_directory(os.path.dirname(filename), os.path.split(filename)[1])
 
@@ -47,7 +58,10 @@ def get_icon(icon: str):
     """
     filename = mtgcollector.app.image_handler.get_icon_path(icon)
     if not os.path.exists(os.path.join(mtgcollector.app.static_folder, filename)):
+        image_cache.inc(kind="icon", result="miss")
         mtgcollector.app.image_handler.download_icon(icon)
+    else:
+        image_cache.inc(kind="icon", result="hit")
 
     return send_from_directory(os.path.dirname(filename), icon)
 
@@ -90,6 +104,41 @@ def list_decks():
     return flask.jsonify(decks=current_user.collection.decks.list())
 
 
+@mtgcollector.app.route("/api/decks/missing", methods=["GET"])
+@login_required
+def list_missing_cards():
+    """ Gets the cards missing from the user's collection for all of his decks at once """
+    return flask.jsonify(missing=current_user.collection.decks.get_all_missing())
+
+
+@mtgcollector.app.route("/api/decks/<name>/analytics", methods=["GET"])
+@login_required
+def get_deck_analytics(name: str):
+    """
+    Gets statistics about the given deck : mana curve, colored mana symbols, card types and legality in each format
+
+    :param name: name of the deck
+    """
+    analytics = current_user.collection.decks.get_analytics(name)
+    if analytics is None:
+        flask.abort(404)
+    return flask.jsonify(**analytics)
+
+
+@mtgcollector.app.route("/api/decks/<name>/legality", methods=["GET"])
+@login_required
+def get_deck_legality(name: str):
+    """
+    Checks whether the given deck is legal in each format
+
+    :param name: name of the deck
+    """
+    legality = current_user.collection.decks.get_legality(name)
+    if legality is None:
+        flask.abort(404)
+    return flask.jsonify(legality=legality)
+
+
 @mtgcollector.app.route("/api/decks/<name>", methods=["POST"])
 @login_required
 def create_deck(name: str):
@@ -98,7 +147,10 @@ def create_deck(name: str):
 
     :param name: name of the deck to create
     """
-    current_user.collection.decks.add(name)
+    try:
+        current_user.collection.decks.add(name)
+    except DataManipulationException as e:
+        return (flask.jsonify(error=e.error), 400)
     return ('', 200)
 
 
@@ -175,7 +227,7 @@ def remove_card_from_deck(name: str, card_id: int):
     :param card_id: id of the card to remove
     :return: 200 OK
     """
-    current_user.decks.remove_card(name, card_id, flask.request.args.get("side", False))
+    current_user.collection.decks.remove_card(name, card_id, flask.request.args.get("side", False))
     return ('', 200)
 
 
@@ -202,10 +254,12 @@ def import_deck():
     if form.validate_on_submit():
         try:
             current_user.collection.decks.load(
-                    json.load(io.TextIOWrapper(form.file.data), object_hook=mtgcollector.lib.json.deck_parser
-            ))
+                    mtgcollector.lib.json.read_deck(io.TextIOWrapper(form.file.data, encoding="utf-8"))
+            )
         except DataManipulationException as e:
             return (flask.jsonify(error=e.error), 400)
+        except JSONDecodeError as e:
+            return (flask.jsonify(error=str(e)), 400)
         else:
             return flask.redirect(flask.url_for("decks"))
 
@@ -215,9 +269,21 @@ def import_deck():
 @mtgcollector.app.route("/api/export")
 @login_required
 def download_collection():
-    """ download user's collection """
-    response = flask.jsonify(current_user.collection.export())
-    response.headers["Content-Disposition"] = 'attachment;filename=collection_{}.json'.format(current_user.username)
+    """
+    download user's collection. The collection is streamed as it is read from the database, and compressed with gzip
+    if the 'gzip' argument is given
+    """
+    filename = "collection_{}.json".format(current_user.username)
+    data = mtgcollector.lib.json.stream_collection(current_user.collection.iter_export())
+    mimetype = "application/json"
+
+    if flask.request.args.get("gzip"):
+        data = mtgcollector.lib.json.gzip_stream(data)
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    response = flask.Response(flask.stream_with_context(data), mimetype=mimetype)
+    response.headers["Content-Disposition"] = 'attachment;filename={}'.format(filename)
     return response
 
 
@@ -229,11 +295,79 @@ def upload_collection():
 
     if form.validate_on_submit():
         try:
-            current_user.collection.load(json.load(
-                    io.TextIOWrapper(form.file.data), object_hook=mtgcollector.lib.json.collection_json_parser
-            ))
+            unresolved = current_user.collection.load(
+                    mtgcollector.lib.json.read_collection(io.TextIOWrapper(form.file.data, encoding="utf-8"))
+            )
         except DataManipulationException as e:
             return (flask.jsonify(error=e.error), 400)
+        except JSONDecodeError as e:
+            return (flask.jsonify(error=str(e)), 400)
         else:
+            if unresolved:
+                return flask.jsonify(
+                    error="{} cards could not be found, all others were imported".format(len(unresolved)),
+                    unresolved=unresolved
+                )
             return flask.redirect(flask.url_for("collection"))
     return (flask.jsonify(form.errors), 400)
+
+
+@mtgcollector.app.route("/api/update", methods=["GET"])
+@login_required
+def update_status():
+    """ Gets the progress and phase timings of the running or last database update. Only for administrators """
+    if not current_user.is_admin:
+        flask.abort(403)
+    return flask.jsonify(update=UpdateJob.status(mtgcollector.app))
+
+
+@mtgcollector.app.route("/api/update", methods=["DELETE"])
+@login_required
+def cancel_update():
+    """ Cancels the running database update. Only for administrators """
+    if not current_user.is_admin:
+        flask.abort(403)
+    UpdateJob.cancel(mtgcollector.app)
+    return ('', 200)
+
+
+@mtgcollector.app.route("/api/metrics", methods=["GET"])
+@login_required
+def get_metrics():
+    """ Exposes the metrics of this process in Prometheus' text format. Only for administrators """
+    if not current_user.is_admin:
+        flask.abort(403)
+    return flask.Response(registry.expose(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@mtgcollector.app.route("/api/profiles", methods=["GET"])
+@login_required
+def list_profiles():
+    """ Lists the stored profiles of requests, most recent first. Only for administrators """
+    if not current_user.is_admin:
+        flask.abort(403)
+    if not mtgcollector.app.profiler.enabled:
+        flask.abort(404)
+    return flask.jsonify(profiles=mtgcollector.app.profiler.list())
+
+
+@mtgcollector.app.route("/api/profiles/<name>", methods=["GET"])
+@login_required
+def get_profile(name: str):
+    """
+    Gets a stored profile, as a pstats file or as text with the 'format=text' argument. Only for administrators
+
+    :param name: name of the profile
+    """
+    if not current_user.is_admin:
+        flask.abort(403)
+    path = mtgcollector.app.profiler.path(name)
+    if path is None:
+        flask.abort(404)
+    if flask.request.args.get("format") == "text":
+        try:
+            report = mtgcollector.app.profiler.report(path, sort=flask.request.args.get("sort", "cumulative"))
+        except ValueError as e:
+            return (flask.jsonify(error=str(e)), 400)
+        return flask.Response(report, content_type="text/plain; charset=utf-8")
+    return send_from_directory(os.path.dirname(path), name, as_attachment=True)
@@ -8,7 +8,7 @@ Views for user authentication, registration and login
 import flask
 from flask_login import login_user, login_required, logout_user, current_user
 
-from lib.exceptions import DataManipulationException
+from lib.exceptions import DataManipulationException, ServerBusyException
 from lib.forms import LoginForm, RegisterForm
 from mtgcollector import app, lib
 
@@ -58,6 +58,8 @@ def register():
             ).create()
         except DataManipulationException:
             form.username.errors.append("A user with the same name or email already exists")
+        except ServerBusyException:
+            form.password.errors.append("The server is busy, please try again in a moment")
         else:
             login_user(user)
             return flask.redirect(flask.request.referrer or "index")
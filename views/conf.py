@@ -6,9 +6,6 @@ Handles the first configuration of the server
 """
 
 import flask
-import mysql.connector
-import mysql.connector.errorcode
-import mysql.connector.errors
 import werkzeug.routing
 import werkzeug.wrappers
 from flask import redirect, url_for, render_template
@@ -19,6 +16,7 @@ import lib.db.maintenance
 import lib.forms
 import lib.models
 from lib.conf import update_conf
+from lib.exceptions import ServerBusyException
 from mtgcollector import app
 
 
@@ -31,6 +29,9 @@ def validate_conf(form: lib.forms.InstallationForm):
 
     :param form: form containing the information
     """
+    import mysql.connector.errorcode  # the installation form configures a MySQL server, other setups don't need it
+    import mysql.connector.errors
+
     app.config.update({
         "DATABASE_USER": form.username.data,
         "DATABASE_HOST": form.host.data,
@@ -133,5 +134,8 @@ def change_parameters():
     form.set_defaults(current_user.username, current_user.email, False)
 
     if form.validate_on_submit():
-        current_user.update(form.username.data, form.email.data, form.password.data)
+        try:
+            current_user.update(form.username.data, form.email.data, form.password.data)
+        except ServerBusyException:
+            form.password.errors.append("The server is busy, please try again in a moment")
     return render_template('parameters.html', active_page="parameters", form=form, import_form=import_form)
@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+WSGI entry point, for servers such as uWSGI, gunicorn or mod_wsgi :
+
+    $ gunicorn --workers 4 --threads 8 wsgi:application
+
+Existing databases are migrated when the application is configured. The background tasks, updating the database and
+watching the catalog, run in a single one of the processes the WSGI server forks : the first one claiming them through
+a lock in the run directory. When it stops, another process claims them.
+"""
+
+import lib
+
+
+__author__ = "Benjamin Schubert <ben.c.schubert@gmail.com>"
+
+
+application = lib.import_logged("mtgcollector").create_app(background_tasks=None)